@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import attr
+import numpy as np
+
+ChatMessage = Dict[str, str]
+
+
+@attr.s
+class AnswerCacheEntry:
+    entry_id: int = attr.ib()
+    key: str = attr.ib()
+    question: str = attr.ib()
+    embedding: np.ndarray = attr.ib()
+    response: ChatMessage = attr.ib()
+    created_at: float = attr.ib()
+
+
+def make_answer_cache_key(model_name: str, paper_ids: Sequence[str], prompt_template: str,
+                          chat_history: List[ChatMessage] = ()) -> str:
+    '''Answers can only be shared between questions sent to the same model, with the same retrieved papers, the same
+    prompt template and the same previous turns.
+    '''
+    sha = hashlib.sha1()
+    sha.update(json.dumps([model_name, sorted(set(paper_ids)), prompt_template, list(chat_history)]).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class SemanticAnswerCache:
+    '''Cache of LLM answers looked up by key (see make_answer_cache_key) and by the similarity of the question embedding:
+    the answer of a cached question of the same key whose cosine similarity with the new question is at least
+    similarity_threshold is returned. Entries expire after ttl_seconds and the least recently used are evicted beyond
+    max_entries. With cache_path the entries are also stored in a sqlite database and reloaded on restart; the table is
+    trimmed to the max_entries most recent rows on load and on eviction, including the rows written by other processes
+    sharing the file.
+    '''
+
+    def __init__(self, similarity_threshold: float = 0.95, ttl_seconds: float = 24 * 3600, max_entries: int = 10000,
+                 cache_path: str = None):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.cache_path = cache_path
+        self._entries: "OrderedDict[int, AnswerCacheEntry]" = OrderedDict()
+        self._entries_by_key: Dict[str, List[int]] = {}
+        self._next_entry_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._db = None
+        if cache_path is not None:
+            self._open_db(cache_path)
+
+    def _open_db(self, cache_path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        self._db = sqlite3.connect(cache_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers (entry_id INTEGER PRIMARY KEY, key TEXT, question TEXT, "
+            "embedding BLOB, response TEXT, created_at REAL)"
+        )
+        self._db.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        self._trim_db()
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT entry_id, key, question, embedding, response, created_at FROM answers ORDER BY created_at"
+        ).fetchall()
+        for entry_id, key, question, embedding, response, created_at in rows:
+            self._add_entry(AnswerCacheEntry(
+                entry_id=entry_id, key=key, question=question, embedding=np.frombuffer(embedding, dtype=np.float32),
+                response=json.loads(response), created_at=created_at,
+            ))
+
+    def _trim_db(self):
+        self._db.execute(
+            "DELETE FROM answers WHERE entry_id NOT IN "
+            "(SELECT entry_id FROM answers ORDER BY created_at DESC, entry_id DESC LIMIT ?)", (self.max_entries,)
+        )
+
+    def _add_entry(self, entry: AnswerCacheEntry):
+        self._entries[entry.entry_id] = entry
+        self._entries_by_key.setdefault(entry.key, []).append(entry.entry_id)
+
+    def _remove_entry(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        key_entries = self._entries_by_key[entry.key]
+        key_entries.remove(entry_id)
+        if not key_entries:
+            del self._entries_by_key[entry.key]
+        if self._db is not None:
+            self._db.execute("DELETE FROM answers WHERE entry_id = ?", (entry_id,))
+
+    def get(self, key: str, question_embedding: np.ndarray) -> Optional[ChatMessage]:
+        question_embedding = np.asarray(question_embedding, dtype=np.float32).reshape(-1)
+        question_embedding = question_embedding / max(float(np.linalg.norm(question_embedding)), 1e-12)
+        with self._lock:
+            now = time.time()
+            best_entry, best_similarity = None, self.similarity_threshold
+            num_expired = 0
+            for entry_id in list(self._entries_by_key.get(key, [])):
+                entry = self._entries[entry_id]
+                if now - entry.created_at > self.ttl_seconds:
+                    self._remove_entry(entry_id)
+                    num_expired += 1
+                    continue
+                similarity = float(entry.embedding @ question_embedding)
+                if similarity >= best_similarity:
+                    best_entry, best_similarity = entry, similarity
+            self.expirations += num_expired
+            if num_expired and self._db is not None:
+                self._db.commit()
+            if best_entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_entry.entry_id)
+            self.hits += 1
+            return dict(best_entry.response)
+
+    def put(self, key: str, question: str, question_embedding: np.ndarray, response: ChatMessage):
+        question_embedding = np.asarray(question_embedding, dtype=np.float32).reshape(-1)
+        question_embedding = question_embedding / max(float(np.linalg.norm(question_embedding)), 1e-12)
+        response = {"role": response["role"], "content": response["content"]}
+        with self._lock:
+            created_at = time.time()
+            if self._db is not None:
+                # The database assigns the ids, so processes sharing the cache file never reuse each other's ids.
+                entry_id = self._db.execute(
+                    "INSERT INTO answers (key, question, embedding, response, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, question, question_embedding.tobytes(), json.dumps(response), created_at),
+                ).lastrowid
+            else:
+                entry_id = self._next_entry_id
+                self._next_entry_id += 1
+            self._add_entry(AnswerCacheEntry(entry_id=entry_id, key=key, question=question,
+                                             embedding=question_embedding, response=response, created_at=created_at))
+            num_evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._remove_entry(next(iter(self._entries)))
+                num_evicted += 1
+            self.evictions += num_evicted
+            if self._db is not None:
+                if num_evicted:
+                    self._trim_db()
+                self._db.commit()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self),
+        }
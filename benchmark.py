@@ -0,0 +1,464 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Sequence
+
+import attr
+import numpy as np
+import openai
+
+import embedding_vector_db
+from chat_agent import OpenAIPubMedAgent
+from document_retriever import DocumentRetriever, RetrievalArgs, EMBEDDING_VECTOR_DIM
+from embedding_store import write_embedding_split
+from fake_openai_server import FakeCompletionConfig, start_fake_openai_server
+from generating_paper_embedding import get_paper_hashes, get_split_content_hash, get_split_embeddings, iter_paper_splits
+from prompt_builder import PromptBuilder
+from vector_index import ANNOY_BACKEND, EXACT_BACKEND, QUANTIZED_BACKEND, VECTOR_INDEX_BACKENDS
+
+SYNTHETIC_MODEL_NAME = 'synthetic-hashing-encoder'
+# Default folder of the results files, ignored by git.
+BENCHMARK_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+
+
+@attr.s
+class BenchmarkConfig:
+    num_papers: int = attr.ib(default=2000)
+    papers_per_file: int = attr.ib(default=500)
+    abstract_words: int = attr.ib(default=150)
+    body_lines: int = attr.ib(default=40)
+    words_per_line: int = attr.ib(default=20)
+    vocabulary_size: int = attr.ib(default=20000)
+    num_topics: int = attr.ib(default=100)
+    vector_db_backend: str = attr.ib(default=ANNOY_BACKEND)
+    num_trees: int = attr.ib(default=100)
+    num_lists: int = attr.ib(default=1)
+    top_k: int = attr.ib(default=5)
+    num_queries: int = attr.ib(default=200)
+    # Questions sent through the agent, sequentially and then concurrently with arun.
+    num_agent_questions: int = attr.ib(default=20)
+    concurrency: int = attr.ib(default=8)
+    first_token_latency: float = attr.ib(default=0.2)
+    inter_token_latency: float = attr.ib(default=0.01)
+    seed: int = attr.ib(default=44)
+    # Fits the prompts with the tiktoken encodings, which must then be in the local tiktoken cache, instead of the
+    # ApproximateTokenizer.
+    use_tiktoken: bool = attr.ib(default=False)
+
+
+class SyntheticEncoder:
+    '''Stand-in for the SentenceTransformer query embedding model so the benchmark runs without downloading a model:
+    every word is hashed to a fixed random vector and a text is embedded as the normalized mean of its word vectors, so
+    texts sharing words are close. It has the encode / get_sentence_embedding_dimension API the repo relies on.
+    '''
+
+    def __init__(self, dim: int = EMBEDDING_VECTOR_DIM, num_buckets: int = 1 << 14, seed: int = 44):
+        self.dim = dim
+        self.num_buckets = num_buckets
+        # Names the embeddings of this encoder in the query embedding cache.
+        self.model_name = f"{SYNTHETIC_MODEL_NAME}-{dim}d-{num_buckets}-{seed}"
+        # The words are lower cased before they are hashed, so the cached queries can be lower cased too.
+        self.do_lower_case = True
+        self.word_vectors = np.random.default_rng(seed).normal(size=(num_buckets, dim)).astype(np.float32)
+
+    def _bucket(self, word: str) -> int:
+        return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little') % self.num_buckets
+
+    def _encode_one(self, text: str) -> np.ndarray:
+        buckets = [self._bucket(word) for word in text.lower().split()]
+        if not buckets:
+            return np.zeros(self.dim, dtype=np.float32)
+        return self.word_vectors[buckets].mean(axis=0)
+
+    def encode(self, sentences, batch_size: int = 32, normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        texts = [sentences] if isinstance(sentences, str) else list(sentences)
+        embeddings = np.stack([self._encode_one(text) for text in texts]) if texts else \
+            np.zeros((0, self.dim), dtype=np.float32)
+        if normalize_embeddings:
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if isinstance(sentences, str) else embeddings
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+
+class ApproximateTokenizer:
+    '''Stand-in for the tiktoken encoding so the prompts are fitted without downloading it: words are cut in pieces of
+    up to 4 characters, each with its leading space, and every other character is a token, which is close to the
+    cl100k_base token counts of English text. It has the encode / decode API PromptBuilder relies on.
+    '''
+    TOKEN_PATTERN = re.compile(r" ?[^\W_]{1,4}|\s+|.", re.DOTALL)
+
+    def encode(self, text: str, **kwargs) -> List[str]:
+        return self.TOKEN_PATTERN.findall(text)
+
+    def decode(self, tokens: List[str]) -> str:
+        return ''.join(tokens)
+
+
+def get_benchmark_prompt_builder(config: BenchmarkConfig) -> PromptBuilder:
+    '''The tiktoken encodings are loaded right away when use_tiktoken is set, so a missing cache fails before the
+    benchmark starts rather than on the first question.
+    '''
+    if not config.use_tiktoken:
+        return PromptBuilder(tokenizer=ApproximateTokenizer())
+    prompt_builder = PromptBuilder()
+    try:
+        for model_name in prompt_builder.model_names:
+            prompt_builder.get_tokenizer(model_name)
+    except Exception as e:
+        raise RuntimeError(f"Could not load the tiktoken encodings ({e}), set TIKTOKEN_CACHE_DIR to a folder holding "
+                           f"the cached cl100k_base encoding or run without --use_tiktoken") from e
+    return prompt_builder
+
+
+def generate_synthetic_corpus(cleaned_text_folder_path: str, config: BenchmarkConfig) -> List[str]:
+    '''Writes num_papers papers in the cleaned text format (one json dict of paper name -> abstract and main_body per
+    file). Every paper is about a topic: most of its words are drawn from the topic's words, so papers of the same topic
+    are near neighbors. Returns the paper names.
+    '''
+    rng = np.random.default_rng(config.seed)
+    vocabulary = np.array([f"term{idx}" for idx in range(config.vocabulary_size)])
+    topic_words = [rng.choice(config.vocabulary_size, size=50, replace=False) for _ in range(config.num_topics)]
+
+    def sample_words(topic: int, num_words: int) -> str:
+        words = np.where(rng.random(num_words) < 0.7, rng.choice(topic_words[topic], size=num_words),
+                         rng.integers(0, config.vocabulary_size, size=num_words))
+        return ' '.join(vocabulary[words])
+
+    os.makedirs(cleaned_text_folder_path, exist_ok=True)
+    paper_names = []
+    for file_idx, start in enumerate(range(0, config.num_papers, config.papers_per_file)):
+        papers = {}
+        for paper_idx in range(start, min(start + config.papers_per_file, config.num_papers)):
+            topic = int(rng.integers(config.num_topics))
+            paper_name = f"SYN{paper_idx:08d}.txt"
+            papers[paper_name] = {
+                'abstract': sample_words(topic, config.abstract_words),
+                'main_body': '\n'.join(sample_words(topic, config.words_per_line) for _ in range(config.body_lines)),
+            }
+            paper_names.append(paper_name)
+        with open(os.path.join(cleaned_text_folder_path, f"split_{file_idx}.jsonl"), 'w') as f:
+            f.write(json.dumps(papers))
+    return paper_names
+
+
+def embed_corpus(cleaned_text_folder_path: str, embeddings_folder_path: str, encoder) -> int:
+    '''Single process equivalent of generating_paper_embedding.generate_embedding_from_text with any encoder.
+    '''
+    num_papers = 0
+    for split_name, file_name, papers in iter_paper_splits(cleaned_text_folder_path):
+        abstract_embeddings, body_embeddings = get_split_embeddings(papers, encoder)
+        write_embedding_split(
+            embeddings_folder_path, split_name, file_name, [name for name, _ in papers], abstract_embeddings,
+            body_embeddings, SYNTHETIC_MODEL_NAME, encoder.get_sentence_embedding_dimension(),
+            content_hash=get_split_content_hash(papers, SYNTHETIC_MODEL_NAME), paper_hashes=get_paper_hashes(papers)
+        )
+        num_papers += len(papers)
+    return num_papers
+
+
+def build_vector_dbs(work_dir: str, config: BenchmarkConfig) -> Dict[str, Any]:
+    '''Builds the index to paper map and the vector DBs the same way embedding_vector_db.py does, returns the paths and
+    build time of every backend.
+    '''
+    paths = {
+        'embeddings': os.path.join(work_dir, 'paper_embedding'),
+        'json_map': os.path.join(work_dir, 'embedding_idx_paper_file_name_map.jsonl'),
+        'arrays_map': os.path.join(work_dir, 'embedding_idx_paper_map'),
+        ANNOY_BACKEND: os.path.join(work_dir, 'trained_annoy', 'index.ann'),
+        EXACT_BACKEND: os.path.join(work_dir, 'trained_exact', 'dataset.npy'),
+        QUANTIZED_BACKEND: os.path.join(work_dir, 'trained_quantized'),
+    }
+    build_times = {}
+    start_time = time.perf_counter()
+    _, embeddings_array = embedding_vector_db.create_and_store_embedding_idx_paper_map(
+        paths['embeddings'], paths['json_map'], paths['arrays_map']
+    )
+    build_times['paper_map'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    exact_vector_db = embedding_vector_db.create_and_train_exact_vector_db(embeddings_array)
+    embedding_vector_db.save_serialized_index(exact_vector_db, *os.path.split(paths[EXACT_BACKEND]))
+    build_times[EXACT_BACKEND] = time.perf_counter() - start_time
+
+    if config.vector_db_backend == ANNOY_BACKEND:
+        start_time = time.perf_counter()
+        annoy_vector_db = embedding_vector_db.create_and_train_annoy_vector_db(
+            embeddings_array, embedding_vector_db.AnnoyConfig(num_trees=config.num_trees)
+        )
+        embedding_vector_db.save_serialized_index(annoy_vector_db, *os.path.split(paths[ANNOY_BACKEND]))
+        build_times[ANNOY_BACKEND] = time.perf_counter() - start_time
+    elif config.vector_db_backend == QUANTIZED_BACKEND:
+        start_time = time.perf_counter()
+        quantized_vector_db = embedding_vector_db.create_and_train_quantized_vector_db(
+            np.load(paths[EXACT_BACKEND], mmap_mode='r'), embedding_vector_db.QuantizedConfig(num_lists=config.num_lists),
+            paths[EXACT_BACKEND]
+        )
+        embedding_vector_db.save_serialized_index(quantized_vector_db, *os.path.split(paths[QUANTIZED_BACKEND]))
+        build_times[QUANTIZED_BACKEND] = time.perf_counter() - start_time
+    return {'paths': paths, 'build_time': build_times}
+
+
+def make_questions(cleaned_text_folder_path: str, num_questions: int, seed: int) -> List[Dict[str, str]]:
+    '''Questions made of a dozen words of the abstract of a random paper, which is kept as the expected source paper.
+    '''
+    rng = np.random.default_rng(seed + 1)
+    papers = []
+    for file_name in sorted(os.listdir(cleaned_text_folder_path)):
+        with open(os.path.join(cleaned_text_folder_path, file_name), 'r') as f:
+            papers.extend(json.loads(f.readline()).items())
+    questions = []
+    for paper_idx in rng.choice(len(papers), size=num_questions, replace=num_questions > len(papers)):
+        paper_name, paper = papers[paper_idx]
+        words = paper['abstract'].split()
+        question_words = rng.choice(words, size=min(12, len(words)), replace=False)
+        questions.append({'question': f"What is known about {' '.join(question_words)}?", 'paper_name': paper_name})
+    return questions
+
+
+def summarize_latencies(latencies: Sequence[float]) -> Dict[str, float]:
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000
+    if not len(latencies):
+        return {'count': 0}
+    return {
+        'count': int(len(latencies)),
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+    }
+
+
+def benchmark_retrieval(retriever: DocumentRetriever, exact_retriever: DocumentRetriever,
+                        questions: List[Dict[str, str]], top_k: int) -> Dict[str, Any]:
+    stage_latencies = {'encode': [], 'search': [], 'passages': []}
+    source_paper_hits = 0
+    for question in questions:
+        start_time = time.perf_counter()
+        query_embedding = retriever.parse_query_to_embedding(question['question'])
+        stage_latencies['encode'].append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        candidate_papers = retriever.retrieve_candidate_papers_for_query(query_embedding, top_k)
+        stage_latencies['search'].append(time.perf_counter() - start_time)
+        source_paper_hits += question['paper_name'] in [paper_file_name[0] for paper_file_name in candidate_papers]
+
+        start_time = time.perf_counter()
+        retriever.retrieve_passages_for_query(query_embedding, candidate_papers)
+        stage_latencies['passages'].append(time.perf_counter() - start_time)
+
+    query_embeddings = retriever.parse_queries_to_embeddings([question['question'] for question in questions])
+    start_time = time.perf_counter()
+    results = retriever.retrieve_candidate_papers_for_queries(query_embeddings, top_k)
+    batch_search_time = time.perf_counter() - start_time
+    exact_results = exact_retriever.retrieve_candidate_papers_for_queries(query_embeddings, top_k)
+
+    return {
+        'latency': {stage: summarize_latencies(latencies) for stage, latencies in stage_latencies.items()},
+        'search_queries_per_sec': len(questions) / sum(stage_latencies['search']),
+        'batch_search_queries_per_sec': len(questions) / batch_search_time,
+        f'recall@{top_k}': embedding_vector_db.get_recall_at_k(
+            [result.indexes for result in results], [result.indexes for result in exact_results]
+        ),
+        f'source_paper_hit@{top_k}': source_paper_hits / len(questions),
+    }
+
+
+async def _run_concurrently(agent: OpenAIPubMedAgent, questions: List[str], concurrency: int) -> List[float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def ask(idx: int, question: str):
+        async with semaphore:
+            start_time = time.perf_counter()
+            await agent.arun(question, [], 0, session_id=f"benchmark-{idx}")
+            latencies.append(time.perf_counter() - start_time)
+            agent.end_session(f"benchmark-{idx}")
+
+    await asyncio.gather(*(ask(idx, question) for idx, question in enumerate(questions)))
+    await agent.aclose()
+    return latencies
+
+
+def benchmark_agent(retriever: DocumentRetriever, questions: List[Dict[str, str]], config: BenchmarkConfig,
+                    prompt_builder: PromptBuilder = None) -> Dict[str, Any]:
+    '''Runs the agent against a local fake chat completion server, so the numbers measure the agent's own overhead
+    on top of the configured LLM latency.
+    '''
+    if prompt_builder is None:
+        prompt_builder = get_benchmark_prompt_builder(config)
+    fake_server, api_base = start_fake_openai_server(
+        FakeCompletionConfig(first_token_latency=config.first_token_latency,
+                             inter_token_latency=config.inter_token_latency)
+    )
+    previous_api_base, previous_api_key = openai.api_base, openai.api_key
+    openai.api_base, openai.api_key = api_base, openai.api_key or 'benchmark'
+    try:
+        agent = OpenAIPubMedAgent(document_retriever=retriever, prompt_builder=prompt_builder)
+        question_texts = [question['question'] for question in questions]
+        run_latencies, first_token_latencies = [], []
+        for question in question_texts:
+            start_time = time.perf_counter()
+            agent.run(question)
+            run_latencies.append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            answer_stream = agent.run_stream(question)
+            next(answer_stream)
+            first_token_latencies.append(time.perf_counter() - start_time)
+            for _ in answer_stream:
+                pass
+
+        start_time = time.perf_counter()
+        concurrent_latencies = asyncio.run(_run_concurrently(agent, question_texts, config.concurrency))
+        concurrent_time = time.perf_counter() - start_time
+    finally:
+        fake_server.shutdown()
+        openai.api_base, openai.api_key = previous_api_base, previous_api_key
+
+    return {
+        'latency': {
+            'run': summarize_latencies(run_latencies),
+            'stream_time_to_first_token': summarize_latencies(first_token_latencies),
+            'arun_concurrent': summarize_latencies(concurrent_latencies),
+        },
+        'sequential_questions_per_sec': len(run_latencies) / sum(run_latencies),
+        'concurrent_questions_per_sec': len(concurrent_latencies) / concurrent_time,
+        'mean_prompt_tokens': float(np.mean([report.prompt_tokens for report in agent.token_reports])),
+    }
+
+
+def get_peak_rss_bytes() -> int:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    return int(peak_rss if sys.platform == 'darwin' else peak_rss * 1024)
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run_benchmark(config: BenchmarkConfig, work_dir: str) -> Dict[str, Any]:
+    prompt_builder = get_benchmark_prompt_builder(config)
+    encoder = SyntheticEncoder(seed=config.seed)
+    cleaned_text_folder_path = os.path.join(work_dir, 'cleaned_text')
+
+    start_time = time.perf_counter()
+    generate_synthetic_corpus(cleaned_text_folder_path, config)
+    corpus_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    embed_corpus(cleaned_text_folder_path, os.path.join(work_dir, 'paper_embedding'), encoder)
+    embedding_time = time.perf_counter() - start_time
+    vector_dbs = build_vector_dbs(work_dir, config)
+    paths = vector_dbs['paths']
+
+    def make_retriever(backend: str) -> DocumentRetriever:
+        retrieval_args = RetrievalArgs(
+            trained_vector_db_file_path=paths[backend], vector_db_index_to_papers_map_file_path=paths['json_map'],
+            vector_db_index_to_papers_arrays_path=paths['arrays_map'], paper_text_files_path=cleaned_text_folder_path,
+            paper_text_store_path=os.path.join(work_dir, 'paper_text_store'), top_k=config.top_k,
+            vector_db_backend=backend, embeddings_folder_path=paths['embeddings'], query_embedding_cache_size=0,
+            lexical_index_path=None,
+        )
+        return DocumentRetriever(retrieval_args, encoder)
+
+    start_time = time.perf_counter()
+    retriever = make_retriever(config.vector_db_backend)
+    retriever_load_time = time.perf_counter() - start_time
+    questions = make_questions(cleaned_text_folder_path, config.num_queries, config.seed)
+    retrieval = benchmark_retrieval(retriever, make_retriever(EXACT_BACKEND), questions, config.top_k)
+    agent = benchmark_agent(retriever, questions[:config.num_agent_questions], config, prompt_builder)
+
+    return {
+        'config': attr.asdict(config),
+        'git_commit': get_git_commit(),
+        'timestamp': time.time(),
+        'build': dict(vector_dbs['build_time'], corpus=corpus_time, embedding=embedding_time,
+                      retriever_load=retriever_load_time),
+        'retrieval': retrieval,
+        'agent': agent,
+        'peak_rss_bytes': get_peak_rss_bytes(),
+    }
+
+
+def _flatten(results: Dict[str, Any], prefix: str = '') -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare_results(baseline: Dict[str, Any], results: Dict[str, Any]) -> Dict[str, float]:
+    '''Relative change of every numeric metric present in both results, e.g. 0.1 for 10% higher than the baseline.
+    '''
+    baseline_metrics = _flatten({key: baseline[key] for key in ('build', 'retrieval', 'agent', 'peak_rss_bytes')
+                                 if key in baseline})
+    metrics = _flatten({key: results[key] for key in ('build', 'retrieval', 'agent', 'peak_rss_bytes')})
+    return {name: (value - baseline_metrics[name]) / baseline_metrics[name] for name, value in metrics.items()
+            if baseline_metrics.get(name)}
+
+
+if __name__ == "__main__":
+    """
+    $ python benchmark.py --num_papers 5000 --vector_db_backend annoy --output results.json
+    $ python benchmark.py --num_papers 5000 --vector_db_backend quantized --compare results.json
+    $ python benchmark.py --output -     # only print the results
+
+    Without --output the results are written to a new timestamped file of benchmark_results/.
+
+    Runs offline: the corpus, embeddings, LLM and tokenizer are synthetic. With --use_tiktoken the prompts are fitted
+    with the tiktoken encodings instead, which must be available in the local tiktoken cache (TIKTOKEN_CACHE_DIR).
+    """
+    parser = argparse.ArgumentParser(description="End to end offline benchmark on a synthetic corpus and a fake LLM")
+    for field in attr.fields(BenchmarkConfig):
+        if field.name == 'vector_db_backend':
+            parser.add_argument("--vector_db_backend", default=field.default, choices=VECTOR_INDEX_BACKENDS)
+        elif isinstance(field.default, bool):
+            parser.add_argument(f"--{field.name}", action='store_true')
+        else:
+            parser.add_argument(f"--{field.name}", type=type(field.default), default=field.default)
+    parser.add_argument("--work_dir", default=None, help="Keeps the generated corpus and indexes, temporary otherwise")
+    parser.add_argument("--output", default=None,
+                        help="Results file, - to only print them, a new file of benchmark_results/ by default")
+    parser.add_argument("--compare", default=None, help="Results file of a previous run to compare against")
+    args = parser.parse_args()
+    benchmark_config = BenchmarkConfig(**{field.name: getattr(args, field.name)
+                                          for field in attr.fields(BenchmarkConfig)})
+
+    benchmark_work_dir = args.work_dir or tempfile.mkdtemp(prefix='pubmed_benchmark_')
+    try:
+        benchmark_results = run_benchmark(benchmark_config, benchmark_work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(benchmark_work_dir, ignore_errors=True)
+    if args.output == '-':
+        print(json.dumps(benchmark_results, indent=2))
+    else:
+        output_path = args.output or os.path.join(BENCHMARK_RESULTS_DIR, time.strftime('results_%Y%m%d_%H%M%S.json'))
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with open(output_path, 'w') as f:
+            f.write(json.dumps(benchmark_results, indent=2))
+        print(json.dumps({key: benchmark_results[key] for key in ('build', 'retrieval', 'agent', 'peak_rss_bytes')},
+                         indent=2))
+        print(f"Wrote the results to {output_path}")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            for metric, change in sorted(compare_results(json.loads(f.read()), benchmark_results).items()):
+                print(f"{metric:<60}{change:+8.1%}")
@@ -1,19 +1,54 @@
+import asyncio
+import collections
 import openai
-from typing import List, Optional, Dict, Union
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Generator, Iterator, List, Optional, Dict, Tuple, Union
+import aiohttp
 import attr
 import backoff
-from constants import SYSTEM_ROLE, SYSTEM_PROMPT_TEMPLATE, HUMAN_QUESTION, ACTOR_USER, ASSISTANT_ROLE
-from document_retriever import DocumentRetriever, RetrievalArgs
+from answer_cache import SemanticAnswerCache, make_answer_cache_key
+from constants import SYSTEM_ROLE, SYSTEM_PROMPT_TEMPLATE, PASSAGES_SYSTEM_PROMPT_TEMPLATE, HUMAN_QUESTION, ACTOR_USER, \
+    ASSISTANT_ROLE, OPENAI_GPT35_16K_MODEL, OPENAI_GPT35_4K_MODEL
+from document_retriever import DocumentRetriever, Passage, RetrievalArgs
+from metrics import METRICS, STAGE_SECONDS
+from prompt_builder import PromptBuilder, TokenReport
 
 
-OPENAI_GPT35_16K_MODEL = "gpt-3.5-turbo-16k"
-OPENAI_GPT35_4K_MODEL = "gpt-3.5-turbo"
 # openai.api_key = PROPHET_KEY
 
 DEFAULT_TEMPERATURE = 0.3
+DEFAULT_SESSION_ID = 'default'
+# Number of most recent token reports kept by the agent.
+MAX_TOKEN_REPORTS = 1000
 ChatMessage = Dict[str, str]
 
 
+def _count_openai_retry(details: Dict):
+    METRICS.increment('openai_retries', error=type(details.get('exception')).__name__)
+
+
+def _count_openai_give_up(details: Dict):
+    METRICS.increment('openai_failures', error=type(details.get('exception')).__name__)
+
+
+retry_on_openai_errors = backoff.on_exception(
+    backoff.expo,
+    (
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.APIConnectionError,
+    ),
+    max_tries=10,
+    base=2,
+    factor=2,
+    max_value=10,
+    on_backoff=_count_openai_retry,
+    on_giveup=_count_openai_give_up,
+)
+
+
 def increment_chat(chat_history: List[ChatMessage], question: str, response: str) -> List[ChatMessage]:
     new_chat = list(chat_history)
     new_chat.append({"role": ACTOR_USER, "content": question})
@@ -21,75 +56,365 @@ def increment_chat(chat_history: List[ChatMessage], question: str, response: str
     return new_chat
 
 
+def render_full_paper_context(passages: List[Passage]) -> str:
+    '''Renders the abstract and main body passages of a single paper the same way as the original full paper prompt.
+    '''
+    passages = sorted(passages, key=lambda passage: passage.section != 'abstract')
+    return '\n[SEP]\n'.join(passage.text for passage in passages)
+
+
+@attr.s
+class ChatSession:
+    '''Paper context retrieved by the last new question (state 0) of a chat session, reused by its follow up questions.
+    '''
+    session_id: str = attr.ib()
+    passages: List[Passage] = attr.ib(default=attr.Factory(list))
+    prompt_template: str = attr.ib(default=PASSAGES_SYSTEM_PROMPT_TEMPLATE)
+    render_context: Callable[[List[Passage]], str] = attr.ib(default=DocumentRetriever.build_passage_context)
+    system_prompt: str = attr.ib(default=None)
+    last_used_time: float = attr.ib(default=attr.Factory(time.time))
+
+
 @attr.s
 class OpenAIPubMedAgent(openai.ChatCompletion):
     temperature = attr.ib(default=DEFAULT_TEMPERATURE)
     model_name: str = attr.ib(default=OPENAI_GPT35_16K_MODEL)
     verbose: bool = attr.ib(default=False)
     system_prompt_template: str = attr.ib(default=SYSTEM_PROMPT_TEMPLATE)
+    # When set, the prompt holds the best passages of all the retrieved papers instead of the full first paper.
+    use_passage_retrieval: bool = attr.ib(default=True)
+    passages_system_prompt_template: str = attr.ib(default=PASSAGES_SYSTEM_PROMPT_TEMPLATE)
     human_question: str = attr.ib(default=HUMAN_QUESTION)
     retrieval_args: RetrievalArgs = attr.ib(default=None)
     document_retriever: DocumentRetriever = attr.ib(default=None)
+    # Fits the prompt and chat history in the model's context window, and picks the model when auto_select_model is on.
+    prompt_builder: PromptBuilder = attr.ib(default=attr.Factory(PromptBuilder))
+    # Max number of LLM requests in flight at once from arun.
+    max_concurrent_requests: int = attr.ib(default=16)
+    # Threads running the query encoding, vector search and paper text reads of arun.
+    max_retrieval_workers: int = attr.ib(default=4)
+    # Returns the answer of a near identical question about the same papers instead of calling the LLM.
+    answer_cache: SemanticAnswerCache = attr.ib(default=None)
+    # The least recently used sessions beyond max_sessions, and the ones idle for session_ttl_seconds, are dropped.
+    max_sessions: int = attr.ib(default=10000)
+    session_ttl_seconds: float = attr.ib(default=24 * 3600)
 
     def __attrs_post_init__(self):
+        if self.max_sessions < 1:
+            raise ValueError(f"max_sessions must be at least 1, got {self.max_sessions}")
         self._prepare_retriever()
+        self.token_reports: Deque[TokenReport] = collections.deque(maxlen=MAX_TOKEN_REPORTS)
+        # Sessions in least recently used order.
+        self.sessions: "collections.OrderedDict[str, ChatSession]" = collections.OrderedDict()
+        self._sessions_lock = threading.Lock()
+        self._retrieval_executor = None
+        # The aiohttp session and the semaphore belong to the event loop they were created on, see _bind_to_loop.
+        self._loop = None
+        self._request_semaphore = None
+        self._http_session = None
 
     def _prepare_retriever(self):
       if self.document_retriever is None:
         self.document_retriever = DocumentRetriever(self.retrieval_args)
 
-    def build_chat(self, inputs: Dict[str, Union[str, List[ChatMessage]]]) -> List[ChatMessage]:
-        messages = [
-            {"role": SYSTEM_ROLE, "content": self.system_prompt}
-        ]
+    def get_session(self, session_id: str = DEFAULT_SESSION_ID) -> ChatSession:
+        now = time.time()
+        with self._sessions_lock:
+            session = self.sessions.get(session_id)
+            if session is None or now - session.last_used_time > self.session_ttl_seconds:
+                session = self.sessions[session_id] = ChatSession(session_id=session_id)
+            session.last_used_time = now
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_sessions or \
+                    now - next(iter(self.sessions.values())).last_used_time > self.session_ttl_seconds:
+                self.sessions.popitem(last=False)
+                METRICS.increment('chat_session_evictions')
+        return session
+
+    @property
+    def system_prompt(self) -> str:
+        return self.get_session().system_prompt
 
-        messages.extend(inputs.get("chat_history", []))
-        messages.append({"role": ACTOR_USER, "content": self.human_question.format(question=inputs["input"])})
+    def _build_chat_with_report(self, inputs: Dict[str, Union[str, List[ChatMessage]]], session: ChatSession
+                                ) -> Tuple[List[ChatMessage], TokenReport]:
+        with METRICS.span('prompt_build'):
+            messages, token_report = self.prompt_builder.build(
+                session.prompt_template, session.passages, session.render_context, inputs.get("chat_history", []),
+                self.human_question.format(question=inputs["input"]), self.model_name
+            )
+        session.system_prompt = messages[0]['content']
+        self.token_reports.append(token_report)
+        return messages, token_report
+
+    def _finish_token_report(self, token_report: TokenReport):
+        '''Records the tokens of the report once the question is answered, whether by the LLM or by the answer cache.
+        '''
+        if token_report.answer_cache_hit:
+            # Nothing was sent to the LLM.
+            token_report.prompt_tokens = token_report.system_tokens = token_report.history_tokens = 0
+            token_report.question_tokens = token_report.completion_tokens = 0
+        METRICS.increment('prompt_tokens', token_report.prompt_tokens, model=token_report.model_name)
+        if token_report.completion_tokens is not None:
+            METRICS.increment('completion_tokens', token_report.completion_tokens, model=token_report.model_name)
+        if token_report.time_to_first_token is not None:
+            METRICS.observe('llm_time_to_first_token_seconds', token_report.time_to_first_token,
+                            model=token_report.model_name)
+        if self.verbose:
+            print(token_report)
+
+    def build_chat(self, inputs: Dict[str, Union[str, List[ChatMessage]]], session_id: str = DEFAULT_SESSION_ID
+                   ) -> List[ChatMessage]:
+        messages, _ = self._build_chat_with_report(inputs, self.get_session(session_id))
         return messages
 
-    @backoff.on_exception(
-        backoff.expo,
-        (
-            openai.error.RateLimitError,
-            openai.error.ServiceUnavailableError,
-            openai.error.APIConnectionError,
-        ),
-        max_tries=10,
-        base=2,
-        factor=2,
-        max_value=10,
-    )
-    def generate(self,messages: List[ChatMessage],stop: Optional[List[str]] = None) -> ChatMessage:
+    @retry_on_openai_errors
+    def generate(self,messages: List[ChatMessage],stop: Optional[List[str]] = None, model_name: str = None) -> ChatMessage:
         openai_api_args = dict(
-            model=self.model_name,
+            model=model_name or self.model_name,
             messages=messages,
             stop=stop,
             temperature=self.temperature,
+            max_tokens=self.prompt_builder.max_completion_tokens,
         )
         response = openai.ChatCompletion.create(**openai_api_args)
         return response
 
-    def run(self, question, chat_history: List[ChatMessage]=[], state: int=0):
+    @retry_on_openai_errors
+    def generate_stream(self, messages: List[ChatMessage], stop: Optional[List[str]] = None,
+                        model_name: str = None) -> Iterator[Dict]:
+        '''Streaming version of generate returning the iterator of response chunks. The request is sent when this is
+        called, so the retries cover failures to start the stream but not a stream interrupted half way.
+        '''
+        openai_api_args = dict(
+            model=model_name or self.model_name,
+            messages=messages,
+            stop=stop,
+            temperature=self.temperature,
+            max_tokens=self.prompt_builder.max_completion_tokens,
+            stream=True,
+        )
+        return openai.ChatCompletion.create(**openai_api_args)
+
+    def _set_session_context(self, candidate_papers: List[Tuple[str, str]], question: str, session: ChatSession):
+        with METRICS.span('session_context'):
+            self._set_session_passages(candidate_papers, question, session)
+
+    def _set_session_passages(self, candidate_papers: List[Tuple[str, str]], question: str, session: ChatSession):
+        if len(candidate_papers) == 0:
+            # No paper to ground the answer on, the prompt instructs the model to say it cannot find the answer.
+            session.passages = []
+            session.prompt_template = self.passages_system_prompt_template
+            session.render_context = self.document_retriever.build_passage_context
+        elif self.use_passage_retrieval:
+            session.passages = self.document_retriever.retrieve_passages_for_query(question, candidate_papers)
+            session.prompt_template = self.passages_system_prompt_template
+            session.render_context = self.document_retriever.build_passage_context
+        else:
+            paper_abstract = self.document_retriever.get_abstract_from_paper_file_name(candidate_papers[0])
+            paper_body = self.document_retriever.get_body_from_paper_file_name(candidate_papers[0])
+            # The abstract is kept ahead of the body when the paper has to be truncated to fit the context window.
+            session.passages = [
+                Passage(paper_file_name=candidate_papers[0], section='abstract', score=1.0, text=paper_abstract),
+                Passage(paper_file_name=candidate_papers[0], section='main_body', score=0.0, text=paper_body),
+            ]
+            session.prompt_template = self.system_prompt_template
+            session.render_context = render_full_paper_context
+
+    @staticmethod
+    def _get_inputs(question, chat_history: List[ChatMessage], state: int) -> Dict[str, Union[str, List[ChatMessage]]]:
         inputs = {}
+        if state != 0:
+            if len(chat_history) == 0 or chat_history is None:
+                raise ValueError(f"The Agent is in continue chat state but no chat history exists. Please set the state to new question and run the program again.")
+            inputs['chat_history'] = chat_history
+        inputs['input'] = question
+        return inputs
+
+    def _prepare_messages(self, question, chat_history: List[ChatMessage], state: int, session_id: str
+                          ) -> Tuple[List[ChatMessage], TokenReport]:
+        inputs = self._get_inputs(question, chat_history, state)
+        session = self.get_session(session_id)
         if state == 0:
             # Implies a net new discussion that required new retrieval and we don't expect to have chat history.
             # This could or could not have a chat history
-            candidate_papers = self.document_retriever.retrieve_candidate_papers_for_query(question)
-            if len(candidate_papers) == 0:
-                # Fill in some default response. and probably we have prompt the user to ask another question.
-                response = {f"{ASSISTANT_ROLE}" : "Could not find any paper relevant to the question"}
+            with METRICS.span('paper_retrieval'):
+                candidate_papers = self.document_retriever.retrieve_candidate_papers_for_query(question)
+            self._set_session_context(candidate_papers, question, session)
+        return self._build_chat_with_report(inputs, session)
+
+    def _get_answer_cache_key(self, chat_history: List[ChatMessage], state: int, session: ChatSession,
+                              model_name: str) -> str:
+        paper_ids = [passage.paper_file_name[0] for passage in session.passages]
+        return make_answer_cache_key(model_name, paper_ids, session.prompt_template + self.human_question,
+                                     chat_history if state != 0 else [])
+
+    def _get_cached_answer(self, question, chat_history: List[ChatMessage], state: int, session_id: str,
+                           token_report: TokenReport) -> Tuple[Optional[ChatMessage], Optional[Tuple]]:
+        '''Returns the cached answer, if any, and the (key, question embedding) to store the generated answer under.
+        '''
+        if self.answer_cache is None:
+            return None, None
+        with METRICS.span('answer_cache_lookup'):
+            key = self._get_answer_cache_key(chat_history, state, self.get_session(session_id),
+                                             token_report.model_name)
+            question_embedding = self.document_retriever.parse_query_to_embedding(question)
+            response = self.answer_cache.get(key, question_embedding)
+        token_report.answer_cache_hit = response is not None
+        METRICS.increment('answer_cache_lookups', result='hit' if response is not None else 'miss')
+        return response, (key, question_embedding)
+
+    def _cache_answer(self, question, cache_entry: Optional[Tuple], response: ChatMessage):
+        if cache_entry is not None:
+            key, question_embedding = cache_entry
+            self.answer_cache.put(key, question, question_embedding, response)
+
+    def run(self, question, chat_history: List[ChatMessage]=[], state: int=0, session_id: str = DEFAULT_SESSION_ID):
+        messages, token_report = self._prepare_messages(question, chat_history, state, session_id)
+        response, cache_entry = self._get_cached_answer(question, chat_history, state, session_id, token_report)
+        if response is not None:
+            self._finish_token_report(token_report)
+            return response, increment_chat(chat_history=chat_history, question=question, response=response)
+        start_time = time.time()
+        with METRICS.span('llm_generate'):
+            response = self.generate(messages, model_name=token_report.model_name)
+        token_report.time_to_first_token = time.time() - start_time
+        token_report.completion_tokens = response.get('usage', {}).get('completion_tokens')
+        self._finish_token_report(token_report)
+        response = response['choices'][0]['message']
+        self._cache_answer(question, cache_entry, response)
+        new_chat = increment_chat(chat_history=chat_history, question=question, response=response)
+        return response, new_chat
+
+    def run_stream(self, question, chat_history: List[ChatMessage]=[], state: int=0,
+                   session_id: str = DEFAULT_SESSION_ID) -> Generator[str, None, Tuple[ChatMessage, List[ChatMessage]]]:
+        '''Same as run but yields the answer deltas as they arrive. The finished message and the updated chat history
+        are the return value of the generator, e.g. `response, chat_history = yield from agent.run_stream(question)`.
+        '''
+        messages, token_report = self._prepare_messages(question, chat_history, state, session_id)
+        response, cache_entry = self._get_cached_answer(question, chat_history, state, session_id, token_report)
+        if response is not None:
+            self._finish_token_report(token_report)
+            yield response['content']
+            return response, increment_chat(chat_history=chat_history, question=question, response=response)
+        start_time = time.time()
+        role, content = ASSISTANT_ROLE, []
+        with METRICS.span('llm_stream_start'):
+            chunks = self.generate_stream(messages, model_name=token_report.model_name)
+        for chunk in chunks:
+            if not chunk['choices']:
+                continue
+            delta = chunk['choices'][0].get('delta', {})
+            role = delta.get('role', role)
+            if delta.get('content'):
+                if not content:
+                    token_report.time_to_first_token = time.time() - start_time
+                content.append(delta['content'])
+                yield delta['content']
+        # Streamed responses carry no usage, the completion is counted with the same tokenizer as the prompt.
+        token_report.completion_tokens = self.prompt_builder.count_tokens(''.join(content), token_report.model_name)
+        METRICS.observe(STAGE_SECONDS, time.time() - start_time, stage='llm_stream')
+        self._finish_token_report(token_report)
+        response = {"role": role, "content": ''.join(content)}
+        self._cache_answer(question, cache_entry, response)
+        new_chat = increment_chat(chat_history=chat_history, question=question, response=response)
+        return response, new_chat
+
+    def _get_retrieval_executor(self) -> ThreadPoolExecutor:
+        if self._retrieval_executor is None:
+            self._retrieval_executor = ThreadPoolExecutor(max_workers=self.max_retrieval_workers)
+        return self._retrieval_executor
+
+    async def _bind_to_loop(self):
+        '''Creates the aiohttp session and the request semaphore for the running event loop. They can not be used from
+        another loop, so when the agent is used from a new loop (e.g. a second asyncio.run) they are replaced, and the
+        session of the previous loop is closed if that loop still runs. Call aclose before a loop ends to also close
+        its connections cleanly.
+        '''
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._http_session is not None and not self._http_session.closed:
+            return
+        previous_loop, previous_session = self._loop, self._http_session
+        if previous_session is not None and not previous_session.closed and previous_loop is not loop:
+            if previous_loop is not None and previous_loop.is_running():
+                asyncio.run_coroutine_threadsafe(previous_session.close(), previous_loop)
             else:
-                paper_abstract = self.document_retriever.get_abstract_from_paper_file_name(candidate_papers[0])
-                paper_body = self.document_retriever.get_body_from_paper_file_name(candidate_papers[0])
-                self.system_prompt = self.system_prompt_template.format(paper_text=paper_abstract+'\n[SEP]\n'+paper_body)
-        else:
-            if len(chat_history) == 0 or chat_history is None:
-                raise ValueError(f"The Agent is in continue chat state but no chat history exists. Please set the state to new question and run the program again.")
-            inputs['chat_history'] = chat_history
+                # Nothing can be awaited on a finished loop any more, its connections are dropped with it.
+                previous_session.detach()
+        self._loop = loop
+        self._request_semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        self._http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrent_requests))
 
-        inputs['input'] = question
-        messages = self.build_chat(inputs)
-        response = self.generate(messages)
+    async def _get_http_session(self) -> aiohttp.ClientSession:
+        await self._bind_to_loop()
+        return self._http_session
+
+    @retry_on_openai_errors
+    async def agenerate(self, messages: List[ChatMessage], stop: Optional[List[str]] = None,
+                        model_name: str = None) -> ChatMessage:
+        '''Async version of generate. All the requests share one aiohttp connection pool and at most
+        max_concurrent_requests are in flight at once.
+        '''
+        openai.aiosession.set(await self._get_http_session())
+        openai_api_args = dict(
+            model=model_name or self.model_name,
+            messages=messages,
+            stop=stop,
+            temperature=self.temperature,
+            max_tokens=self.prompt_builder.max_completion_tokens,
+        )
+        async with self._request_semaphore:
+            response = await openai.ChatCompletion.acreate(**openai_api_args)
+        return response
+
+    async def arun(self, question, chat_history: List[ChatMessage]=[], state: int=0,
+                   session_id: str = DEFAULT_SESSION_ID, candidate_papers: List[Tuple[str, str]] = None):
+        '''Async version of run, many sessions can be answered concurrently from one process. The query encoding, the
+        vector search, the paper text reads and the token counting run on a thread pool so the event loop only waits on
+        the LLM requests. Every session_id keeps its own paper context. candidate_papers already retrieved for the
+        question (e.g. by a batched search) skip the paper level search.
+        '''
+        loop = asyncio.get_running_loop()
+        executor = self._get_retrieval_executor()
+        inputs = self._get_inputs(question, chat_history, state)
+        session = self.get_session(session_id)
+        if state == 0:
+            if candidate_papers is None:
+                with METRICS.span('paper_retrieval'):
+                    candidate_papers = await loop.run_in_executor(
+                        executor, self.document_retriever.retrieve_candidate_papers_for_query, question
+                    )
+            await loop.run_in_executor(executor, self._set_session_context, candidate_papers, question, session)
+        messages, token_report = await loop.run_in_executor(executor, self._build_chat_with_report, inputs, session)
+        response, cache_entry = await loop.run_in_executor(
+            executor, self._get_cached_answer, question, chat_history, state, session_id, token_report
+        )
+        if response is not None:
+            self._finish_token_report(token_report)
+            return response, increment_chat(chat_history=chat_history, question=question, response=response)
+
+        start_time = time.time()
+        with METRICS.span('llm_generate'):
+            response = await self.agenerate(messages, model_name=token_report.model_name)
+        token_report.time_to_first_token = time.time() - start_time
+        token_report.completion_tokens = response.get('usage', {}).get('completion_tokens')
+        self._finish_token_report(token_report)
         response = response['choices'][0]['message']
+        await loop.run_in_executor(executor, self._cache_answer, question, cache_entry, response)
         new_chat = increment_chat(chat_history=chat_history, question=question, response=response)
         return response, new_chat
+
+    def end_session(self, session_id: str):
+        with self._sessions_lock:
+            self.sessions.pop(session_id, None)
+
+    async def aclose(self):
+        '''Releases the connections and threads of arun, which recreates them if the agent is used again.
+        '''
+        if self._http_session is not None and self._loop is asyncio.get_running_loop():
+            await self._http_session.close()
+        if self._retrieval_executor is not None:
+            self._retrieval_executor.shutdown(wait=False)
+        self._http_session = None
+        self._request_semaphore = None
+        self._retrieval_executor = None
+        self._loop = None
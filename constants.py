@@ -11,8 +11,23 @@ You should provide accurate and informative responses to any question a human ma
 DO NOT GENERATE ANSWERS BEYOND THE SCOPE OF THE PROVIDED PAPER. RESTRICT THE ANSWER TO A MAXIMUM OF 1000 TOKENS.
 """
 
+PASSAGES_SYSTEM_PROMPT_TEMPLATE = """
+You are a medical researcher tasked with providing the best answer for the question from the provided excerpts of medical research papers:
+--- START PAPERS ---
+{paper_text}
+--- END PAPERS ---
+[SEP]
+## Instructions
+You should provide accurate and informative responses to any question a human may ask about these papers. If you cannot find the relevant answer in the given excerpts, return saying CANNOT FIND THE ANSWER IN THE PROVIDED SET OF PAPERS.
+DO NOT GENERATE ANSWERS BEYOND THE SCOPE OF THE PROVIDED PAPERS. RESTRICT THE ANSWER TO A MAXIMUM OF 1000 TOKENS.
+"""
+
 HUMAN_QUESTION = "{question}"
 
+EMBEDDING_MODEL_NAME = 'all-mpnet-base-v2'
+OPENAI_GPT35_16K_MODEL = "gpt-3.5-turbo-16k"
+OPENAI_GPT35_4K_MODEL = "gpt-3.5-turbo"
+
 ACTOR_USER = "user"
 SYSTEM_ROLE = "system"
 ASSISTANT_ROLE = "assistant"
@@ -32,16 +47,31 @@ OTHER_DATA_DIR_NAME = 'pubmed_data'
 PAPER_EMBEDDING_DIR = 'paper_embedding'
 SCANN_DB_DIR = "trained_scann"
 TRAINED_ANNOY_DIR = "trained_annoy"
+TRAINED_QUANTIZED_DIR = "trained_quantized"
 ANNOY_FILE_NAME = "index.ann"
+EXACT_DATASET_FILE_NAME = "dataset.npy"
 EMBEDDING_IDX_TO_PAPER_MAP = 'embedding_idx_paper_file_name_map.jsonl'
+EMBEDDING_IDX_TO_PAPER_ARRAYS_DIR = 'embedding_idx_paper_map'
+PAPER_NAMES_FILE_NAME = 'paper_names.npy'
+PAPER_FILE_IDS_FILE_NAME = 'file_ids.npy'
+PAPER_INDEX_MAP_META_FILE_NAME = 'meta.json'
+PAPER_TEXT_STORE_DIR = 'paper_text_store'
+ONNX_QUERY_ENCODER_DIR = 'onnx_query_encoder'
+LEXICAL_INDEX_DIR = 'lexical_index'
+PAPER_TEXT_DATA_FILE_NAME = 'papers.bin'
+PAPER_TEXT_INDEX_FILE_NAME = 'papers_index.json'
 
 RUNTIME_DATA_DIR_PATH = os.path.join(BASE_DIR, REPO_BASE_DIR, RUNTIME_DATA_DIR_NAME)
 EMBEDDINGS_FOLDER_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, PAPER_EMBEDDING_DIR)
 TRAINED_VECTOR_DB_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, SCANN_DB_DIR)
 TRAINED_ANNOY_DB_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, TRAINED_ANNOY_DIR)
+TRAINED_QUANTIZED_DB_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, TRAINED_QUANTIZED_DIR)
 EMBEDDING_INDEX_TO_PAPER_FILE_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, EMBEDDING_IDX_TO_PAPER_MAP)
+EMBEDDING_INDEX_TO_PAPER_ARRAYS_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, EMBEDDING_IDX_TO_PAPER_ARRAYS_DIR)
 
 OTHER_DATA_DIR = os.path.join(BASE_DIR, OTHER_DATA_DIR_NAME)
-ABSTRACT_EMBEDDINGS_FILE_PATH = EMBEDDINGS_FOLDER_PATH + '/split_{}_{}.jsonl'
-BODY_EMBEDDINGS_FILE_PATH = os.path.join(OTHER_DATA_DIR, 'body_embeddings', 'split_{}_{}.jsonl')
-CLEANED_TEXT_FOLDER_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, 'cleaned_text')
\ No newline at end of file
+EMBEDDING_SPLIT_NAME = 'split_{}_{}'
+CLEANED_TEXT_FOLDER_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, 'cleaned_text')
+PAPER_TEXT_STORE_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, PAPER_TEXT_STORE_DIR)
+ONNX_QUERY_ENCODER_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, ONNX_QUERY_ENCODER_DIR)
+LEXICAL_INDEX_PATH = os.path.join(RUNTIME_DATA_DIR_PATH, LEXICAL_INDEX_DIR)
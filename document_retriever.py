@@ -1,70 +1,277 @@
-from typing import Any, List, Union, Tuple
-import json
+from typing import Any, Dict, List, Optional, Union, Tuple
+import collections
+import threading
+import time
+import warnings
 import attr
 import numpy as np
-from sentence_transformers import SentenceTransformer
 # import scann
 import constants
 import os
-from annoy import AnnoyIndex
+from embedding_store import PaperEmbeddingLookup, get_paper_text_hash
+from lexical_index import DEFAULT_RRF_K, BM25Index, reciprocal_rank_fusion
+from metrics import METRICS
+from paper_index_map import PaperIndexMap
+from paper_text_store import PaperTextStore
+from query_embedding_cache import QueryEmbeddingCache, is_lower_casing_encoder
+from vector_index import ANNOY_BACKEND, EXACT_BACKEND, QUANTIZED_BACKEND, VectorIndex, load_vector_index
 
 EMBEDDING_VECTOR_DIM = 768
+QUERY_ENCODE_BATCH_SIZE = 256
+# Bound on the body line embeddings kept for the papers encoded on the fly, about 150MB of 768d float32 embeddings.
+MAX_ENCODED_PASSAGE_ROWS = 50_000
+
+DEFAULT_VECTOR_DB_FILE_PATHS = {
+    ANNOY_BACKEND: os.path.join(constants.TRAINED_ANNOY_DB_PATH, constants.ANNOY_FILE_NAME),
+    EXACT_BACKEND: os.path.join(constants.TRAINED_VECTOR_DB_PATH, constants.EXACT_DATASET_FILE_NAME),
+    QUANTIZED_BACKEND: constants.TRAINED_QUANTIZED_DB_PATH,
+}
+
 
 @attr.s
 class RetrievalArgs:
-    trained_vector_db_file_path: str = attr.ib(default=os.path.join(constants.TRAINED_ANNOY_DB_PATH, constants.ANNOY_FILE_NAME))
+    # Defaults to the trained file of the chosen vector_db_backend.
+    trained_vector_db_file_path: str = attr.ib(default=None)
     vector_db_index_to_papers_map_file_path: str = attr.ib(default=constants.EMBEDDING_INDEX_TO_PAPER_FILE_PATH)
+    # Array backed version of the map above, converted from it on first use.
+    vector_db_index_to_papers_arrays_path: str = attr.ib(default=constants.EMBEDDING_INDEX_TO_PAPER_ARRAYS_PATH)
     paper_text_files_path: str = attr.ib(default=constants.CLEANED_TEXT_FOLDER_PATH)
+    paper_text_store_path: str = attr.ib(default=constants.PAPER_TEXT_STORE_PATH)
     top_k: int = attr.ib(default=5)
+    vector_db_backend: str = attr.ib(default=ANNOY_BACKEND)
+    query_embedding_model_name: str = attr.ib(default=constants.EMBEDDING_MODEL_NAME)
+    # Max number of query embeddings kept in memory, 0 disables the cache.
+    query_embedding_cache_size: int = attr.ib(default=10000)
+    # Directory of the memory mapped on disk query embedding cache, None to only cache in memory.
+    query_embedding_cache_dir: str = attr.ib(default=None)
+    # Binary embedding splits holding the body line embeddings used by the passage retrieval stage.
+    embeddings_folder_path: str = attr.ib(default=constants.EMBEDDINGS_FOLDER_PATH)
+    num_passages: int = attr.ib(default=8)
+    # Number of neighboring lines added on each side of a retrieved body line.
+    passage_window: int = attr.ib(default=1)
+    # Loads the query embedding model on a background thread right away instead of on the first query.
+    warm_up_query_embedding_model: bool = attr.ib(default=False)
+    # BM25 index searched alongside the vector DB when it exists, None to only use the dense search.
+    lexical_index_path: str = attr.ib(default=constants.LEXICAL_INDEX_PATH)
+    # Number of candidates of both the dense and the lexical ranking fused by reciprocal rank into the top_k papers.
+    fusion_depth: int = attr.ib(default=50)
+    rrf_k: int = attr.ib(default=DEFAULT_RRF_K)
+
+    def __attrs_post_init__(self):
+        if self.trained_vector_db_file_path is None:
+            self.trained_vector_db_file_path = DEFAULT_VECTOR_DB_FILE_PATHS[self.vector_db_backend]
+
+
+@attr.s
+class RetrievalResult:
+    indexes: List[int] = attr.ib()
+    scores: List[float] = attr.ib()
+    papers: List[Tuple[str, str]] = attr.ib()
+
+
+@attr.s
+class Passage:
+    paper_file_name: Tuple[str, str] = attr.ib()
+    # 'abstract' or 'main_body', the lines are [start_line, end_line) of the main body.
+    section: str = attr.ib()
+    score: float = attr.ib()
+    text: str = attr.ib()
+    start_line: int = attr.ib(default=0)
+    end_line: int = attr.ib(default=0)
+
+
+def _as_text(paper_text: Union[str, List[str]]) -> str:
+    if isinstance(paper_text, list):
+        return ' '.join(paper_text)
+    return paper_text or ''
+
+
+def load_query_embedding_model(model_name: str = constants.EMBEDDING_MODEL_NAME) -> "SentenceTransformer":
+    # sentence_transformers pulls in torch, which takes seconds to import, so it is only imported with the model.
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
 
 
 class DocumentRetriever:
-    def __init__(self, retrieval_args: RetrievalArgs = None, query_embedding_model: "SentenceTransformer" = None):
-        ## TODO: We would have to ensure that we have a wrapper over vector DB to have the same API exposed irrespective
-        # of the underlying DB so the find_similar_paper doesn't need to know the underlying model and crresponding API
-        # to search for nearest neighbors.
-        # This will allow us to pass a trained and instantiated vector_db directly as an argument without having to
-        # load it from the path.
+    def __init__(self, retrieval_args: RetrievalArgs = None, query_embedding_model: "SentenceTransformer" = None,
+                 vector_db: VectorIndex = None):
+        # The vector DB is accessed only through the VectorIndex API so a trained and instantiated vector_db of any
+        # backend can be passed directly instead of loading it from the path.
         if retrieval_args is None:
             retrieval_args = RetrievalArgs()
+        # Seconds spent in every loading step, including the lazy load of the query embedding model once it happened.
+        self.startup_timings: Dict[str, float] = {}
 
-        self.vector_db = self.load_pre_trained_vector_db(retrieval_args.trained_vector_db_file_path)
+        start_time = time.perf_counter()
+        if vector_db is None:
+            vector_db = self.load_pre_trained_vector_db(
+                retrieval_args.trained_vector_db_file_path, retrieval_args.vector_db_backend
+            )
+        self.vector_db = vector_db
+        self.startup_timings['vector_db'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
         self.paper_text_files_path = retrieval_args.paper_text_files_path
+        self.paper_text_store = PaperTextStore.load_or_build(
+            retrieval_args.paper_text_store_path, retrieval_args.paper_text_files_path
+        )
+        self.startup_timings['paper_text_store'] = time.perf_counter() - start_time
         self.top_k = retrieval_args.top_k
+        self.embeddings_folder_path = retrieval_args.embeddings_folder_path
+        self.num_passages = retrieval_args.num_passages
+        self.passage_window = retrieval_args.passage_window
+        self.paper_embedding_lookup = None
+        # ((paper name, file name), paper text hash) -> (abstract embedding, body line embeddings) of the papers without
+        # up to date stored embeddings, least recently used first.
+        self.encoded_passage_embeddings = collections.OrderedDict()
+        self.num_encoded_passage_rows = 0
+        self._encoded_passage_lock = threading.Lock()
+
+        # The model is loaded on first use, see the model property and warm_up.
+        self.query_embedding_model_name = retrieval_args.query_embedding_model_name
+        self._model = query_embedding_model
+        self._model_lock = threading.Lock()
+        self._query_embedding_dim = None
+        self.query_embedding_cache_size = retrieval_args.query_embedding_cache_size
+        self.query_embedding_cache_dir = retrieval_args.query_embedding_cache_dir
+        self.query_embedding_cache = None
+        self._set_query_embedding_cache(query_embedding_model)
+
+        start_time = time.perf_counter()
+        self.load_idx_to_paper_maps(retrieval_args.vector_db_index_to_papers_map_file_path,
+                                    retrieval_args.vector_db_index_to_papers_arrays_path)
+        self.startup_timings['idx_to_paper_map'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        self.lexical_index = None
+        if BM25Index.exists(retrieval_args.lexical_index_path):
+            self.lexical_index = BM25Index(retrieval_args.lexical_index_path)
+            if not self.lexical_index.matches(self.vector_index_to_paper_map):
+                warnings.warn(f"The lexical index {retrieval_args.lexical_index_path} was built for another paper index "
+                              f"map, only the dense search is used until it is rebuilt with lexical_index.py")
+                self.lexical_index = None
+        self.fusion_depth = retrieval_args.fusion_depth
+        self.rrf_k = retrieval_args.rrf_k
+        self.startup_timings['lexical_index'] = time.perf_counter() - start_time
+
+        if retrieval_args.warm_up_query_embedding_model:
+            self.warm_up()
+
+    @property
+    def model(self) -> "SentenceTransformer":
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    start_time = time.perf_counter()
+                    self._model = load_query_embedding_model(self.query_embedding_model_name)
+                    self.startup_timings['query_embedding_model'] = time.perf_counter() - start_time
+        return self._model
 
-        if query_embedding_model is None:
-            query_embedding_model = SentenceTransformer('all-mpnet-base-v2')
-        self.model = query_embedding_model
+    @model.setter
+    def model(self, query_embedding_model: "SentenceTransformer"):
+        self._model = query_embedding_model
+        self._query_embedding_dim = None
+        self._set_query_embedding_cache(query_embedding_model)
+        with self._encoded_passage_lock:
+            self.encoded_passage_embeddings.clear()
+            self.num_encoded_passage_rows = 0
 
-        self.load_idx_to_paper_maps(retrieval_args.vector_db_index_to_papers_map_file_path)
+    def _set_query_embedding_cache(self, query_embedding_model: Optional["SentenceTransformer"]):
+        '''The cached embeddings are keyed by the name of the model actually encoding the queries, the one of
+        query_embedding_model_name while no model was passed in. A model passed in without a model_name attribute can
+        not be told apart from any other, so its embeddings are not cached at all rather than mixed with the ones of
+        another model in the persistent cache.
+        '''
+        model_name = self.query_embedding_model_name if query_embedding_model is None \
+            else getattr(query_embedding_model, 'model_name', None)
+        self.query_embedding_cache = None
+        if self.query_embedding_cache_size > 0 and model_name is not None:
+            self.query_embedding_cache = QueryEmbeddingCache(
+                model_name, self.query_embedding_cache_size, self.query_embedding_cache_dir,
+                lowercase=is_lower_casing_encoder(query_embedding_model, model_name)
+            )
+
+    def warm_up(self, background: bool = True) -> Optional[threading.Thread]:
+        '''Loads the query embedding model and runs one encode so the first question does not pay for it. In the
+        background a query arriving before the warm up is done simply waits for the model to be loaded.
+        '''
+        def _warm_up():
+            self.model.encode('warm up', normalize_embeddings=True)
+
+        if not background:
+            _warm_up()
+            return None
+        thread = threading.Thread(target=_warm_up, name='query-embedding-model-warm-up', daemon=True)
+        thread.start()
+        return thread
 
     @staticmethod
-    def load_pre_trained_vector_db(path: str):
-        ''' It currently assumes the SCANN Model from Google and relies on it's load API. However, this can be generalized once there are wrapper around these different model classes.
+    def load_pre_trained_vector_db(path: str, backend: str = ANNOY_BACKEND) -> VectorIndex:
+        ''' Loads the trained vector DB of the given backend, 'annoy' for the Annoy index, 'exact' for brute force
+        NumPy search over the memory mapped dataset.npy or 'quantized' for the int8 (and optionally IVF) index.
         '''
-        # trained_vector_index = scann.scann_ops_pybind.load_searcher(path)
-        trained_vector_index = AnnoyIndex(EMBEDDING_VECTOR_DIM, 'angular')
-        trained_vector_index.load(path)
-        return trained_vector_index
+        return load_vector_index(backend, path, EMBEDDING_VECTOR_DIM)
 
-    def load_idx_to_paper_maps(self, file_name: str = constants.EMBEDDING_INDEX_TO_PAPER_FILE_PATH):
+    def load_idx_to_paper_maps(self, file_name: str = constants.EMBEDDING_INDEX_TO_PAPER_FILE_PATH,
+                               arrays_path: str = constants.EMBEDDING_INDEX_TO_PAPER_ARRAYS_PATH):
         '''Loads the pre-saved mapping between the index of the emebdding as stored in the SCANN vector DB to the corresponding paper name and the file containing the actual abstract and the body text of the paper.
+        The JSON map in file_name is converted once to the memory mapped arrays in arrays_path, see PaperIndexMap.
+        '''
+        self.vector_index_to_paper_map = PaperIndexMap.load_or_convert(arrays_path, file_name)
+
+    @property
+    def query_embedding_dim(self) -> int:
+        '''The queries are searched in the vector DB so its dimension is the one of the query embeddings, which lets a
+        cached query embedding be looked up without loading the model. The model is only asked when the vector DB has
+        no dimension, e.g. while it is empty.
         '''
-        self.vector_index_to_paper_map = {}
-        with open(file_name, 'r') as f:
-            self.vector_index_to_paper_map = json.loads(f.readlines()[0])
+        if self._query_embedding_dim is None:
+            dim = getattr(self.vector_db, 'dim', None) or self.model.get_sentence_embedding_dimension()
+            self._query_embedding_dim = int(dim)
+        return self._query_embedding_dim
+
+    def _get_cached_query_embedding(self, query: str):
+        if self.query_embedding_cache is None:
+            return None
+        query_embedding = self.query_embedding_cache.get(query, dim=self.query_embedding_dim)
+        METRICS.increment('query_embedding_cache_lookups', result='miss' if query_embedding is None else 'hit')
+        return query_embedding
 
     def parse_query_to_embedding(self, query: str) -> np.array:
-        query_embedding = self.model.encode(query, normalize_embeddings=True)
+        query_embedding = self._get_cached_query_embedding(query)
+        if query_embedding is None:
+            with METRICS.span('query_encode'):
+                query_embedding = self.model.encode(query, normalize_embeddings=True)
+            if self.query_embedding_cache is not None:
+                self.query_embedding_cache.put(query, query_embedding)
         return query_embedding
 
+    def parse_queries_to_embeddings(self, queries: List[str], batch_size: int = QUERY_ENCODE_BATCH_SIZE) -> np.array:
+        '''Only the queries missing from the query embedding cache are encoded.
+        '''
+        cached_embeddings = [self._get_cached_query_embedding(query) for query in queries]
+        missing_queries = [query for query, embedding in zip(queries, cached_embeddings) if embedding is None]
+        if missing_queries:
+            with METRICS.span('query_batch_encode'):
+                missing_embeddings = iter(self.model.encode(missing_queries, batch_size=batch_size,
+                                                            normalize_embeddings=True))
+            for idx, query in enumerate(queries):
+                if cached_embeddings[idx] is None:
+                    cached_embeddings[idx] = next(missing_embeddings)
+                    if self.query_embedding_cache is not None:
+                        self.query_embedding_cache.put(query, cached_embeddings[idx])
+        if not cached_embeddings:
+            return np.zeros((0, self.query_embedding_dim), dtype=np.float32)
+        return np.stack(cached_embeddings)
+
     def find_similar_papers(self, query_embedding: str, top_k: int = None) -> Tuple[Any, Any]:
         '''Finds the top_k similar embeddings and returns a sorted List of tuples of their index to the similarity score in descending order of scores.
         '''
         if top_k is None:
             top_k = self.top_k
 
-        indexes, scores = self.vector_db.get_nns_by_vector(query_embedding, n=top_k, include_distances=True)
+        with METRICS.span('vector_search'):
+            indexes, scores = self.vector_db.search(query_embedding, top_k)
         return indexes, scores
 
     def retrieve_candidate_papers_for_query(self, query: Union[str, np.array], k: int = None) -> List[Tuple[str, str]]:
@@ -72,20 +279,60 @@ class DocumentRetriever:
           Fetches paper
         '''
         if isinstance(query, np.ndarray):
-            query_emebedding = query
+            query_embedding = query
         elif isinstance(query, str):
             query_embedding = self.parse_query_to_embedding(query)
 
-        candidate_indexes, candidate_score = self.find_similar_papers(query_embedding, k)
+        if self.lexical_index is not None and isinstance(query, str):
+            # The text of the query is needed for the lexical search, a precomputed embedding only gets the dense one.
+            k = self.top_k if k is None else k
+            dense_indexes, _ = self.find_similar_papers(query_embedding, max(k, self.fusion_depth))
+            with METRICS.span('lexical_search'):
+                lexical_indexes, _ = self.lexical_index.search(query, max(k, self.fusion_depth))
+            candidate_indexes, candidate_score = reciprocal_rank_fusion([dense_indexes, lexical_indexes], self.rrf_k, k)
+        else:
+            candidate_indexes, candidate_score = self.find_similar_papers(query_embedding, k)
         if len(candidate_indexes) == 0:
             return []
 
-        candidate_papers = []
-        for idx, score in zip(candidate_indexes, candidate_score):
-            paper_file_name = self.vector_index_to_paper_map.get(str(idx), None)
-            if paper_file_name:
-                candidate_papers.append(paper_file_name)
-        return candidate_papers
+        return self._get_candidate_papers(candidate_indexes)
+
+    def _get_candidate_papers(self, candidate_indexes: List[int]) -> List[Tuple[str, str]]:
+        return self.vector_index_to_paper_map.get_many(candidate_indexes)
+
+    def retrieve_candidate_papers_for_queries(self, queries: Union[List[str], np.array], k: int = None,
+                                              batch_size: int = QUERY_ENCODE_BATCH_SIZE) -> List[RetrievalResult]:
+        '''Batch version of retrieve_candidate_papers_for_query for offline jobs over many questions. The queries are
+        either a list of strings, encoded in batches of batch_size, or a 2-d array of precomputed query embeddings. The
+        neighbor search of all the queries is done by a single batch_search on the vector DB. String queries are also
+        searched in the lexical index, when there is one, and the scores are then the reciprocal rank fusion scores.
+        '''
+        if k is None:
+            k = self.top_k
+        if isinstance(queries, np.ndarray):
+            query_embeddings = queries.reshape(-1, queries.shape[-1])
+        else:
+            query_embeddings = self.parse_queries_to_embeddings(list(queries), batch_size)
+        if len(query_embeddings) == 0:
+            return []
+
+        use_lexical_index = self.lexical_index is not None and not isinstance(queries, np.ndarray)
+        with METRICS.span('vector_batch_search'):
+            batch_indexes, batch_scores = self.vector_db.batch_search(
+                query_embeddings, max(k, self.fusion_depth) if use_lexical_index else k
+            )
+        if use_lexical_index:
+            with METRICS.span('lexical_batch_search'):
+                lexical_results = self.lexical_index.batch_search(list(queries), max(k, self.fusion_depth))
+            fused_results = [reciprocal_rank_fusion([dense_indexes, lexical_indexes], self.rrf_k, k)
+                             for dense_indexes, (lexical_indexes, _) in zip(batch_indexes, lexical_results)]
+            batch_indexes, batch_scores = zip(*fused_results)
+        results = []
+        for indexes, scores in zip(batch_indexes, batch_scores):
+            results.append(RetrievalResult(
+                indexes=list(indexes), scores=list(scores), papers=self._get_candidate_papers(indexes)
+            ))
+        return results
 
     # These 2 functions should be Retrieval class and hence Retrieval also has to be attached to the Agent class.
     # The reasons this should be in retrieval so it can be independently access of the agent. As well as this is closely
@@ -93,21 +340,141 @@ class DocumentRetriever:
     # so the retrieval and getting the text has to linked. Also there are scenarios where we wouldn't needs these since
     # the vector database would automatically do this under the hood.
     def get_abstract_from_paper_file_name(self, paper_file_name: Tuple[str, str]):
-        paper_name = paper_file_name[0]
-        file_name = paper_file_name[1]
-        file_path = os.path.join(self.paper_text_files_path,file_name)
-        with open(file_path, 'r') as f:
-            papers = json.loads(f.readlines()[0])
-            paper_text = papers.get(paper_name, {})
-
-        return paper_text.get('abstract', '')
+        with METRICS.span('paper_text_read'):
+            return self.paper_text_store.get_abstract(paper_file_name)
 
     def get_body_from_paper_file_name(self, paper_file_name: Tuple[str, str]):
-        paper_name = paper_file_name[0]
-        file_name = paper_file_name[1]
-        file_path = os.path.join(self.paper_text_files_path,file_name)
-        with open(file_path, 'r') as f:
-            papers = json.loads(f.readlines()[0])
-            paper_text = papers.get(paper_name, {})
-
-        return paper_text.get('main_body', '')
+        with METRICS.span('paper_text_read'):
+            return self.paper_text_store.get_body(paper_file_name)
+
+    def get_papers(self, paper_file_names: List[Tuple[str, str]]) -> List[Dict[str, str]]:
+        '''Bulk version of the two getters above, returns a dict with the abstract and main_body for every paper.
+        '''
+        with METRICS.span('paper_text_read'):
+            return self.paper_text_store.get_papers(paper_file_names)
+
+    def _get_paper_embedding_lookup(self) -> PaperEmbeddingLookup:
+        if self.paper_embedding_lookup is None:
+            self.paper_embedding_lookup = PaperEmbeddingLookup(self.embeddings_folder_path)
+        return self.paper_embedding_lookup
+
+    def _get_passage_embeddings(self, paper_file_name: Tuple[str, str], abstract: str, body_lines: List[str]
+                                ) -> Tuple[np.array, np.array]:
+        '''Returns the stored abstract and body line embeddings of the paper. They are encoded on the fly when the paper
+        has no stored embeddings or its text changed since they were generated, which is told by the paper hash stored
+        with the split (or by the number of body lines for the splits written without paper hashes). The encoded
+        embeddings are kept for the next requests as long as the text of the paper does not change.
+        '''
+        paper_embedding_lookup = self._get_paper_embedding_lookup()
+        paper_hash = get_paper_text_hash(abstract, body_lines)
+        stored_paper_hash = paper_embedding_lookup.get_paper_hash(paper_file_name)
+        abstract_embedding = paper_embedding_lookup.get_abstract_embedding(paper_file_name)
+        body_embeddings = paper_embedding_lookup.get_body_embeddings(paper_file_name)
+        is_stale = (abstract_embedding is None or
+                    (stored_paper_hash != paper_hash if stored_paper_hash is not None
+                     else len(body_embeddings) != len(body_lines)))
+        if is_stale:
+            abstract_embedding, body_embeddings = self._get_encoded_passage_embeddings(
+                paper_file_name, paper_hash, abstract, body_lines
+            )
+        abstract_embedding = np.asarray(abstract_embedding, dtype=np.float32)
+        abstract_embedding = abstract_embedding / max(float(np.linalg.norm(abstract_embedding)), 1e-12)
+        return abstract_embedding, np.asarray(body_embeddings, dtype=np.float32)
+
+    def _get_encoded_passage_embeddings(self, paper_file_name: Tuple[str, str], paper_hash: str, abstract: str,
+                                        body_lines: List[str]) -> Tuple[np.array, np.array]:
+        key = (tuple(paper_file_name), paper_hash)
+        with self._encoded_passage_lock:
+            if key in self.encoded_passage_embeddings:
+                self.encoded_passage_embeddings.move_to_end(key)
+                return self.encoded_passage_embeddings[key]
+
+        abstract_embedding = np.asarray(self.model.encode(abstract, normalize_embeddings=True), dtype=np.float32)
+        body_embeddings = np.asarray(self.model.encode(body_lines, batch_size=QUERY_ENCODE_BATCH_SIZE,
+                                                       normalize_embeddings=True), dtype=np.float32) if body_lines \
+            else np.zeros((0, len(abstract_embedding)), dtype=np.float32)
+        with self._encoded_passage_lock:
+            if key not in self.encoded_passage_embeddings:
+                self.encoded_passage_embeddings[key] = (abstract_embedding, body_embeddings)
+                self.num_encoded_passage_rows += 1 + len(body_embeddings)
+            while self.num_encoded_passage_rows > MAX_ENCODED_PASSAGE_ROWS and len(self.encoded_passage_embeddings) > 1:
+                _, (_, evicted_body_embeddings) = self.encoded_passage_embeddings.popitem(last=False)
+                self.num_encoded_passage_rows -= 1 + len(evicted_body_embeddings)
+        return abstract_embedding, body_embeddings
+
+    def retrieve_passages_for_query(self, query: Union[str, np.array], candidate_papers: List[Tuple[str, str]],
+                                    num_passages: int = None, window: int = None) -> List[Passage]:
+        '''Second retrieval stage over the papers found by the paper level search: the abstract and every body line of
+        the candidate papers are scored against the query, the num_passages best are kept and the body lines are
+        expanded with window neighboring lines on each side, merging the overlapping ones. Passages are returned in
+        descending order of score.
+        '''
+        if num_passages is None:
+            num_passages = self.num_passages
+        if window is None:
+            window = self.passage_window
+        query_embedding = self.parse_query_to_embedding(query) if isinstance(query, str) else query
+        query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+
+        papers = self.get_papers(candidate_papers)
+        with METRICS.span('passage_scoring'):
+            paper_lines = []
+            hits = []  # (score, paper position, line index or -1 for the abstract)
+            for paper_position, (paper_file_name, paper) in enumerate(zip(candidate_papers, papers)):
+                abstract = _as_text(paper['abstract'])
+                body_lines = _as_text(paper['main_body']).splitlines()
+                paper_lines.append((abstract, body_lines))
+                abstract_embedding, body_embeddings = self._get_passage_embeddings(paper_file_name, abstract,
+                                                                                   body_lines)
+                if abstract:
+                    hits.append((float(abstract_embedding @ query_embedding), paper_position, -1))
+                if len(body_lines):
+                    line_scores = body_embeddings @ query_embedding
+                    hits.extend((float(score), paper_position, line_idx) for line_idx, score in enumerate(line_scores)
+                                if body_lines[line_idx].strip())
+        hits.sort(reverse=True)
+        hits = hits[:num_passages]
+
+        passages = []
+        for paper_position in sorted(set(hit[1] for hit in hits)):
+            abstract, body_lines = paper_lines[paper_position]
+            paper_file_name = candidate_papers[paper_position]
+            paper_hits = [hit for hit in hits if hit[1] == paper_position]
+            for score, _, line_idx in paper_hits:
+                if line_idx == -1:
+                    passages.append(Passage(paper_file_name=paper_file_name, section='abstract', score=score,
+                                            text=abstract))
+            line_hits = sorted((line_idx, score) for score, _, line_idx in paper_hits if line_idx != -1)
+            start, end, best = None, None, None
+            for line_idx, score in line_hits:
+                line_start, line_end = max(0, line_idx - window), min(len(body_lines), line_idx + window + 1)
+                if start is not None and line_start <= end:
+                    end, best = max(end, line_end), max(best, score)
+                    continue
+                if start is not None:
+                    passages.append(Passage(paper_file_name=paper_file_name, section='main_body', score=best,
+                                            text='\n'.join(body_lines[start:end]), start_line=start, end_line=end))
+                start, end, best = line_start, line_end, score
+            if start is not None:
+                passages.append(Passage(paper_file_name=paper_file_name, section='main_body', score=best,
+                                        text='\n'.join(body_lines[start:end]), start_line=start, end_line=end))
+
+        passages.sort(key=lambda passage: passage.score, reverse=True)
+        return passages
+
+    @staticmethod
+    def build_passage_context(passages: List[Passage]) -> str:
+        '''Formats the passages grouped by paper, in the order of each paper's best passage, and in reading order
+        within a paper (abstract first, then the body lines).
+        '''
+        paper_order = []
+        for passage in passages:
+            if tuple(passage.paper_file_name) not in paper_order:
+                paper_order.append(tuple(passage.paper_file_name))
+        context = []
+        for paper_name, file_name in paper_order:
+            paper_passages = [passage for passage in passages
+                              if tuple(passage.paper_file_name) == (paper_name, file_name)]
+            paper_passages.sort(key=lambda passage: (passage.section != 'abstract', passage.start_line))
+            context.append(f"PAPER: {paper_name}\n" + '\n[...]\n'.join(passage.text for passage in paper_passages))
+        return '\n[SEP]\n'.join(context)
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+from typing import List, Optional, Tuple, Union
+
+import attr
+import numpy as np
+
+import constants
+
+ABSTRACT_EMBEDDINGS_SUFFIX = '.abstract.npy'
+BODY_EMBEDDINGS_SUFFIX = '.body.npy'
+EMBEDDINGS_META_SUFFIX = '.meta.json'
+SUPPORTED_DTYPES = ('float32', 'float16')
+
+
+@attr.s
+class EmbeddingSplit:
+    '''One split of the binary embedding format.
+
+    The abstract embeddings are a (num_papers, dim) matrix and the body line embeddings of all the papers are stacked in
+    a single (total_num_lines, dim) matrix, where the lines of paper i are the rows body_row_offsets[i]:body_row_offsets[i+1].
+    '''
+    name: str = attr.ib()
+    model_name: str = attr.ib()
+    dim: int = attr.ib()
+    dtype: str = attr.ib()
+    source_file: str = attr.ib()
+    paper_ids: List[str] = attr.ib()
+    body_row_offsets: np.ndarray = attr.ib()
+    abstract_embeddings: np.ndarray = attr.ib()
+    body_embeddings: np.ndarray = attr.ib()
+    content_hash: str = attr.ib(default=None)
+    paper_hashes: Optional[List[str]] = attr.ib(default=None)
+
+    def get_body_embeddings(self, paper_idx: int) -> np.ndarray:
+        return self.body_embeddings[self.body_row_offsets[paper_idx]:self.body_row_offsets[paper_idx + 1]]
+
+
+def get_paper_text_hash(abstract: Union[str, List[str]], body_lines: List[str]) -> str:
+    '''Identifies the text the embeddings of one paper were generated from, to tell whether the stored embeddings
+    still match the text of the paper when it is read back.
+    '''
+    if isinstance(abstract, list):
+        abstract = ' '.join(abstract)
+    return hashlib.sha1(json.dumps([abstract or '', list(body_lines)]).encode('utf-8')).hexdigest()
+
+
+def _save_npy_atomically(file_path: str, array: np.ndarray):
+    with open(file_path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def write_embedding_split(folder_path: str, split_name: str, source_file: str, paper_ids: List[str],
+                          abstract_embeddings: np.ndarray, body_embeddings: List[np.ndarray], model_name: str,
+                          dim: int, dtype: str = 'float32', content_hash: str = None,
+                          paper_hashes: List[str] = None):
+    '''Writes one split as contiguous .npy matrices and a json sidecar with the paper ids, the body row ranges, the
+    embedding dimension and the model name. The sidecar is written last, so a split only exists once it is complete.
+    content_hash identifies the text the split was generated from so reruns can skip unchanged splits, paper_hashes
+    (see get_paper_text_hash) identify the text of every paper so edited papers are detected at retrieval time.
+    '''
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f"Unsupported embedding dtype {dtype}, expected one of {SUPPORTED_DTYPES}")
+    abstract_embeddings = np.asarray(abstract_embeddings, dtype=dtype).reshape(len(paper_ids), -1)
+    if abstract_embeddings.shape[1] != dim:
+        raise ValueError(f"Abstract embeddings of {split_name} have dimension {abstract_embeddings.shape[1]} but "
+                         f"{model_name} produces {dim} dimensional embeddings")
+    if len(body_embeddings) != len(paper_ids):
+        raise ValueError(f"Got body embeddings for {len(body_embeddings)} papers but {len(paper_ids)} paper ids")
+    if paper_hashes is not None and len(paper_hashes) != len(paper_ids):
+        raise ValueError(f"Got {len(paper_hashes)} paper hashes but {len(paper_ids)} paper ids")
+
+    body_row_offsets = [0]
+    for paper_id, body_embedding in zip(paper_ids, body_embeddings):
+        body_embedding = np.asarray(body_embedding)
+        if body_embedding.size and (body_embedding.ndim != 2 or body_embedding.shape[1] != dim):
+            raise ValueError(f"Body embeddings of {paper_id} have shape {body_embedding.shape} but {model_name} "
+                             f"produces {dim} dimensional embeddings")
+        body_row_offsets.append(body_row_offsets[-1] + (len(body_embedding) if body_embedding.size else 0))
+    non_empty_bodies = [np.asarray(body, dtype=dtype) for body in body_embeddings if np.asarray(body).size]
+    if non_empty_bodies:
+        stacked_body_embeddings = np.concatenate(non_empty_bodies, axis=0)
+    else:
+        stacked_body_embeddings = np.zeros((0, dim), dtype=dtype)
+
+    os.makedirs(folder_path, exist_ok=True)
+    split_path = os.path.join(folder_path, split_name)
+    _save_npy_atomically(split_path + ABSTRACT_EMBEDDINGS_SUFFIX, abstract_embeddings)
+    _save_npy_atomically(split_path + BODY_EMBEDDINGS_SUFFIX, stacked_body_embeddings)
+    meta = {
+        'model_name': model_name,
+        'dim': dim,
+        'dtype': dtype,
+        'source_file': source_file,
+        'paper_ids': list(paper_ids),
+        'body_row_offsets': body_row_offsets,
+        'content_hash': content_hash,
+        'paper_hashes': list(paper_hashes) if paper_hashes is not None else None,
+    }
+    with open(split_path + EMBEDDINGS_META_SUFFIX + '.tmp', 'w') as f:
+        f.write(json.dumps(meta))
+    os.replace(split_path + EMBEDDINGS_META_SUFFIX + '.tmp', split_path + EMBEDDINGS_META_SUFFIX)
+
+
+def list_embedding_splits(folder_path: str) -> List[str]:
+    if not os.path.isdir(folder_path):
+        return []
+    return sorted(file_name[:-len(EMBEDDINGS_META_SUFFIX)] for file_name in os.listdir(folder_path)
+                  if file_name.endswith(EMBEDDINGS_META_SUFFIX))
+
+
+def delete_embedding_split(folder_path: str, split_name: str):
+    '''The sidecar is removed first, so a crash half way leaves matrices that are ignored instead of a broken split.
+    '''
+    split_path = os.path.join(folder_path, split_name)
+    for suffix in (EMBEDDINGS_META_SUFFIX, ABSTRACT_EMBEDDINGS_SUFFIX, BODY_EMBEDDINGS_SUFFIX):
+        if os.path.exists(split_path + suffix):
+            os.remove(split_path + suffix)
+
+
+def read_embedding_split(folder_path: str, split_name: str, mmap_mode: str = 'r') -> EmbeddingSplit:
+    split_path = os.path.join(folder_path, split_name)
+    with open(split_path + EMBEDDINGS_META_SUFFIX, 'r') as f:
+        meta = json.loads(f.read())
+    return EmbeddingSplit(
+        name=split_name,
+        model_name=meta['model_name'],
+        dim=meta['dim'],
+        dtype=meta['dtype'],
+        source_file=meta['source_file'],
+        paper_ids=meta['paper_ids'],
+        body_row_offsets=np.asarray(meta['body_row_offsets'], dtype=np.int64),
+        abstract_embeddings=np.load(split_path + ABSTRACT_EMBEDDINGS_SUFFIX, mmap_mode=mmap_mode),
+        body_embeddings=np.load(split_path + BODY_EMBEDDINGS_SUFFIX, mmap_mode=mmap_mode),
+        content_hash=meta.get('content_hash'),
+        paper_hashes=meta.get('paper_hashes'),
+    )
+
+
+def read_all_abstract_embeddings(folder_path: str = constants.EMBEDDINGS_FOLDER_PATH
+                                 ) -> Tuple[List[Tuple[str, str]], np.ndarray]:
+    '''Reads the abstract embeddings of every split into a single float32 matrix along with the (paper name, cleaned
+    text file name) of every row. All the splits must have been generated by the same model.
+    '''
+    paper_file_names = []
+    matrices = []
+    model_name, dim = None, None
+    for split_name in list_embedding_splits(folder_path):
+        split = read_embedding_split(folder_path, split_name)
+        if model_name is None:
+            model_name, dim = split.model_name, split.dim
+        elif (split.model_name, split.dim) != (model_name, dim):
+            raise ValueError(f"Split {split_name} was generated by {split.model_name} ({split.dim}d) but the previous "
+                             f"splits were generated by {model_name} ({dim}d)")
+        paper_file_names.extend((paper_id, split.source_file) for paper_id in split.paper_ids)
+        matrices.append(split.abstract_embeddings)
+
+    if not matrices:
+        return [], np.zeros((0, dim or 0), dtype=np.float32)
+    return paper_file_names, np.concatenate(matrices, axis=0).astype(np.float32, copy=False)
+
+
+class PaperEmbeddingLookup:
+    '''Maps the (paper name, cleaned text file name) of every paper to its row in the memory mapped embedding splits, to
+    fetch the abstract embedding or the body line embeddings of a single paper without loading the splits in memory.
+    The same paper name in two cleaned text files are two different papers.
+    '''
+
+    def __init__(self, folder_path: str = constants.EMBEDDINGS_FOLDER_PATH):
+        self.splits = {}
+        self.paper_locations = {}
+        for split_name in list_embedding_splits(folder_path):
+            split = read_embedding_split(folder_path, split_name)
+            self.splits[split_name] = split
+            for paper_idx, paper_id in enumerate(split.paper_ids):
+                self.paper_locations[(paper_id, split.source_file)] = (split_name, paper_idx)
+
+    def __contains__(self, paper_file_name: Tuple[str, str]) -> bool:
+        return tuple(paper_file_name) in self.paper_locations
+
+    def get_abstract_embedding(self, paper_file_name: Tuple[str, str]) -> Optional[np.ndarray]:
+        if tuple(paper_file_name) not in self.paper_locations:
+            return None
+        split_name, paper_idx = self.paper_locations[tuple(paper_file_name)]
+        return self.splits[split_name].abstract_embeddings[paper_idx]
+
+    def get_body_embeddings(self, paper_file_name: Tuple[str, str]) -> Optional[np.ndarray]:
+        if tuple(paper_file_name) not in self.paper_locations:
+            return None
+        split_name, paper_idx = self.paper_locations[tuple(paper_file_name)]
+        return self.splits[split_name].get_body_embeddings(paper_idx)
+
+    def get_paper_hash(self, paper_file_name: Tuple[str, str]) -> Optional[str]:
+        '''None when the paper has no stored embeddings or its split was written without paper hashes.
+        '''
+        if tuple(paper_file_name) not in self.paper_locations:
+            return None
+        split_name, paper_idx = self.paper_locations[tuple(paper_file_name)]
+        paper_hashes = self.splits[split_name].paper_hashes
+        return paper_hashes[paper_idx] if paper_hashes is not None else None
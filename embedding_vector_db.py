@@ -1,9 +1,18 @@
-from annoy import AnnoyIndex
+import argparse
 import attr
 import os
 import json
+import time
+from typing import Any, Dict, List, Sequence, Tuple
+import numpy as np
 import constants
+from embedding_store import read_all_abstract_embeddings
+from paper_index_map import PaperIndexMap
+from vector_index import AnnoyVectorIndex, ExactVectorIndex, QuantizedVectorIndex, ShardedVectorIndex, get_delta_path, \
+    get_delta_manifest_path
 EMBEDDING_VECTOR_DIM = 768
+# The delta shard is merged into the main index once it holds more than this fraction of the main index's papers.
+DEFAULT_COMPACTION_FRACTION = 0.1
 
 
 @attr.s
@@ -21,6 +30,13 @@ class AnnoyConfig:
     seed = attr.ib(default=44)  # Ideally this should of enum class
     num_neighbors = attr.ib(default=10)
     file_name = attr.ib(default=constants.ANNOY_FILE_NAME)
+    num_build_jobs = attr.ib(default=-1)  # Threads building the trees, -1 uses every core.
+
+@attr.s
+class QuantizedConfig:
+    num_lists = attr.ib(default=1)  # Number of IVF lists, 1 scans the codes of every vector.
+    num_probes = attr.ib(default=8)  # Lists scored per query.
+    rerank_factor = attr.ib(default=10)  # The best k * rerank_factor candidates are re-ranked exactly.
 
 
 # def create_and_train_scann_vector_db(embeddings_array, scann_config: VectorDbConfig):
@@ -40,56 +56,269 @@ class AnnoyConfig:
 #
 #     return searcher
 
+def create_annoy_vector_db(dim, annoy_config: AnnoyConfig):
+    return AnnoyVectorIndex(dim, metric=annoy_config.distance_method, num_trees=annoy_config.num_trees,
+                            seed=annoy_config.seed, num_build_jobs=annoy_config.num_build_jobs)
+
+
 def create_and_train_annoy_vector_db(embeddings_array, annoy_config: AnnoyConfig):
     # TODO: Allow better configurability in instantiation. For now using a bunch of preset values
     vector_length = len(embeddings_array[0])
-    annoy_index = AnnoyIndex(vector_length, metric=annoy_config.distance_method)
-    annoy_index.set_seed(annoy_config.seed)
-    for idx, embedding in enumerate(embeddings_array):
-        annoy_index.add_item(idx, embedding)
-    annoy_index.build(annoy_config.num_trees)
+    annoy_index = create_annoy_vector_db(vector_length, annoy_config)
+    start_time = time.time()
+    annoy_index.build(embeddings_array)
+    print(f"Built {annoy_config.num_trees} trees over {len(embeddings_array)} vectors in "
+          f"{time.time() - start_time:.1f}s")
     return annoy_index
 
 
+def create_and_train_exact_vector_db(embeddings_array):
+    exact_index = ExactVectorIndex()
+    exact_index.build(embeddings_array)
+    return exact_index
+
+
+def create_and_train_quantized_vector_db(embeddings_array, quantized_config: QuantizedConfig, vectors_path=None):
+    '''vectors_path is the saved exact dataset holding embeddings_array, which the index then re-ranks against instead
+    of saving its own copy of the full precision vectors.
+    '''
+    quantized_index = QuantizedVectorIndex(num_lists=quantized_config.num_lists, num_probes=quantized_config.num_probes,
+                                           rerank_factor=quantized_config.rerank_factor, vectors_path=vectors_path)
+    start_time = time.time()
+    quantized_index.build(embeddings_array)
+    print(f"Built the quantized index with {quantized_config.num_lists} lists over {len(embeddings_array)} vectors in "
+          f"{time.time() - start_time:.1f}s ({quantized_index.bytes_per_vector:.1f} bytes per vector in memory)")
+    return quantized_index
+
+
 def save_serialized_index(vector_db, folder_path, file_name=constants.ANNOY_FILE_NAME):
     os.makedirs(folder_path, exist_ok=True)
     vector_db.save(os.path.join(folder_path, file_name))
+    if not isinstance(vector_db, ShardedVectorIndex):
+        # A fully rebuilt index already holds the papers of the previous delta shard.
+        for delta_file_path in (get_delta_manifest_path(os.path.join(folder_path, file_name)),
+                                get_delta_path(os.path.join(folder_path, file_name))):
+            if os.path.exists(delta_file_path):
+                os.remove(delta_file_path)
 
 
-def read_stored_embeddings(file_path):
-    with open(file_path, 'r') as f:
-        paper_embedding_map = json.loads(f.readlines()[0])
+def store_embedding_idx_paper_map(paper_file_names: Sequence[Tuple[str, str]], embedding_index_to_paper_file_path,
+                                  embedding_index_to_paper_arrays_path=constants.EMBEDDING_INDEX_TO_PAPER_ARRAYS_PATH):
+    '''Overwrites the JSON map and the array map DocumentRetriever loads. The JSON map is written first so the array map
+    records it as its source and is not converted again from it.
+    '''
+    embeddings_idx_to_paper_file_map = {
+        idx: (paper_file[0], paper_file[1]) for idx, paper_file in enumerate(paper_file_names)
+    }
+    with open(embedding_index_to_paper_file_path + '.tmp', 'w') as f:
+        f.write(json.dumps(embeddings_idx_to_paper_file_map))
+    os.replace(embedding_index_to_paper_file_path + '.tmp', embedding_index_to_paper_file_path)
+    PaperIndexMap.from_paper_file_names(paper_file_names).save(
+        embedding_index_to_paper_arrays_path, embedding_index_to_paper_file_path
+    )
 
-    return paper_embedding_map
 
+def create_and_store_embedding_idx_paper_map(embeddings_folder_path, embedding_index_to_paper_file_path,
+                                             embedding_index_to_paper_arrays_path=constants.EMBEDDING_INDEX_TO_PAPER_ARRAYS_PATH):
+    paper_file_names, embeddings_array = read_all_abstract_embeddings(embeddings_folder_path)
+    sorted_order = sorted(range(len(paper_file_names)), key=lambda idx: paper_file_names[idx])
+    paper_file_names = [paper_file_names[idx] for idx in sorted_order]
+    embeddings_array = embeddings_array[sorted_order]
 
-def create_and_store_embedding_idx_paper_map(embeddings_folder_path, embedding_index_to_paper_file_path):
-    all_embeddings = []
-    for file_path in os.listdir(embeddings_folder_path):
-        with open(os.path.join(embeddings_folder_path,file_path), 'r') as f:
-            embeddings = json.loads(f.readlines()[0])
+    store_embedding_idx_paper_map(paper_file_names, embedding_index_to_paper_file_path,
+                                  embedding_index_to_paper_arrays_path)
+    return paper_file_names, embeddings_array
 
-        file_name = '_'.join(file_path.split('/')[-1].split('_')[:-1]) + '.jsonl'
-        embeddings_list = list((paper, file_name, embedding) for paper, embedding in embeddings.items())
-        all_embeddings.extend(embeddings_list)
 
-    all_embeddings.sort()
-    embeddings_idx_to_paper_file_map = {
-        idx: (paper_embed[0], paper_embed[1]) for idx, paper_embed in enumerate(all_embeddings)
-    }
-    try:
-        with open(embedding_index_to_paper_file_path, 'x') as f:
-            f.write(json.dumps(embeddings_idx_to_paper_file_map))
-    except:
-        print('file exists skip writing')
-    return all_embeddings
+def _get_embeddings_in_index_order(paper_file_names: Sequence[Tuple[str, str]], all_paper_file_names, all_embeddings):
+    # The same paper name in two split files are two different papers, so the rows are keyed by (paper name, file name).
+    row_by_paper_file = {tuple(paper_file): row for row, paper_file in enumerate(all_paper_file_names)}
+    missing_papers = [paper_file for paper_file in paper_file_names if tuple(paper_file) not in row_by_paper_file]
+    if missing_papers:
+        raise ValueError(f"{len(missing_papers)} indexed papers have no embeddings anymore, e.g. {missing_papers[:3]}, "
+                         f"rebuild the index from scratch")
+    return all_embeddings[[row_by_paper_file[tuple(paper_file)] for paper_file in paper_file_names]]
+
+
+def add_new_papers_to_vector_dbs(embeddings_folder_path, embedding_index_to_paper_file_path,
+                                 annoy_folder_path=constants.TRAINED_ANNOY_DB_PATH,
+                                 annoy_config: AnnoyConfig = None,
+                                 exact_dataset_path=os.path.join(constants.TRAINED_VECTOR_DB_PATH,
+                                                                 constants.EXACT_DATASET_FILE_NAME),
+                                 quantized_db_path=constants.TRAINED_QUANTIZED_DB_PATH,
+                                 embedding_index_to_paper_arrays_path=constants.EMBEDDING_INDEX_TO_PAPER_ARRAYS_PATH,
+                                 compaction_fraction: float = DEFAULT_COMPACTION_FRACTION, force_compaction=False):
+    '''Incremental ingestion: the embedded papers missing from the index map are appended to the delta shard (see
+    ShardedVectorIndex) of the Annoy index, and of the exact dataset and quantized index when they exist, and to the
+    map, without rebuilding the main index. Once a delta holds more than compaction_fraction of its main index's
+    papers, or with force_compaction, the main index is rebuilt over all the papers, keeping their ids. Unless it was
+    compacted, only the delta shard and its manifest are written and the main index files are left untouched. The
+    indexes are saved before the map so a crash in between only leaves papers that are indexed but not yet returned.
+    '''
+    annoy_config = annoy_config or AnnoyConfig()
+    paper_index_map = PaperIndexMap.load_or_convert(embedding_index_to_paper_arrays_path,
+                                                    embedding_index_to_paper_file_path)
+    paper_file_names = [paper_index_map[idx] for idx in range(len(paper_index_map))]
+    indexed_paper_files = set(paper_file_names)
+    all_paper_file_names, all_embeddings = read_all_abstract_embeddings(embeddings_folder_path)
+    new_rows = [row for row, paper_file in enumerate(all_paper_file_names) if paper_file not in indexed_paper_files]
+    new_paper_file_names = paper_file_names + [all_paper_file_names[row] for row in new_rows]
+    print(f"Found {len(new_rows)} new papers")
+
+    vector_dbs = [(os.path.join(annoy_folder_path, annoy_config.file_name),
+                   ShardedVectorIndex(create_annoy_vector_db(all_embeddings.shape[1], annoy_config)))]
+    if exact_dataset_path is not None and os.path.exists(exact_dataset_path):
+        vector_dbs.append((exact_dataset_path, ShardedVectorIndex(ExactVectorIndex())))
+    if quantized_db_path is not None and os.path.exists(quantized_db_path):
+        vector_dbs.append((quantized_db_path, ShardedVectorIndex(QuantizedVectorIndex())))
+    for index_path, vector_db in vector_dbs:
+        vector_db.load(index_path)
+        if len(vector_db) != len(paper_file_names):
+            raise ValueError(f"{index_path} holds {len(vector_db)} vectors but the map {len(paper_file_names)} papers, "
+                             f"rebuild the index from scratch")
+        if new_rows:
+            vector_db.add(all_embeddings[new_rows])
+        should_compact = len(vector_db.delta_index) and (
+            force_compaction or len(vector_db.delta_index) > compaction_fraction * len(vector_db.main_index))
+        if should_compact:
+            start_time = time.time()
+            vector_db.compact(_get_embeddings_in_index_order(new_paper_file_names, all_paper_file_names, all_embeddings))
+            print(f"Compacted {index_path} over {len(vector_db)} vectors in {time.time() - start_time:.1f}s")
+        else:
+            print(f"The delta shard of {index_path} holds {len(vector_db.delta_index)} papers")
+        if new_rows or should_compact:
+            vector_db.save(index_path)
+    if new_rows:
+        store_embedding_idx_paper_map(new_paper_file_names, embedding_index_to_paper_file_path,
+                                      embedding_index_to_paper_arrays_path)
+    return [vector_db for _, vector_db in vector_dbs]
+
+
+def make_benchmark_queries(embeddings_array, num_queries: int = 200, seed: int = 44) -> np.ndarray:
+    '''Randomly picked vectors of the index with some noise added, so the queries are near but not on indexed vectors.
+    '''
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(embeddings_array[np.sort(rng.choice(len(embeddings_array), replace=False,
+                                                             size=min(num_queries, len(embeddings_array))))],
+                         dtype=np.float32)
+    return queries + rng.normal(scale=0.5 * float(queries.std()), size=queries.shape).astype(np.float32)
+
+
+def get_recall_at_k(indexes: Sequence[Sequence[int]], exact_indexes: Sequence[Sequence[int]]) -> float:
+    return float(np.mean([len(set(query_indexes) & set(exact_query_indexes)) / max(len(exact_query_indexes), 1)
+                          for query_indexes, exact_query_indexes in zip(indexes, exact_indexes)]))
+
+
+def report_annoy_trees_vs_recall(embeddings_array, tree_counts: Sequence[int], k: int = 10, num_queries: int = 200,
+                                 num_build_jobs: int = -1, seed: int = 44) -> List[Dict[str, Any]]:
+    '''Builds an Annoy index for every number of trees and reports its build time, search time and recall@k against
+    exact search.
+    '''
+    embeddings_array = np.asarray(embeddings_array, dtype=np.float32)
+    queries = make_benchmark_queries(embeddings_array, num_queries, seed)
+    exact_index = create_and_train_exact_vector_db(embeddings_array)
+    exact_indexes, _ = exact_index.batch_search(queries, k)
+
+    report = []
+    for num_trees in tree_counts:
+        annoy_index = AnnoyVectorIndex(embeddings_array.shape[1], num_trees=num_trees, seed=seed,
+                                       num_build_jobs=num_build_jobs)
+        start_time = time.time()
+        annoy_index.build(embeddings_array)
+        build_time = time.time() - start_time
+        start_time = time.time()
+        annoy_indexes, _ = annoy_index.batch_search(queries, k)
+        search_time = time.time() - start_time
+        recall = get_recall_at_k(annoy_indexes, exact_indexes)
+        report.append({'num_trees': num_trees, 'build_time': build_time, 'queries_per_sec': len(queries) / search_time,
+                       f'recall@{k}': recall})
+        print(f"trees={num_trees:<6} build={build_time:8.2f}s  qps={len(queries) / search_time:10.1f}  "
+              f"recall@{k}={recall:.4f}")
+    return report
+
+
+def report_quantized_vs_exact(embeddings_array, quantized_configs: Sequence[QuantizedConfig], k: int = 10,
+                              num_queries: int = 200, seed: int = 44) -> List[Dict[str, Any]]:
+    '''Reports the bytes per vector held in memory, QPS and recall@k against exact search of the quantized index built
+    with every config, along with the same numbers for the exact float32 search.
+    '''
+    embeddings_array = np.asarray(embeddings_array, dtype=np.float32)
+    queries = make_benchmark_queries(embeddings_array, num_queries, seed)
+    exact_index = create_and_train_exact_vector_db(embeddings_array)
+    start_time = time.time()
+    exact_indexes, _ = exact_index.batch_search(queries, k)
+    exact_qps = len(queries) / (time.time() - start_time)
+    report = [{'index': 'exact', 'bytes_per_vector': embeddings_array.shape[1] * 4, 'queries_per_sec': exact_qps,
+               f'recall@{k}': 1.0}]
+    print(f"exact{'':<33} bytes/vector={embeddings_array.shape[1] * 4:7.1f}  qps={exact_qps:10.1f}  recall@{k}=1.0000")
+
+    for quantized_config in quantized_configs:
+        quantized_index = create_and_train_quantized_vector_db(embeddings_array, quantized_config)
+        start_time = time.time()
+        quantized_indexes, _ = quantized_index.batch_search(queries, k)
+        qps = len(queries) / (time.time() - start_time)
+        recall = get_recall_at_k(quantized_indexes, exact_indexes)
+        name = f"lists={quantized_config.num_lists} probes={quantized_config.num_probes} " \
+               f"rerank={quantized_config.rerank_factor}"
+        report.append({'index': 'quantized', 'num_lists': quantized_config.num_lists,
+                       'num_probes': quantized_config.num_probes, 'rerank_factor': quantized_config.rerank_factor,
+                       'bytes_per_vector': quantized_index.bytes_per_vector, 'queries_per_sec': qps,
+                       f'recall@{k}': recall})
+        print(f"{name:<38} bytes/vector={quantized_index.bytes_per_vector:7.1f}  qps={qps:10.1f}  recall@{k}={recall:.4f}")
+    return report
 
 
 if __name__ == "__main__":
+    """
+    $ python embedding_vector_db.py                      # full rebuild
+    $ python embedding_vector_db.py --mode add           # index the newly embedded papers in the delta shard
+    $ python embedding_vector_db.py --mode compact       # merge the delta shard into the main index
+    $ python embedding_vector_db.py --mode report_trees --tree_counts 10,100,1000
+    $ python embedding_vector_db.py --build_quantized --num_lists 1024       # full rebuild including the quantized index
+    $ python embedding_vector_db.py --mode report_quantized --num_lists 256 --num_probes 8,32
+    """
+    parser = argparse.ArgumentParser(description="Build the vector databases over the abstract embeddings")
+    parser.add_argument("--mode", default='build', choices=['build', 'add', 'compact', 'report_trees', 'report_quantized'])
+    parser.add_argument("--num_trees", type=int, default=AnnoyConfig().num_trees)
+    parser.add_argument("--num_build_jobs", type=int, default=-1, help="Threads building the Annoy trees, -1 for all")
+    parser.add_argument("--compaction_fraction", type=float, default=DEFAULT_COMPACTION_FRACTION)
+    parser.add_argument("--tree_counts", default='10,50,100,500,1000')
+    parser.add_argument("--build_quantized", action="store_true", help="Also build the quantized index")
+    parser.add_argument("--num_lists", type=int, default=QuantizedConfig().num_lists)
+    parser.add_argument("--num_probes", default=str(QuantizedConfig().num_probes),
+                        help="Lists scored per query, comma separated values are compared by report_quantized")
+    parser.add_argument("--rerank_factor", type=int, default=QuantizedConfig().rerank_factor)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+    annoy_config = AnnoyConfig(num_trees=args.num_trees, num_build_jobs=args.num_build_jobs)
+    quantized_configs = [QuantizedConfig(args.num_lists, int(num_probes), args.rerank_factor)
+                         for num_probes in args.num_probes.split(',')]
 
-    paper_embeddings = create_and_store_embedding_idx_paper_map(
-        constants.EMBEDDINGS_FOLDER_PATH, constants.EMBEDDING_INDEX_TO_PAPER_FILE_PATH
-    )
-    embedding_array = [embed[-1] for embed in paper_embeddings]
-    trained_vector_db = create_and_train_annoy_vector_db(embedding_array, AnnoyConfig())
-    save_serialized_index(trained_vector_db, constants.TRAINED_ANNOY_DB_PATH)
+    if args.mode == 'build':
+        paper_file_names, embedding_array = create_and_store_embedding_idx_paper_map(
+            constants.EMBEDDINGS_FOLDER_PATH, constants.EMBEDDING_INDEX_TO_PAPER_FILE_PATH
+        )
+        trained_vector_db = create_and_train_annoy_vector_db(embedding_array, annoy_config)
+        save_serialized_index(trained_vector_db, constants.TRAINED_ANNOY_DB_PATH)
+        exact_vector_db = create_and_train_exact_vector_db(embedding_array)
+        save_serialized_index(exact_vector_db, constants.TRAINED_VECTOR_DB_PATH, constants.EXACT_DATASET_FILE_NAME)
+        if args.build_quantized:
+            # Built from the saved exact dataset, memory mapped, which the quantized index re-ranks against.
+            exact_dataset_path = os.path.join(constants.TRAINED_VECTOR_DB_PATH, constants.EXACT_DATASET_FILE_NAME)
+            quantized_vector_db = create_and_train_quantized_vector_db(
+                np.load(exact_dataset_path, mmap_mode='r'), quantized_configs[0], exact_dataset_path
+            )
+            save_serialized_index(quantized_vector_db, constants.RUNTIME_DATA_DIR_PATH, constants.TRAINED_QUANTIZED_DIR)
+    elif args.mode in ('add', 'compact'):
+        add_new_papers_to_vector_dbs(
+            constants.EMBEDDINGS_FOLDER_PATH, constants.EMBEDDING_INDEX_TO_PAPER_FILE_PATH,
+            constants.TRAINED_ANNOY_DB_PATH, annoy_config, compaction_fraction=args.compaction_fraction,
+            force_compaction=args.mode == 'compact'
+        )
+    elif args.mode == 'report_quantized':
+        _, embedding_array = read_all_abstract_embeddings(constants.EMBEDDINGS_FOLDER_PATH)
+        report_quantized_vs_exact(embedding_array, quantized_configs, args.k)
+    else:
+        _, embedding_array = read_all_abstract_embeddings(constants.EMBEDDINGS_FOLDER_PATH)
+        report_annoy_trees_vs_recall(embedding_array, [int(count) for count in args.tree_counts.split(',')], args.k,
+                                     num_build_jobs=args.num_build_jobs)
@@ -0,0 +1,123 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Tuple
+
+import attr
+
+DEFAULT_FAKE_RESPONSE = "This is a fake answer generated by the local fake OpenAI chat completion server."
+
+
+@attr.s
+class FakeCompletionConfig:
+    response_text: str = attr.ib(default=DEFAULT_FAKE_RESPONSE)
+    # Seconds before the first token (or the whole response when not streaming) is sent.
+    first_token_latency: float = attr.ib(default=0.2)
+    # Seconds between two streamed tokens.
+    inter_token_latency: float = attr.ib(default=0.01)
+
+
+class FakeChatCompletionHandler(BaseHTTPRequestHandler):
+    '''Minimal OpenAI compatible /chat/completions endpoint answering every request with the configured response text,
+    either as a single json body or, when the request has stream=true, as server sent events with one chunk per token.
+    '''
+    config: FakeCompletionConfig = FakeCompletionConfig()
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body: dict):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_event(self, body):
+        data = body if isinstance(body, str) else json.dumps(body)
+        chunk = f"data: {data}\n\n".encode('utf-8')
+        self.wfile.write(f"{len(chunk):x}\r\n".encode('ascii') + chunk + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        self.server.received_requests.append(request)
+        model = request.get('model', '')
+        prompt_tokens = sum(len(message.get('content', '').split()) for message in request.get('messages', []))
+        tokens = [token + ' ' for token in self.config.response_text.split(' ')]
+        tokens[-1] = tokens[-1].rstrip(' ')
+        created = int(time.time())
+
+        time.sleep(self.config.first_token_latency)
+        if not request.get('stream'):
+            self._send_json({
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': self.config.response_text}}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(tokens),
+                          'total_tokens': prompt_tokens + len(tokens)},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': created, 'model': model}
+        self._send_event(dict(chunk, choices=[{'index': 0, 'delta': {'role': 'assistant'}, 'finish_reason': None}]))
+        for idx, token in enumerate(tokens):
+            if idx:
+                time.sleep(self.config.inter_token_latency)
+            self._send_event(dict(chunk, choices=[{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]))
+        self._send_event(dict(chunk, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+        self._send_event('[DONE]')
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def make_fake_openai_server(config: FakeCompletionConfig = None, host: str = '127.0.0.1', port: int = 0
+                            ) -> Tuple[ThreadingHTTPServer, str]:
+    '''Returns the fake server along with the api base to set as openai.api_base. Port 0 picks a free port. The body of
+    every request is appended to server.received_requests.
+    '''
+    handler = type('ConfiguredFakeChatCompletionHandler', (FakeChatCompletionHandler,),
+                   {'config': config or FakeCompletionConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.received_requests = []
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def start_fake_openai_server(config: FakeCompletionConfig = None, host: str = '127.0.0.1', port: int = 0
+                             ) -> Tuple[ThreadingHTTPServer, str]:
+    '''Same as make_fake_openai_server but also starts serving on a daemon thread, call server.shutdown() to stop.
+    '''
+    server, api_base = make_fake_openai_server(config, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, api_base
+
+
+if __name__ == "__main__":
+    """
+    $ python fake_openai_server.py --port 8001 --first_token_latency 0.5
+    $ python pubmed_agent_cli.py --api_key dummy_key --api_base http://127.0.0.1:8001/v1 --stream --question "..."
+    """
+    parser = argparse.ArgumentParser(description="Local fake OpenAI chat completion server to test the agent offline")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--first_token_latency", type=float, default=0.2)
+    parser.add_argument("--inter_token_latency", type=float, default=0.01)
+    parser.add_argument("--response_text", default=DEFAULT_FAKE_RESPONSE)
+    args = parser.parse_args()
+    fake_server, api_base = make_fake_openai_server(
+        FakeCompletionConfig(args.response_text, args.first_token_latency, args.inter_token_latency), args.host, args.port
+    )
+    print(f"Serving fake chat completions at {api_base}")
+    fake_server.serve_forever()
@@ -1,17 +1,31 @@
+import argparse
+import hashlib
 import numpy as np
 import os
-from typing import List
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 import json
-from sentence_transformers import SentenceTransformer
 
 import constants
-import annoy
+from embedding_store import (EmbeddingSplit, delete_embedding_split, get_paper_text_hash, list_embedding_splits,
+                             read_embedding_split, write_embedding_split)
 
 CHUNK_SIZE = 100
-EMPTY_EMBEDDING = np.zeros(384)
+SPLIT_SIZE = 1000
+ENCODE_BATCH_SIZE = 128
+
+PaperSplit = Tuple[str, str, List[Tuple[str, Dict[str, Any]]]]
+# (abstract embedding, body line embeddings) of one paper.
+PaperEmbeddings = Tuple[np.ndarray, np.ndarray]
+
+# Model loaded once per worker process by _init_worker.
+_worker_model = None
 
 
 def split_into_chunks(txt: List[str]) -> List[str]:
+    if isinstance(txt, str):
+        txt = txt.split()
     if len(txt) < CHUNK_SIZE:
         return [' '.join(word for word in txt)]
 
@@ -31,62 +45,234 @@ def get_abstract_embeddings(abstract, model) -> np.array:
     # Encode the sentences and get a tensor of embeddings
     embeddings = model.encode(split_abstract, normalize_embeddings=True)
     # Calculate the mean embedding
-    mean_embedding = np.mean(embeddings, dim=0)
+    mean_embedding = np.mean(embeddings, axis=0)
     return mean_embedding
 
 
 def get_body_embeddings(body_text, model) -> np.array:
     ''' Since most lines in the body text have <100 word tokens it was considered safe to generate embedding for every
-    line and represent the body as a 2-d array of num_lines * embedding_dimension
+    line and represent the body as a 2-d array of num_lines * embedding_dimension. An empty body has zero lines.
     '''
     if body_text == '' or body_text is None:
-        return EMPTY_EMBEDDING
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
     body_txt_lines = body_text.splitlines()
     # Encode the sentences and get a tensor of embeddings
     embeddings = model.encode(body_txt_lines, normalize_embeddings=True)
     return embeddings
 
 
-def generate_embedding_from_text(model):
-    overall_idx = 0
-    abstract_embeddings_collection = {}
-    body_embeddings_collection = {}
-    for idx, file_name in enumerate(os.listdir(constants.CLEANED_TEXT_FOLDER_PATH)):
-        with open(file=os.path.join(constants.CLEANED_TEXT_FOLDER_PATH,file_name), mode='r') as f:
+def get_split_embeddings(papers: List[Tuple[str, Dict[str, Any]]], model, batch_size: int = ENCODE_BATCH_SIZE
+                         ) -> Tuple[np.ndarray, List[np.ndarray]]:
+    '''Batched equivalent of calling get_abstract_embeddings and get_body_embeddings for every paper of a split.
+
+    The abstract chunks and body lines of all the papers are packed together and sorted by length, so every encode batch
+    is full and holds texts of similar length (less padding), and the embeddings are then scattered back to the papers.
+    '''
+    embedding_dim = model.get_sentence_embedding_dimension()
+    texts = []
+    abstract_rows = []
+    body_rows = []
+    for _, paper in papers:
+        chunks = split_into_chunks(paper['abstract'])
+        abstract_rows.append((len(texts), len(texts) + len(chunks)))
+        texts.extend(chunks)
+        body_text = paper['main_body']
+        lines = body_text.splitlines() if body_text else []
+        body_rows.append((len(texts), len(texts) + len(lines)))
+        texts.extend(lines)
+
+    embeddings = np.zeros((len(texts), embedding_dim), dtype=np.float32)
+    if texts:
+        length_order = np.argsort([len(text) for text in texts], kind='stable')
+        embeddings[length_order] = model.encode(
+            [texts[idx] for idx in length_order], batch_size=batch_size, normalize_embeddings=True
+        )
+
+    abstract_embeddings = np.stack([np.mean(embeddings[start:end], axis=0) for start, end in abstract_rows])
+    body_embeddings = [embeddings[start:end] for start, end in body_rows]
+    return abstract_embeddings, body_embeddings
+
+
+def get_split_content_hash(papers: List[Tuple[str, Dict[str, Any]]], model_name: str) -> str:
+    sha = hashlib.sha1(model_name.encode('utf-8'))
+    for name, paper in papers:
+        sha.update(json.dumps([name, paper['abstract'], paper['main_body']]).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def get_paper_hashes(papers: List[Tuple[str, Dict[str, Any]]]) -> List[str]:
+    return [get_paper_text_hash(paper['abstract'], paper['main_body'].splitlines() if paper['main_body'] else [])
+            for _, paper in papers]
+
+
+def iter_paper_splits(cleaned_text_folder_path: str = constants.CLEANED_TEXT_FOLDER_PATH,
+                      split_size: int = SPLIT_SIZE) -> Iterator[PaperSplit]:
+    '''Streams the cleaned text files one at a time and yields (split name, file name, papers) in groups of split_size
+    papers. The last group of every file is yielded as well, even when it is smaller than split_size. The split names
+    hold the full file name without its extension, so the splits of two files never share a name.
+    '''
+    for file_name in sorted(os.listdir(cleaned_text_folder_path)):
+        with open(file=os.path.join(cleaned_text_folder_path, file_name), mode='r') as f:
             content = json.loads(f.readlines()[0])
         print(f"Finished reading text from file : {file_name}")
-        base_file = file_name.split('_')[-1].split('.')[0]
-        print(f"base file index is. : {base_file}")
-        for name, paper in content.items():
-            overall_idx += 1
-            abstract = paper['abstract']
-            body_text = paper['main_body']
-            body_embed = get_body_embeddings(body_text, model)
-            abstract_embed = get_abstract_embeddings(abstract, model)
-            abstract_embeddings_collection[name] = abstract_embed.tolist()
-            body_embeddings_collection[name] = body_embed.tolist()
-            if overall_idx != 0 and overall_idx % 100 == 0:
-                print(F'Finished computing embeddings for : {overall_idx} papers')
-            if overall_idx != 0 and overall_idx % 1000 == 0:
-                split_name = int(overall_idx // 1000)
-
-                print(f'Finish computing embeddings for {base_file, overall_idx} files')
-                abstract_embeddings_file_name = constants.ABSTRACT_EMBEDDINGS_FILE_PATH.format(base_file, split_name)
-                body_embeddings_file_name = constants.BODY_EMBEDDINGS_FILE_PATH.format(base_file, split_name)
-                with open(abstract_embeddings_file_name, 'x') as f_abstract:
-                    f_abstract.write(json.dumps(abstract_embeddings_collection))
-                    print(f"Finished writing abstract file {abstract_embeddings_file_name}")
-
-                with open(body_embeddings_file_name, 'x') as f_body:
-                    f_body.write(json.dumps(body_embeddings_collection))
-                    print(f"Finished writing body file {body_embeddings_file_name}")
-
-                abstract_embeddings_collection = {}
-                body_embeddings_collection = {}
-                print('-*' * 40)
+        base_file = os.path.splitext(file_name)[0]
+        papers = list(content.items())
+        for split_idx, start in enumerate(range(0, len(papers), split_size)):
+            split_name = constants.EMBEDDING_SPLIT_NAME.format(base_file, split_idx + 1)
+            yield split_name, file_name, papers[start:start + split_size]
+
+
+def _init_worker(model_name: str, num_threads: int):
+    global _worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(num_threads)
+    _worker_model = SentenceTransformer(model_name)
+
+
+def _embed_and_write_split(split_name: str, file_name: str, papers: List[Tuple[str, Dict[str, Any]]],
+                           content_hash: str, paper_hashes: List[str], reused_embeddings: Dict[int, PaperEmbeddings],
+                           embeddings_folder_path: str, model_name: str, dtype: str, batch_size: int,
+                           expected_dim: Optional[int] = None) -> int:
+    '''Only the papers missing from reused_embeddings, keyed by their position in papers, are encoded. expected_dim is
+    the dimension recorded in the splits model_name wrote in previous runs, which the loaded model must produce too.
+    Returns the number of encoded papers.
+    '''
+    dim = _worker_model.get_sentence_embedding_dimension()
+    if expected_dim is not None and dim != expected_dim:
+        raise ValueError(f"{model_name} produces {dim} dimensional embeddings but the existing splits of "
+                         f"{embeddings_folder_path} hold {expected_dim} dimensional ones, embed from scratch in a new "
+                         f"folder")
+    papers_to_encode = [paper for paper_idx, paper in enumerate(papers) if paper_idx not in reused_embeddings]
+    encoded_embeddings = iter([])
+    if papers_to_encode:
+        abstract_embeddings, body_embeddings = get_split_embeddings(papers_to_encode, _worker_model, batch_size)
+        encoded_embeddings = zip(abstract_embeddings, body_embeddings)
+    paper_embeddings = [reused_embeddings[paper_idx] if paper_idx in reused_embeddings else next(encoded_embeddings)
+                        for paper_idx in range(len(papers))]
+    write_embedding_split(
+        embeddings_folder_path, split_name, file_name, [name for name, _ in papers],
+        np.stack([np.asarray(abstract_embedding, dtype=np.float32) for abstract_embedding, _ in paper_embeddings]),
+        [body_embedding for _, body_embedding in paper_embeddings], model_name, dim, dtype, content_hash,
+        paper_hashes
+    )
+    return len(papers_to_encode)
+
+
+def _read_completed_splits(embeddings_folder_path: str) -> Dict[str, EmbeddingSplit]:
+    '''The splits are memory mapped before any of them is rewritten, and a rewrite replaces the files, so the rows read
+    from these splits stay the ones of the previous run for the whole run.
+    '''
+    return {split_name: read_embedding_split(embeddings_folder_path, split_name)
+            for split_name in list_embedding_splits(embeddings_folder_path)}
+
+
+def _get_expected_dim(splits: Iterable[EmbeddingSplit], model_name: str) -> Optional[int]:
+    '''The dimension recorded in the sidecars of the splits model_name wrote, None when it wrote none yet.
+    '''
+    dims = set(split.dim for split in splits if split.model_name == model_name)
+    if len(dims) > 1:
+        raise ValueError(f"The splits written by {model_name} hold embeddings of different dimensions {sorted(dims)}")
+    return dims.pop() if dims else None
+
+
+def _get_reusable_papers(splits: Iterable[EmbeddingSplit], model_name: str
+                         ) -> Dict[Tuple[str, str, str], Tuple[EmbeddingSplit, int]]:
+    '''(paper name, file name, paper text hash) -> (split, row) of the papers embedded by model_name in a previous run,
+    wherever their split was, so a paper whose text did not change is never encoded again.
+    '''
+    reusable_papers = {}
+    for split in splits:
+        if split.model_name != model_name or split.paper_hashes is None:
+            continue
+        for paper_idx, (paper_id, paper_hash) in enumerate(zip(split.paper_ids, split.paper_hashes)):
+            reusable_papers[(paper_id, split.source_file, paper_hash)] = (split, paper_idx)
+    return reusable_papers
+
+
+def _get_reused_embeddings(papers: List[Tuple[str, Dict[str, Any]]], file_name: str, paper_hashes: List[str],
+                           reusable_papers: Dict[Tuple[str, str, str], Tuple[EmbeddingSplit, int]]
+                           ) -> Dict[int, PaperEmbeddings]:
+    reused_embeddings = {}
+    for paper_idx, ((paper_name, _), paper_hash) in enumerate(zip(papers, paper_hashes)):
+        location = reusable_papers.get((paper_name, file_name, paper_hash))
+        if location is not None:
+            split, split_paper_idx = location
+            reused_embeddings[paper_idx] = (np.array(split.abstract_embeddings[split_paper_idx]),
+                                            np.array(split.get_body_embeddings(split_paper_idx)))
+    return reused_embeddings
+
+
+def generate_embedding_from_text(model_name: str = constants.EMBEDDING_MODEL_NAME,
+                                 cleaned_text_folder_path: str = constants.CLEANED_TEXT_FOLDER_PATH,
+                                 embeddings_folder_path: str = constants.EMBEDDINGS_FOLDER_PATH,
+                                 num_workers: int = None, dtype: str = 'float32',
+                                 batch_size: int = ENCODE_BATCH_SIZE, split_size: int = SPLIT_SIZE):
+    '''Embeds every split on a pool of worker processes. A split whose sidecar exists with the same content hash was
+    already completed by a previous run and is skipped. In the other splits, the papers of a previous run whose file
+    and text did not change keep their embeddings, wherever their split was (e.g. when a paper inserted early in a
+    file shifts the following ones to the next split), so a rerun after a crash, or after papers were added or edited,
+    only encodes the new or changed papers. Splits of a previous run that the cleaned text no longer produces (e.g.
+    after a file shrank or was removed) are deleted once all the splits are embedded, so no stale paper is indexed.
+    '''
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1) // 4)
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    completed_splits = _read_completed_splits(embeddings_folder_path)
+    reusable_papers = _get_reusable_papers(completed_splits.values(), model_name)
+    expected_dim = _get_expected_dim(completed_splits.values(), model_name)
+
+    start_time = time.time()
+    num_embedded_papers, num_skipped_papers = 0, 0
+    pending = set()
+    current_split_names = set()
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                             initargs=(model_name, num_threads)) as executor:
+        for split_name, file_name, papers in iter_paper_splits(cleaned_text_folder_path, split_size):
+            current_split_names.add(split_name)
+            content_hash = get_split_content_hash(papers, model_name)
+            if split_name in completed_splits and completed_splits[split_name].content_hash == content_hash:
+                num_skipped_papers += len(papers)
+                continue
+            paper_hashes = get_paper_hashes(papers)
+            reused_embeddings = _get_reused_embeddings(papers, file_name, paper_hashes, reusable_papers)
+            num_skipped_papers += len(reused_embeddings)
+            pending.add(executor.submit(
+                _embed_and_write_split, split_name, file_name, papers, content_hash, paper_hashes, reused_embeddings,
+                embeddings_folder_path, model_name, dtype, batch_size, expected_dim
+            ))
+            # Bound the number of splits held in memory while waiting for the workers.
+            while len(pending) >= 2 * num_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                num_embedded_papers += _report_progress(done, num_embedded_papers, start_time)
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            num_embedded_papers += _report_progress(done, num_embedded_papers, start_time)
+
+    stale_split_names = sorted(set(completed_splits) - current_split_names)
+    for split_name in stale_split_names:
+        delete_embedding_split(embeddings_folder_path, split_name)
+    print(f"Embedded {num_embedded_papers} papers, skipped {num_skipped_papers} already embedded papers and deleted "
+          f"{len(stale_split_names)} stale splits in {time.time() - start_time:.1f}s")
+
+
+def _report_progress(done, num_embedded_papers: int, start_time: float) -> int:
+    num_papers = sum(future.result() for future in done)
+    total = num_embedded_papers + num_papers
+    elapsed = time.time() - start_time
+    print(f'Finished computing embeddings for : {total} papers ({total / max(elapsed, 1e-6):.1f} papers/sec)')
+    return num_papers
 
 
 if __name__ == "__main__":
 
-    model = SentenceTransformer('all-mpnet-base-v2')
-    generate_embedding_from_text(model)
+    parser = argparse.ArgumentParser(description="Generate the abstract and body embeddings of the cleaned paper text")
+    parser.add_argument("--model_name", default=constants.EMBEDDING_MODEL_NAME)
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=ENCODE_BATCH_SIZE)
+    parser.add_argument("--dtype", default='float32', choices=['float32', 'float16'])
+    args = parser.parse_args()
+    generate_embedding_from_text(
+        model_name=args.model_name, num_workers=args.num_workers, dtype=args.dtype, batch_size=args.batch_size
+    )
@@ -0,0 +1,338 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import constants
+from paper_index_map import PaperIndexMap
+from paper_text_store import PaperTextStore
+
+TOKEN_PATTERN = re.compile(r"\w+(?:-\w+)*")
+# Only the most frequent function words, their postings would cover nearly every paper without helping the ranking.
+STOPWORDS = frozenset((
+    'a', 'about', 'after', 'all', 'also', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'been', 'being', 'between',
+    'both', 'but', 'by', 'can', 'could', 'did', 'do', 'does', 'during', 'each', 'for', 'from', 'had', 'has', 'have',
+    'how', 'however', 'if', 'in', 'into', 'is', 'it', 'its', 'may', 'more', 'most', 'no', 'not', 'of', 'on', 'or',
+    'other', 'our', 'such', 'than', 'that', 'the', 'their', 'then', 'there', 'these', 'they', 'this', 'those',
+    'through', 'to', 'under', 'was', 'we', 'were', 'what', 'when', 'where', 'which', 'while', 'who', 'why', 'will',
+    'with', 'within', 'would',
+))
+MAX_TERM_FREQUENCY = np.iinfo(np.uint16).max
+MAX_TERM_BYTES = 48
+DEFAULT_RRF_K = 60
+
+# (block vocabulary, term ids into it, doc ids, term frequencies, doc lengths)
+TokenizedBlock = Tuple[List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def _fits_vocabulary(token: str) -> bool:
+    return len(token) <= MAX_TERM_BYTES and (token.isascii() or len(token.encode('utf-8')) <= MAX_TERM_BYTES)
+
+
+def tokenize(text: str) -> List[str]:
+    '''Lower cased word tokens without the stopwords. Hyphenated terms such as il-6 or tnf-alpha are kept whole and also
+    split into their parts, so a query for il6 style ids or for the parts still matches. Tokens longer than
+    MAX_TERM_BYTES, e.g. sequences or IUPAC names, are dropped (only their parts are kept) since the vocabulary is
+    stored with the width of its longest term.
+    '''
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if '-' not in token:
+            if _fits_vocabulary(token):
+                tokens.append(token)
+            continue
+        parts = [part for part in token.split('-') if part not in STOPWORDS]
+        tokens.extend(term for term in [token] + parts + [token.replace('-', '')] if _fits_vocabulary(term))
+    return tokens
+
+
+def _paper_text(paper_text_store: PaperTextStore, paper_file_name: Tuple[str, str], include_body: bool) -> str:
+    texts = [paper_text_store.get_abstract(paper_file_name)]
+    if include_body:
+        texts.append(paper_text_store.get_body(paper_file_name))
+    return ' '.join(' '.join(text) if isinstance(text, list) else (text or '') for text in texts)
+
+
+def _init_worker(paper_text_store_path: str, paper_index_map_path: str):
+    global _worker_paper_text_store, _worker_paper_index_map
+    _worker_paper_text_store = PaperTextStore(paper_text_store_path)
+    _worker_paper_index_map = PaperIndexMap.load(paper_index_map_path)
+
+
+def _tokenize_block(start: int, end: int, include_body: bool) -> TokenizedBlock:
+    '''Term counts of the documents [start, end), with the postings in doc id order.
+    '''
+    vocabulary: Dict[str, int] = {}
+    term_ids, doc_ids, term_frequencies = [], [], []
+    doc_lengths = np.zeros(end - start, dtype=np.int32)
+    for doc_id in range(start, end):
+        tokens = tokenize(_paper_text(_worker_paper_text_store, _worker_paper_index_map[doc_id], include_body))
+        doc_lengths[doc_id - start] = len(tokens)
+        counts: Dict[int, int] = {}
+        for token in tokens:
+            term_id = vocabulary.setdefault(token, len(vocabulary))
+            counts[term_id] = counts.get(term_id, 0) + 1
+        term_ids.extend(counts)
+        term_frequencies.extend(counts.values())
+        doc_ids.extend([doc_id] * len(counts))
+    return (list(vocabulary), np.asarray(term_ids, dtype=np.int32), np.asarray(doc_ids, dtype=np.int32),
+            np.minimum(term_frequencies, MAX_TERM_FREQUENCY).astype(np.uint16), doc_lengths)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = DEFAULT_RRF_K,
+                           top_k: int = None) -> Tuple[List[int], List[float]]:
+    '''Fuses rankings of ids, best first, by summing 1 / (k + rank) over the rankings an id appears in. Only the ranks
+    are used, so the BM25 and cosine scores never have to be calibrated against each other. Negative ids (padding) are
+    ignored.
+    '''
+    fused_scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking):
+            if idx >= 0:
+                fused_scores[int(idx)] = fused_scores.get(int(idx), 0.0) + 1.0 / (k + rank + 1)
+    fused = sorted(fused_scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+    return [idx for idx, _ in fused], [score for _, score in fused]
+
+
+class BM25Index:
+    '''Okapi BM25 inverted index over the cleaned paper text, where the document id of a paper is its id in the vector
+    DB so the lexical and dense results can be fused directly.
+
+    The vocabulary is a sorted bytes array at most MAX_TERM_BYTES wide searched with np.searchsorted, the postings of t are
+    the rows postings_offsets[t]:postings_offsets[t + 1] of the doc id and term frequency arrays. Every array is a .npy
+    file memory mapped on load, so opening the index is instant whatever the corpus size and a query only reads the
+    postings of its own terms.
+    '''
+    VOCABULARY_FILE_NAME = 'vocabulary.npy'
+    POSTINGS_OFFSETS_FILE_NAME = 'postings_offsets.npy'
+    POSTINGS_DOC_IDS_FILE_NAME = 'postings_doc_ids.npy'
+    POSTINGS_TERM_FREQUENCIES_FILE_NAME = 'postings_term_frequencies.npy'
+    DOC_LENGTHS_FILE_NAME = 'doc_lengths.npy'
+    META_FILE_NAME = 'meta.json'
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        with open(os.path.join(path, self.META_FILE_NAME), 'r') as f:
+            meta = json.loads(f.read())
+        self.path = path
+        self.include_body = meta['include_body']
+        self.num_docs = meta['num_docs']
+        self.paper_index_map_fingerprint = meta.get('paper_index_map_fingerprint')
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = np.load(os.path.join(path, self.VOCABULARY_FILE_NAME), mmap_mode='r')
+        self.postings_offsets = np.load(os.path.join(path, self.POSTINGS_OFFSETS_FILE_NAME), mmap_mode='r')
+        self.postings_doc_ids = np.load(os.path.join(path, self.POSTINGS_DOC_IDS_FILE_NAME), mmap_mode='r')
+        self.postings_term_frequencies = np.load(os.path.join(path, self.POSTINGS_TERM_FREQUENCIES_FILE_NAME),
+                                                 mmap_mode='r')
+        doc_lengths = np.load(os.path.join(path, self.DOC_LENGTHS_FILE_NAME), mmap_mode='r')
+        average_doc_length = max(meta['average_doc_length'], 1e-9)
+        # The length normalization k1 * (1 - b + b * |d| / avgdl) of every document, computed once per load.
+        self.doc_length_norms = (k1 * (1 - b + b * np.asarray(doc_lengths, dtype=np.float32) / average_doc_length))
+
+    @staticmethod
+    def exists(path: Optional[str]) -> bool:
+        return path is not None and os.path.exists(os.path.join(path, BM25Index.META_FILE_NAME))
+
+    @classmethod
+    def build(cls, path: str = constants.LEXICAL_INDEX_PATH,
+              paper_text_store_path: str = constants.PAPER_TEXT_STORE_PATH,
+              paper_text_files_path: str = constants.CLEANED_TEXT_FOLDER_PATH,
+              paper_index_map_path: str = constants.EMBEDDING_INDEX_TO_PAPER_ARRAYS_PATH,
+              json_map_file_path: str = constants.EMBEDDING_INDEX_TO_PAPER_FILE_PATH, include_body: bool = False,
+              num_workers: int = None, block_size: int = 10000) -> "BM25Index":
+        '''Indexes the abstract (and with include_body the main body) of every paper of the vector DB.
+
+        Blocks of documents are tokenized on a pool of worker processes and spilled to disk as they complete. Once the
+        vocabulary is known, it is sorted and every block is scattered into its place in the memory mapped postings, so
+        the memory used stays proportional to one block and the vocabulary rather than to the corpus.
+        '''
+        PaperTextStore.load_or_build(paper_text_store_path, paper_text_files_path).close()
+        paper_index_map = PaperIndexMap.load_or_convert(paper_index_map_path, json_map_file_path)
+        num_docs = len(paper_index_map)
+        if num_workers is None:
+            num_workers = max(1, os.cpu_count() or 1)
+
+        start_time = time.time()
+        build_path = path.rstrip(os.sep) + '.tmp'
+        shutil.rmtree(build_path, ignore_errors=True)
+        os.makedirs(build_path)
+        vocabulary: Dict[str, int] = {}
+        document_frequencies = np.zeros(0, dtype=np.int64)
+        doc_lengths = np.zeros(num_docs, dtype=np.int32)
+        block_starts = list(range(0, num_docs, block_size))
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                 initargs=(paper_text_store_path, paper_index_map_path)) as executor:
+            blocks = executor.map(_tokenize_block, block_starts,
+                                  [min(start + block_size, num_docs) for start in block_starts],
+                                  [include_body] * len(block_starts))
+            for block_idx, (block_vocabulary, term_ids, doc_ids, term_frequencies, block_doc_lengths) in \
+                    enumerate(blocks):
+                block_term_ids = np.asarray([vocabulary.setdefault(term, len(vocabulary))
+                                             for term in block_vocabulary], dtype=np.int32)
+                term_ids = block_term_ids[term_ids]
+                if len(vocabulary) > len(document_frequencies):
+                    document_frequencies = np.concatenate(
+                        [document_frequencies, np.zeros(len(vocabulary) - len(document_frequencies), np.int64)])
+                document_frequencies += np.bincount(term_ids, minlength=len(vocabulary))
+                start = block_starts[block_idx]
+                doc_lengths[start:start + len(block_doc_lengths)] = block_doc_lengths
+                np.savez(os.path.join(build_path, f'block_{block_idx}.npz'), term_ids=term_ids, doc_ids=doc_ids,
+                         term_frequencies=term_frequencies)
+                print(f"Tokenized {start + len(block_doc_lengths)}/{num_docs} papers, {len(vocabulary)} terms "
+                      f"({time.time() - start_time:.1f}s)")
+
+        # Term ids are reassigned in the sorted order of the terms so the vocabulary can be binary searched.
+        terms = [term.encode('utf-8') for term in vocabulary]
+        sorted_terms = np.array(terms, dtype=f"S{max([len(term) for term in terms] + [1])}")
+        term_order = np.argsort(sorted_terms, kind='stable')
+        sorted_terms = sorted_terms[term_order]
+        sorted_term_ids = np.empty(len(term_order), dtype=np.int64)
+        sorted_term_ids[term_order] = np.arange(len(term_order))
+        postings_offsets = np.concatenate([[0], np.cumsum(document_frequencies[term_order])]).astype(np.int64)
+
+        postings_doc_ids = np.lib.format.open_memmap(
+            os.path.join(build_path, cls.POSTINGS_DOC_IDS_FILE_NAME), mode='w+', dtype=np.int32,
+            shape=(int(postings_offsets[-1]),))
+        postings_term_frequencies = np.lib.format.open_memmap(
+            os.path.join(build_path, cls.POSTINGS_TERM_FREQUENCIES_FILE_NAME), mode='w+', dtype=np.uint16,
+            shape=(int(postings_offsets[-1]),))
+        # Next free position in the postings of every term, the blocks are in doc id order so the postings are too.
+        write_positions = postings_offsets[:-1].copy()
+        for block_idx in range(len(block_starts)):
+            block_file_path = os.path.join(build_path, f'block_{block_idx}.npz')
+            with np.load(block_file_path) as block:
+                term_ids = sorted_term_ids[block['term_ids']]
+                order = np.argsort(term_ids, kind='stable')
+                term_ids = term_ids[order]
+                block_terms, group_starts, group_counts = np.unique(term_ids, return_index=True, return_counts=True)
+                positions = write_positions[term_ids] + np.arange(len(term_ids)) - np.repeat(group_starts, group_counts)
+                postings_doc_ids[positions] = block['doc_ids'][order]
+                postings_term_frequencies[positions] = block['term_frequencies'][order]
+                write_positions[block_terms] += group_counts
+            os.remove(block_file_path)
+        postings_doc_ids.flush()
+        postings_term_frequencies.flush()
+        del postings_doc_ids, postings_term_frequencies
+
+        np.save(os.path.join(build_path, cls.VOCABULARY_FILE_NAME), sorted_terms)
+        np.save(os.path.join(build_path, cls.POSTINGS_OFFSETS_FILE_NAME), postings_offsets)
+        np.save(os.path.join(build_path, cls.DOC_LENGTHS_FILE_NAME), doc_lengths)
+        with open(os.path.join(build_path, cls.META_FILE_NAME), 'w') as f:
+            f.write(json.dumps({
+                'num_docs': num_docs,
+                'num_terms': len(sorted_terms),
+                'num_postings': int(postings_offsets[-1]),
+                'average_doc_length': float(doc_lengths.mean()) if num_docs else 0.0,
+                'include_body': include_body,
+                'paper_index_map_fingerprint': paper_index_map.get_fingerprint(),
+            }))
+        # The index is built aside and swapped in at the end so a crashed build never leaves a half written index.
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(build_path, path)
+        print(f"Built the BM25 index of {num_docs} papers, {len(sorted_terms)} terms and {int(postings_offsets[-1])} "
+              f"postings in {time.time() - start_time:.1f}s")
+        return cls(path)
+
+    def __len__(self) -> int:
+        return self.num_docs
+
+    def matches(self, paper_index_map: PaperIndexMap) -> bool:
+        '''Whether the doc ids of this index are still the ids of the same papers in the paper index map. Papers
+        appended to the map since the build are fine, they are only found by the dense search.
+        '''
+        return len(paper_index_map) >= self.num_docs and \
+            paper_index_map.get_fingerprint(self.num_docs) == self.paper_index_map_fingerprint
+
+    def _get_term_ids(self, terms: Sequence[str]) -> np.ndarray:
+        width = self.vocabulary.dtype.itemsize
+        # Terms longer than the widest term of the vocabulary would be truncated by the cast and can not be in it.
+        encoded_terms = [term.encode('utf-8') for term in terms]
+        encoded_terms = np.array([term for term in encoded_terms if len(term) <= width], dtype=self.vocabulary.dtype)
+        if not len(encoded_terms) or not len(self.vocabulary):
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.vocabulary, encoded_terms), len(self.vocabulary) - 1)
+        return positions[self.vocabulary[positions] == encoded_terms]
+
+    def search(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        '''Returns the ids and BM25 scores of the k best matching documents, best first. Documents sharing no term with
+        the query are never returned, so there can be fewer than k results.
+        '''
+        term_ids = self._get_term_ids(sorted(set(tokenize(query))))
+        doc_ids, doc_scores = [], []
+        for term_id in term_ids:
+            start, end = self.postings_offsets[term_id], self.postings_offsets[term_id + 1]
+            term_doc_ids = np.asarray(self.postings_doc_ids[start:end])
+            term_frequencies = np.asarray(self.postings_term_frequencies[start:end], dtype=np.float32)
+            document_frequency = end - start
+            idf = np.log(1 + (self.num_docs - document_frequency + 0.5) / (document_frequency + 0.5))
+            doc_ids.append(term_doc_ids)
+            doc_scores.append(idf * term_frequencies * (self.k1 + 1) /
+                              (term_frequencies + self.doc_length_norms[term_doc_ids]))
+        if not doc_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        doc_ids, doc_scores = np.concatenate(doc_ids), np.concatenate(doc_scores)
+        if len(doc_ids) > self.num_docs // 8:
+            # Dense accumulation is cheaper than sorting once the postings cover a good part of the corpus.
+            scores = np.bincount(doc_ids, weights=doc_scores, minlength=self.num_docs)
+            candidate_ids = np.arange(self.num_docs)
+        else:
+            candidate_ids, inverse = np.unique(doc_ids, return_inverse=True)
+            scores = np.bincount(inverse, weights=doc_scores)
+        k = min(k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return candidate_ids[top], scores[top].astype(np.float32)
+
+    def batch_search(self, queries: Sequence[str], k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return [self.search(query, k) for query in queries]
+
+
+def iter_top_terms(bm25_index: BM25Index, num_terms: int) -> Iterator[Tuple[str, int]]:
+    document_frequencies = np.diff(bm25_index.postings_offsets)
+    for term_id in np.argsort(-document_frequencies, kind='stable')[:num_terms]:
+        yield bm25_index.vocabulary[term_id].decode('utf-8'), int(document_frequencies[term_id])
+
+
+if __name__ == "__main__":
+    """
+    $ python lexical_index.py --num_workers 8
+    $ python lexical_index.py --mode query --query "CCR7 expression in lymphatic endothelial cells"
+    """
+    parser = argparse.ArgumentParser(description="Build or query the BM25 inverted index of the cleaned paper text")
+    parser.add_argument("--mode", default='build', choices=['build', 'query', 'stats'])
+    parser.add_argument("--index_path", default=constants.LEXICAL_INDEX_PATH)
+    parser.add_argument("--include_body", action="store_true",
+                        help="Also index the main body, the index is then about 10x larger")
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--block_size", type=int, default=10000)
+    parser.add_argument("--query", default=None)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.mode == 'build':
+        BM25Index.build(args.index_path, include_body=args.include_body, num_workers=args.num_workers,
+                        block_size=args.block_size)
+    elif args.mode == 'query':
+        lexical_index = BM25Index(args.index_path)
+        paper_index_map = PaperIndexMap.load(constants.EMBEDDING_INDEX_TO_PAPER_ARRAYS_PATH)
+        search_start_time = time.perf_counter()
+        result_ids, result_scores = lexical_index.search(args.query, args.k)
+        print(f"Searched in {(time.perf_counter() - search_start_time) * 1000:.2f}ms")
+        for result_id, result_score in zip(result_ids, result_scores):
+            print(f"{result_score:8.3f}  {paper_index_map[result_id]}")
+    else:
+        lexical_index = BM25Index(args.index_path)
+        print(f"{len(lexical_index)} papers, {len(lexical_index.vocabulary)} terms, "
+              f"{len(lexical_index.postings_doc_ids)} postings")
+        for top_term, top_document_frequency in iter_top_terms(lexical_index, 20):
+            print(f"{top_term:<30}{top_document_frequency}")
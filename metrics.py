@@ -0,0 +1,222 @@
+import collections
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+METRICS_ENV_VARIABLE = 'PUBMED_AGENT_METRICS'
+METRIC_PREFIX = 'pubmed_agent_'
+STAGE_SECONDS = 'stage_seconds'
+DEFAULT_SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MAX_RECENT_SPANS = 10000
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    '''Times a stage into the stage_seconds histogram and keeps it in the recent spans, along with the stage it is
+    nested in within the same thread or asyncio task.
+    '''
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+        self.parent = None
+        self.start_time = 0.0
+        self._token = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.parent = parent.name if parent is not None else None
+        self._token = _current_span.set(self)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start_time
+        _current_span.reset(self._token)
+        self.metrics.observe(STAGE_SECONDS, duration, stage=self.name)
+        self.metrics.record_span(self.name, self.parent, duration, exc_type is not None)
+        return False
+
+
+class Metrics:
+    '''Counters, histograms and timing spans of the retrieval and chat path. Everything is a no-op until enable() is
+    called, or the PUBMED_AGENT_METRICS environment variable is set, so the instrumented code only pays for a flag
+    check.
+    '''
+
+    def __init__(self, enabled: bool = False, buckets: Sequence[float] = DEFAULT_SECONDS_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        # (name, labels) -> [count per bucket (not cumulative) with a last +Inf bucket, sum, count]
+        self._histograms: Dict[Tuple[str, Labels], list] = {}
+        self._recent_spans: Deque[dict] = collections.deque(maxlen=MAX_RECENT_SPANS)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._recent_spans.clear()
+
+    def span(self, name: str):
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        bucket_idx = len(self.buckets)
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                bucket_idx = idx
+                break
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bucket_idx] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def record_span(self, name: str, parent: Optional[str], duration: float, failed: bool):
+        self._recent_spans.append({'span': name, 'parent': parent, 'end_time': time.time(), 'duration': duration,
+                                   'error': failed})
+
+    @staticmethod
+    def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+        labels = labels + extra
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def export_prometheus(self) -> str:
+        '''Prometheus text exposition format, counters get the _total suffix.
+        '''
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self._histograms.items()}
+        lines = []
+        for name in sorted(set(name for name, _ in counters)):
+            lines.append(f"# TYPE {METRIC_PREFIX}{name}_total counter")
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f"{METRIC_PREFIX}{name}_total{self._format_labels(labels)} {value}")
+        for name in sorted(set(name for name, _ in histograms)):
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+            for (histogram_name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative_count = 0
+                for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(f"{METRIC_PREFIX}{name}_bucket{self._format_labels(labels, (('le', str(bound)),))} "
+                                 f"{cumulative_count}")
+                lines.append(f"{METRIC_PREFIX}{name}_sum{self._format_labels(labels)} {total}")
+                lines.append(f"{METRIC_PREFIX}{name}_count{self._format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def export_json_lines(self, include_spans: bool = True) -> str:
+        '''One json object per counter, histogram and (optionally) recent span.
+        '''
+        with self._lock:
+            records = [{'type': 'counter', 'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(self._counters.items())]
+            records += [{'type': 'histogram', 'name': name, 'labels': dict(labels), 'buckets': list(self.buckets),
+                         'bucket_counts': list(bucket_counts), 'sum': total, 'count': count}
+                        for (name, labels), (bucket_counts, total, count) in sorted(self._histograms.items())]
+            if include_spans:
+                records += [dict(span, type='span') for span in self._recent_spans]
+        return ''.join(json.dumps(record) + '\n' for record in records)
+
+    def write_json_lines(self, file_path: str, include_spans: bool = True):
+        with open(file_path, 'a') as f:
+            f.write(self.export_json_lines(include_spans))
+
+
+METRICS = Metrics(enabled=bool(os.getenv(METRICS_ENV_VARIABLE, '')))
+
+
+class SamplingProfiler:
+    '''Opt-in statistical profiler: a daemon thread samples the stack of every other thread each interval seconds and
+    counts the stacks, which are written in the folded format of flamegraph.pl / speedscope. Nothing runs unless
+    start() is called.
+    '''
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stack_counts: Dict[str, int] = collections.Counter()
+        self.num_samples = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own_thread_id = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stack_counts[';'.join(reversed(stack))] += 1
+        self.num_samples += 1
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._sample()
+
+    def start(self) -> "SamplingProfiler":
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def get_folded_stacks(self) -> List[str]:
+        return [f"{stack} {count}" for stack, count in sorted(self.stack_counts.items(), key=lambda item: -item[1])]
+
+    def write_folded_stacks(self, file_path: str):
+        with open(file_path, 'w') as f:
+            f.write('\n'.join(self.get_folded_stacks()) + '\n')
@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import time
+from typing import Any, Dict, List, Sequence, Union
+
+import numpy as np
+
+import constants
+from document_retriever import DocumentRetriever, RetrievalArgs
+
+ENCODER_CONFIG_FILE_NAME = 'encoder_config.json'
+FP32_MODEL_FILE_NAME = 'model.onnx'
+INT8_MODEL_FILE_NAME = 'model_int8.onnx'
+ONNX_OPSET_VERSION = 14
+
+
+def export_onnx_query_encoder(model_name: str = constants.EMBEDDING_MODEL_NAME,
+                              output_dir: str = constants.ONNX_QUERY_ENCODER_PATH, quantize: bool = True):
+    '''Exports the transformer of the SentenceTransformer model to ONNX, along with its tokenizer and the pooling used
+    on top of it, and with quantize also writes the int8 dynamically quantized version of the model (weights in int8,
+    activations quantized on the fly), which is usually 2-4x faster on CPU.
+    '''
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    class TransformerOutput(torch.nn.Module):
+        '''Passes the inputs by name since the positional order of the transformers models differs.
+        '''
+
+        def __init__(self, auto_model, input_names: List[str]):
+            super().__init__()
+            self.auto_model = auto_model
+            self.input_names = input_names
+
+        def forward(self, *inputs):
+            return self.auto_model(**dict(zip(self.input_names, inputs))).last_hidden_state
+
+    model = SentenceTransformer(model_name, device='cpu')
+    transformer, pooling = model[0], model[1]
+    tokenizer = transformer.tokenizer
+    example = tokenizer(['an example query about lymphatic vessels'], return_tensors='pt', padding=True,
+                        truncation=True, max_length=model.max_seq_length)
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in example]
+
+    os.makedirs(output_dir, exist_ok=True)
+    fp32_model_path = os.path.join(output_dir, FP32_MODEL_FILE_NAME)
+    with torch.no_grad():
+        torch.onnx.export(
+            TransformerOutput(transformer.auto_model.eval(), input_names), tuple(example[name] for name in input_names),
+            fp32_model_path, input_names=input_names, output_names=['last_hidden_state'],
+            dynamic_axes={name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']},
+            opset_version=ONNX_OPSET_VERSION,
+        )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_model_path, os.path.join(output_dir, INT8_MODEL_FILE_NAME), weight_type=QuantType.QInt8)
+
+    tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, ENCODER_CONFIG_FILE_NAME), 'w') as f:
+        f.write(json.dumps({
+            'model_name': model_name,
+            'input_names': input_names,
+            'pooling': 'cls' if pooling.pooling_mode_cls_token else 'mean',
+            'normalize': any(type(module).__name__ == 'Normalize' for module in model),
+            'max_seq_length': model.max_seq_length,
+            'dim': model.get_sentence_embedding_dimension(),
+        }))
+    print(f"Exported {model_name} to {output_dir}" + (" with its int8 quantized version" if quantize else ""))
+
+
+class OnnxQueryEncoder:
+    '''CPU query encoder running the model exported by export_onnx_query_encoder with ONNX Runtime. It has the encode /
+    get_sentence_embedding_dimension API of SentenceTransformer so it can be passed as the query_embedding_model of
+    DocumentRetriever. num_threads bounds the threads ONNX Runtime uses for one encode, None lets it use every core.
+    '''
+
+    def __init__(self, model_dir: str = constants.ONNX_QUERY_ENCODER_PATH, quantized: bool = True,
+                 num_threads: int = None):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, ENCODER_CONFIG_FILE_NAME), 'r') as f:
+            config = json.loads(f.read())
+        self.input_names = config['input_names']
+        self.pooling = config['pooling']
+        self.normalize = config['normalize']
+        self.max_seq_length = config['max_seq_length']
+        self.dim = config['dim']
+        # Embeddings of the quantized model differ slightly from the reference ones, so they are cached separately.
+        self.model_name = f"{config['model_name']}-onnx" + ('-int8' if quantized else '')
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+            session_options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, INT8_MODEL_FILE_NAME if quantized else FP32_MODEL_FILE_NAME), session_options,
+            providers=['CPUExecutionProvider'],
+        )
+
+    def _pool(self, last_hidden_state: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        if self.pooling == 'cls':
+            return last_hidden_state[:, 0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        return (last_hidden_state * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+    def encode(self, sentences: Union[str, Sequence[str]], batch_size: int = 32, normalize_embeddings: bool = False,
+               **kwargs) -> np.ndarray:
+        '''Texts are encoded in batches of similar length to limit the padding.
+        '''
+        texts = [sentences] if isinstance(sentences, str) else list(sentences)
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        length_order = np.argsort([len(text) for text in texts], kind='stable')
+        for start in range(0, len(texts), batch_size):
+            rows = length_order[start:start + batch_size]
+            tokens = self.tokenizer([texts[row] for row in rows], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors='np')
+            last_hidden_state = self.session.run(
+                None, {name: tokens[name].astype(np.int64) for name in self.input_names}
+            )[0]
+            embeddings[rows] = self._pool(last_hidden_state, tokens['attention_mask'])
+        if normalize_embeddings or self.normalize:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if isinstance(sentences, str) else embeddings
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+
+def load_onnx_document_retriever(retrieval_args: RetrievalArgs = None,
+                                 model_dir: str = constants.ONNX_QUERY_ENCODER_PATH, quantized: bool = True,
+                                 num_threads: int = None) -> DocumentRetriever:
+    '''DocumentRetriever encoding the queries with the ONNX encoder, whose query embeddings are cached under the
+    model_name of the encoder so they never mix with the ones of the reference model.
+    '''
+    return DocumentRetriever(retrieval_args, OnnxQueryEncoder(model_dir, quantized, num_threads))
+
+
+def sample_queries_from_papers(num_queries: int, paper_text_store_path: str = constants.PAPER_TEXT_STORE_PATH,
+                               paper_text_files_path: str = constants.CLEANED_TEXT_FOLDER_PATH, max_words: int = 30,
+                               seed: int = 44) -> List[str]:
+    '''Question-like queries made of the first sentence of the abstract of randomly picked papers.
+    '''
+    from paper_text_store import PaperTextStore
+
+    paper_text_store = PaperTextStore.load_or_build(paper_text_store_path, paper_text_files_path)
+    paper_file_names = sorted(paper_text_store.paper_offsets)
+    rng = np.random.default_rng(seed)
+    queries = []
+    for paper_idx in rng.choice(len(paper_file_names), size=min(num_queries, len(paper_file_names)), replace=False):
+        abstract = paper_text_store.get_abstract(paper_file_names[paper_idx])
+        abstract = ' '.join(abstract) if isinstance(abstract, list) else abstract
+        words = abstract.split('. ')[0].split()[:max_words]
+        if words:
+            queries.append(' '.join(words))
+    return queries
+
+
+def _time_single_queries(encoder, queries: Sequence[str]) -> List[float]:
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        encoder.encode(query, normalize_embeddings=True)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def validate_onnx_query_encoder(reference_encoder, onnx_encoder, queries: Sequence[str], vector_db=None, k: int = 10,
+                                batch_size: int = 32) -> Dict[str, Any]:
+    '''Compares the ONNX encoder with the reference SentenceTransformer on the queries: single query latency and batch
+    throughput speedups, cosine similarity between the two embeddings of every query, and, with a vector_db, the overlap
+    of the top k papers retrieved with either embedding.
+    '''
+    from embedding_vector_db import get_recall_at_k
+
+    # One untimed encode each so the first timed query does not pay for the lazy initializations.
+    reference_encoder.encode(queries[0])
+    onnx_encoder.encode(queries[0])
+    reference_latencies = _time_single_queries(reference_encoder, queries)
+    onnx_latencies = _time_single_queries(onnx_encoder, queries)
+
+    start_time = time.perf_counter()
+    reference_embeddings = np.asarray(reference_encoder.encode(list(queries), batch_size=batch_size,
+                                                               normalize_embeddings=True), dtype=np.float32)
+    reference_batch_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    onnx_embeddings = onnx_encoder.encode(list(queries), batch_size=batch_size, normalize_embeddings=True)
+    onnx_batch_time = time.perf_counter() - start_time
+
+    cosine_similarities = np.sum(reference_embeddings * onnx_embeddings, axis=1)
+    report = {
+        'num_queries': len(queries),
+        'reference_p50_ms': float(np.percentile(reference_latencies, 50) * 1000),
+        'onnx_p50_ms': float(np.percentile(onnx_latencies, 50) * 1000),
+        'single_query_speedup': float(np.median(reference_latencies) / np.median(onnx_latencies)),
+        'batch_speedup': reference_batch_time / onnx_batch_time,
+        'mean_cosine_similarity': float(cosine_similarities.mean()),
+        'min_cosine_similarity': float(cosine_similarities.min()),
+    }
+    if vector_db is not None:
+        reference_indexes, _ = vector_db.batch_search(reference_embeddings, k)
+        onnx_indexes, _ = vector_db.batch_search(onnx_embeddings, k)
+        report[f'top{k}_overlap'] = get_recall_at_k(onnx_indexes, reference_indexes)
+    return report
+
+
+if __name__ == "__main__":
+    """
+    $ python onnx_query_encoder.py --mode export
+    $ python onnx_query_encoder.py --mode validate --num_threads 4 --num_queries 200
+    """
+    from document_retriever import DEFAULT_VECTOR_DB_FILE_PATHS, load_query_embedding_model
+    from vector_index import ANNOY_BACKEND, VECTOR_INDEX_BACKENDS
+
+    parser = argparse.ArgumentParser(description="Export the query encoder to ONNX Runtime and validate it against the "
+                                                 "reference SentenceTransformer")
+    parser.add_argument("--mode", default='validate', choices=['export', 'validate'])
+    parser.add_argument("--model_name", default=constants.EMBEDDING_MODEL_NAME)
+    parser.add_argument("--model_dir", default=constants.ONNX_QUERY_ENCODER_PATH)
+    parser.add_argument("--no_quantize", action="store_true", help="Export or validate the float32 ONNX model only")
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--num_queries", type=int, default=200)
+    parser.add_argument("--queries_file", default=None, help="One query per line instead of sampling paper abstracts")
+    parser.add_argument("--vector_db_backend", default=ANNOY_BACKEND, choices=VECTOR_INDEX_BACKENDS)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--output", default=None, help="Writes the validation report as json")
+    args = parser.parse_args()
+
+    if args.mode == 'export':
+        export_onnx_query_encoder(args.model_name, args.model_dir, quantize=not args.no_quantize)
+    else:
+        if args.queries_file:
+            with open(args.queries_file, 'r') as f:
+                validation_queries = [line.strip() for line in f if line.strip()][:args.num_queries]
+        else:
+            validation_queries = sample_queries_from_papers(args.num_queries)
+        validation_report = validate_onnx_query_encoder(
+            load_query_embedding_model(args.model_name),
+            OnnxQueryEncoder(args.model_dir, quantized=not args.no_quantize, num_threads=args.num_threads),
+            validation_queries,
+            DocumentRetriever.load_pre_trained_vector_db(DEFAULT_VECTOR_DB_FILE_PATHS[args.vector_db_backend],
+                                                         args.vector_db_backend),
+            args.k,
+        )
+        for metric, value in validation_report.items():
+            print(f"{metric:<28}{value:10.4f}" if isinstance(value, float) else f"{metric:<28}{value:>10}")
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(json.dumps(validation_report, indent=2))
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import constants
+
+PaperFileName = Tuple[str, str]
+
+
+class PaperIndexMap:
+    '''Maps the index of an embedding in the vector DB to the (paper name, source file name) of its paper.
+
+    The map is stored as arrays indexed directly by the vector DB id instead of a JSON dict keyed by stringified ints:
+    the paper names are a fixed width bytes array, the source file names are interned in a small list and every paper
+    only keeps the int32 id of its source file. Both arrays are saved as .npy files and memory mapped on load, so opening
+    the map costs the same for a thousand or for millions of papers. The fingerprints of the map, and of the maps it
+    was extended from, are saved along so checking them does not hash every paper name again.
+    '''
+
+    def __init__(self, paper_names: np.ndarray, file_ids: np.ndarray, file_names: List[str],
+                 fingerprints: Dict[int, str] = None):
+        if len(paper_names) != len(file_ids):
+            raise ValueError(f"Got {len(paper_names)} paper names but {len(file_ids)} file ids")
+        self.paper_names = paper_names
+        self.file_ids = file_ids
+        self.file_names = file_names
+        # num_papers -> fingerprint of the first num_papers paper names, see get_fingerprint.
+        self.fingerprints = dict(fingerprints or {})
+
+    @classmethod
+    def from_paper_file_names(cls, paper_file_names: Sequence[PaperFileName]) -> "PaperIndexMap":
+        '''paper_file_names[idx] is the (paper name, source file name) of the embedding idx.
+        '''
+        file_ids = {}
+        paper_file_ids = np.empty(len(paper_file_names), dtype=np.int32)
+        for idx, (_, file_name) in enumerate(paper_file_names):
+            paper_file_ids[idx] = file_ids.setdefault(file_name, len(file_ids))
+        encoded_names = [paper_name.encode('utf-8') for paper_name, _ in paper_file_names]
+        # np.array would strip trailing NUL bytes anyway, the width is at least 1 so empty maps still have a dtype.
+        width = max([len(name) for name in encoded_names] + [1])
+        return cls(np.array(encoded_names, dtype=f'S{width}'), paper_file_ids, list(file_ids))
+
+    @classmethod
+    def from_json_map(cls, json_map_file_path: str) -> "PaperIndexMap":
+        '''Converts the legacy embedding_idx_paper_file_name_map.jsonl dict of "idx" -> [paper name, file name].
+        '''
+        with open(json_map_file_path, 'r') as f:
+            json_map = json.loads(f.readline())
+        num_papers = max((int(idx) for idx in json_map), default=-1) + 1
+        if len(json_map) != num_papers:
+            raise ValueError(f"{json_map_file_path} does not map every index in [0, {num_papers})")
+        return cls.from_paper_file_names([tuple(json_map[str(idx)]) for idx in range(num_papers)])
+
+    @staticmethod
+    def _source_signature(source_file_path: str) -> Optional[List[int]]:
+        if source_file_path is None or not os.path.exists(source_file_path):
+            return None
+        stat = os.stat(source_file_path)
+        return [stat.st_size, int(stat.st_mtime)]
+
+    def _get_fingerprints_to_save(self, folder_path: str) -> Dict[int, str]:
+        '''The fingerprint of the whole map, plus the fingerprints saved with the previous map in folder_path when this
+        map extends it, as papers appended by incremental ingestion do.
+        '''
+        fingerprints = {len(self): self.get_fingerprint()}
+        previous_meta = self._read_meta(folder_path) or {}
+        previous_fingerprints = {int(num_papers): fingerprint for num_papers, fingerprint
+                                 in (previous_meta.get('fingerprints') or {}).items()}
+        previous_num_papers = previous_meta.get('num_papers')
+        if previous_num_papers in previous_fingerprints and previous_num_papers <= len(self) and \
+                previous_fingerprints[previous_num_papers] == self.get_fingerprint(previous_num_papers):
+            fingerprints.update({num_papers: fingerprint for num_papers, fingerprint in previous_fingerprints.items()
+                                 if num_papers <= previous_num_papers})
+        return fingerprints
+
+    def save(self, folder_path: str, source_file_path: str = None):
+        '''The arrays are written first and the meta file last, each through a temporary file, so a reader never sees a
+        half written map.
+        '''
+        os.makedirs(folder_path, exist_ok=True)
+        self.fingerprints.update(self._get_fingerprints_to_save(folder_path))
+        for file_name, array in ((constants.PAPER_NAMES_FILE_NAME, self.paper_names),
+                                 (constants.PAPER_FILE_IDS_FILE_NAME, self.file_ids)):
+            file_path = os.path.join(folder_path, file_name)
+            with open(file_path + '.tmp', 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(file_path + '.tmp', file_path)
+
+        meta_file_path = os.path.join(folder_path, constants.PAPER_INDEX_MAP_META_FILE_NAME)
+        with open(meta_file_path + '.tmp', 'w') as f:
+            f.write(json.dumps({
+                'num_papers': len(self),
+                'file_names': self.file_names,
+                'source': self._source_signature(source_file_path),
+                'fingerprints': {str(num_papers): fingerprint for num_papers, fingerprint
+                                 in sorted(self.fingerprints.items())},
+            }))
+        os.replace(meta_file_path + '.tmp', meta_file_path)
+
+    @staticmethod
+    def _read_meta(folder_path: str) -> Optional[dict]:
+        meta_file_path = os.path.join(folder_path, constants.PAPER_INDEX_MAP_META_FILE_NAME)
+        if not os.path.exists(meta_file_path):
+            return None
+        with open(meta_file_path, 'r') as f:
+            return json.loads(f.read())
+
+    @classmethod
+    def load(cls, folder_path: str) -> "PaperIndexMap":
+        meta = cls._read_meta(folder_path)
+        if meta is None:
+            raise FileNotFoundError(f"No paper index map in {folder_path}")
+        paper_names = np.load(os.path.join(folder_path, constants.PAPER_NAMES_FILE_NAME), mmap_mode='r')
+        file_ids = np.load(os.path.join(folder_path, constants.PAPER_FILE_IDS_FILE_NAME), mmap_mode='r')
+        fingerprints = {int(num_papers): fingerprint for num_papers, fingerprint
+                        in (meta.get('fingerprints') or {}).items()}
+        return cls(paper_names, file_ids, meta['file_names'], fingerprints)
+
+    @classmethod
+    def load_or_convert(cls, folder_path: str, json_map_file_path: str = None) -> "PaperIndexMap":
+        '''Loads the array map, converting and saving the legacy JSON map first when the array map is missing or was
+        converted from a different version of the JSON map.
+        '''
+        meta = cls._read_meta(folder_path)
+        source_signature = cls._source_signature(json_map_file_path)
+        if meta is not None and (source_signature is None or meta['source'] == source_signature):
+            return cls.load(folder_path)
+        if source_signature is None:
+            raise FileNotFoundError(f"No paper index map in {folder_path} and no JSON map to convert")
+        paper_index_map = cls.from_json_map(json_map_file_path)
+        paper_index_map.save(folder_path, json_map_file_path)
+        return cls.load(folder_path)
+
+    def __len__(self) -> int:
+        return len(self.paper_names)
+
+    def __getitem__(self, idx: int) -> PaperFileName:
+        return self.paper_names[idx].decode('utf-8'), self.file_names[self.file_ids[idx]]
+
+    def get(self, idx: int, default: PaperFileName = None) -> Optional[PaperFileName]:
+        if 0 <= idx < len(self.paper_names):
+            return self[idx]
+        return default
+
+    def get_fingerprint(self, num_papers: int = None) -> str:
+        '''Hash of the first num_papers paper names, in id order, so an index keyed by the ids of this map can check it
+        still refers to the same papers. It does not depend on the width the names happen to be stored with. The
+        fingerprints saved with the map are returned as is, only the others hash the paper names.
+        '''
+        num_papers = len(self) if num_papers is None else min(num_papers, len(self))
+        if num_papers in self.fingerprints:
+            return self.fingerprints[num_papers]
+        paper_names = np.asarray(self.paper_names[:num_papers])
+        width = max(int(np.char.str_len(paper_names).max()) if len(paper_names) else 0, 1)
+        return hashlib.sha1(paper_names.astype(f'S{width}').tobytes()).hexdigest()
+
+    def get_many(self, indexes: Sequence[int]) -> List[PaperFileName]:
+        '''Indexes outside of the map, e.g. -1 padding from a backend with fewer than k results, are skipped.
+        '''
+        return [self[idx] for idx in indexes if 0 <= idx < len(self.paper_names)]
@@ -0,0 +1,152 @@
+import json
+import mmap
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import constants
+
+ABSTRACT_FIELD = 'abstract'
+BODY_FIELD = 'main_body'
+# Bumped whenever the layout of the index changes, a store of another version is rebuilt.
+STORE_FORMAT_VERSION = 2
+
+# (paper name, cleaned text file name), the same key as the PaperIndexMap entries.
+PaperFileName = Tuple[str, str]
+
+
+class PaperTextStore:
+    '''Read only store of the cleaned paper text built once from the cleaned text split files.
+
+    Every paper is written to a single data file as two JSON encoded fields (abstract followed by main body) and a small
+    index maps the (paper name, file name) of the paper to (byte offset, abstract length, body length). The same paper
+    name in two split files are two different papers, as everywhere else in the repo. The data file is memory mapped so
+    a lookup only decodes the bytes of the requested field instead of parsing the whole multi-megabyte split file.
+    '''
+
+    def __init__(self, store_path: str = constants.PAPER_TEXT_STORE_PATH):
+        self.store_path = store_path
+        with open(os.path.join(store_path, constants.PAPER_TEXT_INDEX_FILE_NAME), 'r') as f:
+            store_index = json.loads(f.read())
+        self.format_version = store_index.get('version')
+        self.sources = store_index['sources']
+        self.paper_offsets: Dict[PaperFileName, List[int]] = {}
+        if self.format_version == STORE_FORMAT_VERSION:
+            self.paper_offsets = {(paper_name, file_name): paper_offset
+                                  for file_name, file_paper_offsets in store_index['papers'].items()
+                                  for paper_name, paper_offset in file_paper_offsets.items()}
+
+        self._data_file = open(os.path.join(store_path, constants.PAPER_TEXT_DATA_FILE_NAME), 'rb')
+        if os.fstat(self._data_file.fileno()).st_size == 0:
+            # mmap does not accept empty files.
+            self._data = b''
+        else:
+            self._data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _source_signature(paper_text_files_path: str) -> Optional[Dict[str, List[int]]]:
+        '''None when the cleaned text folder does not exist, e.g. on a deployment shipping only the built store.
+        '''
+        if not os.path.isdir(paper_text_files_path):
+            return None
+        signature = {}
+        for file_name in sorted(os.listdir(paper_text_files_path)):
+            stat = os.stat(os.path.join(paper_text_files_path, file_name))
+            signature[file_name] = [stat.st_size, int(stat.st_mtime)]
+        return signature
+
+    @classmethod
+    def build(cls, paper_text_files_path: str = constants.CLEANED_TEXT_FOLDER_PATH,
+              store_path: str = constants.PAPER_TEXT_STORE_PATH) -> "PaperTextStore":
+        '''Parses every cleaned text split file exactly once and writes the data file and its index. Files are written
+        to a temporary name first and then renamed so a crashed build never leaves a half written store behind.
+        '''
+        os.makedirs(store_path, exist_ok=True)
+        data_file_path = os.path.join(store_path, constants.PAPER_TEXT_DATA_FILE_NAME)
+        index_file_path = os.path.join(store_path, constants.PAPER_TEXT_INDEX_FILE_NAME)
+
+        sources = cls._source_signature(paper_text_files_path)
+        if sources is None:
+            raise FileNotFoundError(f"No cleaned text folder {paper_text_files_path} to build the paper text store from")
+        paper_offsets = {}
+        offset = 0
+        with open(data_file_path + '.tmp', 'wb') as f_data:
+            for file_name in sources:
+                with open(os.path.join(paper_text_files_path, file_name), 'r') as f:
+                    papers = json.loads(f.readlines()[0])
+                file_paper_offsets = paper_offsets.setdefault(file_name, {})
+                for paper_name, paper in papers.items():
+                    abstract = json.dumps(paper.get(ABSTRACT_FIELD, '')).encode('utf-8')
+                    body = json.dumps(paper.get(BODY_FIELD, '')).encode('utf-8')
+                    f_data.write(abstract)
+                    f_data.write(body)
+                    file_paper_offsets[paper_name] = [offset, len(abstract), len(body)]
+                    offset += len(abstract) + len(body)
+
+        with open(index_file_path + '.tmp', 'w') as f_index:
+            f_index.write(json.dumps({'version': STORE_FORMAT_VERSION, 'sources': sources, 'papers': paper_offsets}))
+
+        os.replace(data_file_path + '.tmp', data_file_path)
+        os.replace(index_file_path + '.tmp', index_file_path)
+        return cls(store_path)
+
+    @classmethod
+    def load_or_build(cls, store_path: str = constants.PAPER_TEXT_STORE_PATH,
+                      paper_text_files_path: str = constants.CLEANED_TEXT_FOLDER_PATH) -> "PaperTextStore":
+        '''Loads the store if it exists and is up to date with the cleaned text folder, otherwise (re)builds it. When
+        the cleaned text folder is absent the existing store is used as is, as long as it has the current format.
+        '''
+        index_file_path = os.path.join(store_path, constants.PAPER_TEXT_INDEX_FILE_NAME)
+        if os.path.exists(index_file_path):
+            store = cls(store_path)
+            if store.format_version == STORE_FORMAT_VERSION:
+                sources = cls._source_signature(paper_text_files_path)
+                if sources is None or store.sources == sources:
+                    return store
+            store.close()
+        return cls.build(paper_text_files_path, store_path)
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data_file.close()
+
+    def __contains__(self, paper_file_name: PaperFileName) -> bool:
+        return tuple(paper_file_name) in self.paper_offsets
+
+    def __len__(self) -> int:
+        return len(self.paper_offsets)
+
+    def _read_field(self, paper_file_name: PaperFileName, field: str) -> Any:
+        paper_offset = self.paper_offsets.get(tuple(paper_file_name), None)
+        if paper_offset is None:
+            return ''
+        offset, abstract_length, body_length = paper_offset
+        if field == ABSTRACT_FIELD:
+            start, end = offset, offset + abstract_length
+        else:
+            start, end = offset + abstract_length, offset + abstract_length + body_length
+        return json.loads(self._data[start:end].decode('utf-8'))
+
+    def get_abstract(self, paper_file_name: PaperFileName) -> Any:
+        return self._read_field(paper_file_name, ABSTRACT_FIELD)
+
+    def get_body(self, paper_file_name: PaperFileName) -> Any:
+        return self._read_field(paper_file_name, BODY_FIELD)
+
+    def get_paper(self, paper_file_name: PaperFileName) -> Dict[str, Any]:
+        return {ABSTRACT_FIELD: self.get_abstract(paper_file_name), BODY_FIELD: self.get_body(paper_file_name)}
+
+    def get_papers(self, paper_file_names: List[PaperFileName]) -> List[Dict[str, Any]]:
+        '''Reads the papers in the order of their offset in the data file so the page cache is walked sequentially, but
+        returns them in the requested order.
+        '''
+        paper_file_names = [tuple(paper_file_name) for paper_file_name in paper_file_names]
+        ordered = sorted(set(paper_file_names), key=lambda key: self.paper_offsets.get(key, [-1])[0])
+        papers = {key: self.get_paper(key) for key in ordered}
+        return [papers[key] for key in paper_file_names]
+
+
+if __name__ == "__main__":
+
+    paper_text_store = PaperTextStore.build(constants.CLEANED_TEXT_FOLDER_PATH, constants.PAPER_TEXT_STORE_PATH)
+    print(f"Finished building paper text store with {len(paper_text_store)} papers at {constants.PAPER_TEXT_STORE_PATH}")
@@ -0,0 +1,190 @@
+from typing import Any, Callable, Dict, List, Tuple
+
+import attr
+import tiktoken
+
+from constants import ACTOR_USER, OPENAI_GPT35_16K_MODEL, OPENAI_GPT35_4K_MODEL, SYSTEM_ROLE
+from document_retriever import Passage
+
+ChatMessage = Dict[str, str]
+
+MODEL_CONTEXT_WINDOWS = {
+    OPENAI_GPT35_4K_MODEL: 4096,
+    OPENAI_GPT35_16K_MODEL: 16384,
+}
+# Every chat message is wrapped in <|start|>{role}\n{content}<|end|>\n and the reply is primed with
+# <|start|>assistant<|message|>, see the OpenAI cookbook on counting tokens for chat completions.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+EARLIER_CONVERSATION_PREFIX = "Earlier in this conversation the user asked: "
+
+
+@attr.s
+class TokenReport:
+    model_name: str = attr.ib()
+    prompt_tokens: int = attr.ib()
+    system_tokens: int = attr.ib()
+    history_tokens: int = attr.ib()
+    question_tokens: int = attr.ib()
+    num_passages: int = attr.ib(default=0)
+    num_dropped_passages: int = attr.ib(default=0)
+    num_dropped_turns: int = attr.ib(default=0)
+    completion_tokens: int = attr.ib(default=None)
+    # Seconds from sending the request to the first answer token (the whole answer when not streaming).
+    time_to_first_token: float = attr.ib(default=None)
+    answer_cache_hit: bool = attr.ib(default=False)
+
+
+@attr.s
+class PromptBuilder:
+    '''Builds the chat messages within the context window of the model, leaving max_completion_tokens for the answer.
+
+    The system prompt and the question are always kept. The most recent chat turns get the budget left by the full paper
+    context, and at least max_history_fraction of it, and the older turns are replaced by a one line summary of the
+    questions asked. The paper passages then fill the rest of the budget in order of relevance, the last one being
+    truncated. The max_completion_tokens reserved for the answer are sent as the max_tokens of the request. With
+    auto_select_model (off by default, the configured model is then always used) the smallest model whose window fits
+    the untrimmed context is used, falling back to the largest model with trimming. Tokens are counted with the tiktoken
+    encoding of the model unless a tokenizer with the same encode / decode API is given.
+    '''
+    model_names: List[str] = attr.ib(default=attr.Factory(lambda: [OPENAI_GPT35_4K_MODEL, OPENAI_GPT35_16K_MODEL]))
+    auto_select_model: bool = attr.ib(default=False)
+    max_completion_tokens: int = attr.ib(default=1000)
+    max_history_fraction: float = attr.ib(default=0.3)
+    max_summary_tokens: int = attr.ib(default=200)
+    context_windows: Dict[str, int] = attr.ib(default=attr.Factory(lambda: dict(MODEL_CONTEXT_WINDOWS)))
+    # Used for every model instead of the tiktoken encodings, which are downloaded on first use.
+    tokenizer: Any = attr.ib(default=None)
+
+    def get_tokenizer(self, model_name: str):
+        if self.tokenizer is not None:
+            return self.tokenizer
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+
+    def count_tokens(self, text: str, model_name: str) -> int:
+        return len(self.get_tokenizer(model_name).encode(text, disallowed_special=()))
+
+    def count_message_tokens(self, messages: List[ChatMessage], model_name: str) -> int:
+        num_tokens = TOKENS_PER_REPLY
+        for message in messages:
+            num_tokens += TOKENS_PER_MESSAGE + self.count_tokens(message['role'], model_name)
+            num_tokens += self.count_tokens(message['content'], model_name)
+        return num_tokens
+
+    def truncate_to_tokens(self, text: str, max_tokens: int, model_name: str) -> str:
+        tokenizer = self.get_tokenizer(model_name)
+        tokens = tokenizer.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return tokenizer.decode(tokens[:max(max_tokens, 0)])
+
+    def _fit_history(self, chat_history: List[ChatMessage], budget: int, model_name: str
+                     ) -> Tuple[List[ChatMessage], int]:
+        '''Keeps the most recent (question, answer) turns within budget and summarizes the dropped ones.
+        '''
+        turns = [chat_history[idx:idx + 2] for idx in range(0, len(chat_history), 2)]
+        kept = []
+        used = 0
+        for turn in reversed(turns):
+            turn_tokens = self.count_message_tokens(turn, model_name) - TOKENS_PER_REPLY
+            if used + turn_tokens > budget:
+                break
+            kept.insert(0, turn)
+            used += turn_tokens
+        dropped = turns[:len(turns) - len(kept)]
+        messages = [message for turn in kept for message in turn]
+        if dropped:
+            questions = '; '.join(message['content'] for turn in dropped for message in turn
+                                  if message['role'] == ACTOR_USER)
+            summary = self.truncate_to_tokens(EARLIER_CONVERSATION_PREFIX + questions,
+                                              min(self.max_summary_tokens, max(budget - used, 0)), model_name)
+            if summary:
+                messages.insert(0, {"role": SYSTEM_ROLE, "content": summary})
+        return messages, len(dropped)
+
+    def _fit_passages(self, system_prompt_template: str, passages: List[Passage],
+                      render_context: Callable[[List[Passage]], str], budget: int, model_name: str
+                      ) -> Tuple[str, int]:
+        def system_tokens(selected: List[Passage]) -> int:
+            system_prompt = system_prompt_template.format(paper_text=render_context(selected))
+            return self.count_message_tokens([{"role": SYSTEM_ROLE, "content": system_prompt}], model_name) - \
+                TOKENS_PER_REPLY
+
+        selected = []
+        for passage in sorted(passages, key=lambda passage: passage.score, reverse=True):
+            if system_tokens(selected + [passage]) <= budget:
+                selected.append(passage)
+                continue
+            # Truncate the first passage that does not fit to the remaining budget and stop there.
+            remaining = budget - system_tokens(selected)
+            while remaining > 0:
+                truncated = attr.evolve(passage, text=self.truncate_to_tokens(passage.text, remaining, model_name))
+                overflow = system_tokens(selected + [truncated]) - budget
+                if overflow <= 0:
+                    selected.append(truncated)
+                    break
+                remaining -= overflow
+            break
+        system_prompt = system_prompt_template.format(paper_text=render_context(selected))
+        return system_prompt, len(passages) - len(selected)
+
+    def _build_for_model(self, model_name: str, system_prompt_template: str, passages: List[Passage],
+                         render_context: Callable[[List[Passage]], str], chat_history: List[ChatMessage],
+                         question_message: ChatMessage) -> Tuple[List[ChatMessage], TokenReport]:
+        budget = self.context_windows[model_name] - self.max_completion_tokens
+        question_tokens = self.count_message_tokens([question_message], model_name)
+        empty_system_tokens = self.count_message_tokens(
+            [{"role": SYSTEM_ROLE, "content": system_prompt_template.format(paper_text='')}], model_name
+        ) - TOKENS_PER_REPLY
+        available = budget - question_tokens - empty_system_tokens
+        full_system_tokens = self.count_message_tokens(
+            [{"role": SYSTEM_ROLE, "content": system_prompt_template.format(paper_text=render_context(passages))}],
+            model_name
+        ) - TOKENS_PER_REPLY
+        # History may use whatever the full paper context leaves, and at least max_history_fraction of the budget.
+        history_budget = max(available - (full_system_tokens - empty_system_tokens),
+                             int(available * self.max_history_fraction), 0)
+
+        history, num_dropped_turns = self._fit_history(chat_history, history_budget, model_name)
+        history_tokens = self.count_message_tokens(history, model_name) - TOKENS_PER_REPLY if history else 0
+        system_prompt, num_dropped_passages = self._fit_passages(
+            system_prompt_template, passages, render_context, budget - question_tokens - history_tokens, model_name
+        )
+        system_message = {"role": SYSTEM_ROLE, "content": system_prompt}
+        messages = [system_message] + history + [question_message]
+        report = TokenReport(
+            model_name=model_name,
+            prompt_tokens=self.count_message_tokens(messages, model_name),
+            system_tokens=self.count_message_tokens([system_message], model_name) - TOKENS_PER_REPLY,
+            history_tokens=history_tokens,
+            question_tokens=question_tokens - TOKENS_PER_REPLY,
+            num_passages=len(passages) - num_dropped_passages,
+            num_dropped_passages=num_dropped_passages,
+            num_dropped_turns=num_dropped_turns,
+        )
+        return messages, report
+
+    def build(self, system_prompt_template: str, passages: List[Passage],
+              render_context: Callable[[List[Passage]], str], chat_history: List[ChatMessage], question: str,
+              model_name: str) -> Tuple[List[ChatMessage], TokenReport]:
+        '''Returns the messages to send and the per turn token report, whose model_name is the model to use. model_name
+        is used as is when auto_select_model is off.
+        '''
+        question_message = {"role": ACTOR_USER, "content": question}
+        if not self.auto_select_model:
+            return self._build_for_model(model_name, system_prompt_template, passages, render_context,
+                                         chat_history, question_message)
+
+        model_names = sorted(self.model_names, key=lambda name: self.context_windows[name])
+        full_messages = [{"role": SYSTEM_ROLE, "content": system_prompt_template.format(paper_text=render_context(passages))}]
+        full_messages += list(chat_history) + [question_message]
+        for candidate_model_name in model_names:
+            budget = self.context_windows[candidate_model_name] - self.max_completion_tokens
+            if self.count_message_tokens(full_messages, candidate_model_name) <= budget:
+                return self._build_for_model(candidate_model_name, system_prompt_template, passages, render_context,
+                                             chat_history, question_message)
+        return self._build_for_model(model_names[-1], system_prompt_template, passages, render_context,
+                                     chat_history, question_message)
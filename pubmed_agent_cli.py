@@ -1,6 +1,55 @@
+import time
+IMPORT_START_TIME = time.perf_counter()
 import argparse
+import sys
+from typing import List
 from chat_agent import OpenAIPubMedAgent
+from document_retriever import RetrievalArgs
+from metrics import METRICS, SamplingProfiler
 import openai
+IMPORT_TIME = time.perf_counter() - IMPORT_START_TIME
+
+HEAVY_MODULES = ['torch', 'sentence_transformers', 'onnxruntime', 'annoy']
+
+
+def ask(agent: OpenAIPubMedAgent, question: str, chat_history, state: int, stream: bool):
+    '''Runs the agent on the question and prints the answer, token by token as they arrive when streaming.
+    '''
+    if not stream:
+        response, chat_history = agent.run(question=question, chat_history=chat_history, state=state)
+        print(response)
+        return chat_history
+
+    answer_stream = agent.run_stream(question=question, chat_history=chat_history, state=state)
+    while True:
+        try:
+            print(next(answer_stream), end='', flush=True)
+        except StopIteration as stop:
+            _, chat_history = stop.value
+            print()
+            return chat_history
+
+
+def get_imported_heavy_modules() -> List[str]:
+    return [module for module in HEAVY_MODULES if module in sys.modules]
+
+
+def print_startup_profile(agent: OpenAIPubMedAgent, agent_init_time: float, heavy_modules_at_startup: List[str]):
+    '''Prints the seconds spent in every startup step. The query embedding model is loaded lazily, its load time is the
+    cost of the first question unless it is warmed up in the background. heavy_modules_at_startup is taken before the
+    profile loads the model, which imports them.
+    '''
+    timings = [('imports', IMPORT_TIME), ('agent init (total)', agent_init_time)]
+    timings += [(f"  {step}", seconds) for step, seconds in agent.document_retriever.startup_timings.items()
+                if step != 'query_embedding_model']
+    model_load_time = agent.document_retriever.startup_timings.get('query_embedding_model')
+    if model_load_time is not None:
+        timings.append(('query embedding model (lazy, not in agent init)', model_load_time))
+    print("Startup profile (seconds):")
+    for step, seconds in timings:
+        print(f"  {step:<45}{seconds:8.3f}")
+    print(f"  heavy modules imported at startup: {', '.join(heavy_modules_at_startup) or 'none'}")
+
 
 if __name__ == "__main__":
     """
@@ -12,6 +61,23 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="A command Line AI Agent to interact with thousands of medical research papers sourced from pubmed")
     parser.add_argument("--api_key")
+    parser.add_argument("--api_base", default=None,
+                        help="OpenAI compatible endpoint to use instead of the OpenAI API, e.g. the local "
+                             "fake_openai_server.py")
+    parser.add_argument("--stream", action="store_true", help="Print the answer tokens as they are generated")
+    parser.add_argument("--warm_up", action="store_true",
+                        help="Load the query embedding model in the background while waiting for the first question")
+    parser.add_argument("--profile_startup", "--profile-startup", action="store_true",
+                        help="Print where the startup time goes, including the lazy load of the embedding model")
+    parser.add_argument("--metrics_output", default=None,
+                        help="Records the per stage timings, retries, cache hits and tokens and appends them as json "
+                             "lines to this file on exit")
+    parser.add_argument("--profile_output", default=None,
+                        help="Runs the sampling profiler and writes the folded stacks to this file on exit")
+    parser.add_argument("--onnx_encoder_dir", default=None,
+                        help="Encode the queries with the ONNX model exported by onnx_query_encoder.py in this folder")
+    parser.add_argument("--onnx_float32", action="store_true", help="Use the float32 ONNX model instead of the int8 one")
+    parser.add_argument("--encoder_threads", type=int, default=None, help="Threads of the ONNX query encoder")
     parser.add_argument("--question")
     parser.add_argument("--state", type=int, default=0,
                         help="0: New unrelated question and requires retrieving new relevant papers"
@@ -20,21 +86,42 @@ if __name__ == "__main__":
                         )
     args = parser.parse_args()
     openai.api_key = args.api_key
-    agent = OpenAIPubMedAgent()
+    if args.api_base:
+        openai.api_base = args.api_base
+    if args.metrics_output:
+        METRICS.enable()
+    profiler = SamplingProfiler().start() if args.profile_output else None
+    agent_init_start_time = time.perf_counter()
+    retrieval_args = RetrievalArgs(warm_up_query_embedding_model=args.warm_up)
+    document_retriever = None
+    if args.onnx_encoder_dir:
+        from onnx_query_encoder import load_onnx_document_retriever
+        document_retriever = load_onnx_document_retriever(retrieval_args, args.onnx_encoder_dir,
+                                                          not args.onnx_float32, args.encoder_threads)
+    agent = OpenAIPubMedAgent(retrieval_args=retrieval_args, document_retriever=document_retriever)
+    agent_init_time = time.perf_counter() - agent_init_start_time
+    if args.profile_startup:
+        heavy_modules_at_startup = get_imported_heavy_modules()
+        agent.document_retriever.warm_up(background=False)
+        print_startup_profile(agent, agent_init_time, heavy_modules_at_startup)
     chat_history = []
-    while args.state != 2:
-        if args.state == 1:
-            question = input(">> ")
-            response, chat_history = agent.run(question=question, chat_history=chat_history, state=args.state)
-            print(response)
-        else:
-            if args.question:
-                response, chat_history = agent.run(question=args.question, chat_history=chat_history, state=args.state)
-                print(response)
-                args.question = ''
-            else:
+    try:
+        while args.state != 2:
+            if args.state == 1:
                 question = input(">> ")
-                response, chat_history = agent.run(question=question, chat_history=chat_history, state=args.state)
-                print(response)
+                chat_history = ask(agent, question, chat_history, args.state, args.stream)
+            else:
+                if args.question:
+                    chat_history = ask(agent, args.question, chat_history, args.state, args.stream)
+                    args.question = ''
+                else:
+                    question = input(">> ")
+                    chat_history = ask(agent, question, chat_history, args.state, args.stream)
 
-        args.state = int(input("Enter the desired state, to exit enter 2>> "))
+            args.state = int(input("Enter the desired state, to exit enter 2>> "))
+    finally:
+        if args.metrics_output:
+            METRICS.write_json_lines(args.metrics_output)
+        if profiler is not None:
+            profiler.stop()
+            profiler.write_folded_stacks(args.profile_output)
@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import collections
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple
+
+import numpy as np
+import openai
+from aiohttp import web
+
+from answer_cache import SemanticAnswerCache
+from chat_agent import OpenAIPubMedAgent
+from document_retriever import RetrievalArgs
+from metrics import METRICS, SamplingProfiler
+
+LATENCY_WINDOW = 10000
+
+
+class MicroBatcher:
+    '''Combines the items submitted concurrently into batches of at most max_batch_size items, waiting at most
+    max_wait_ms after the first item of a batch for more to arrive. process_batch maps a list of items to the list of
+    their results and runs on the executor, one batch at a time, and every result is handed back to its caller.
+    '''
+
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0, executor: ThreadPoolExecutor = None):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self._queue = None
+        self._worker = None
+        self.num_batches = 0
+        self.num_items = 0
+
+    async def submit(self, item: Any) -> Any:
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.ensure_future(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[Any, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.num_batches += 1
+            self.num_items += len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+
+
+class PubMedAgentServer:
+    '''Long lived serving process: the agent, and so the embedding model, vector index and paper maps, is loaded once and
+    the paper level retrieval of concurrent new questions is micro batched (one encode and one batch search per batch).
+    '''
+
+    def __init__(self, agent: OpenAIPubMedAgent, max_batch_size: int = 32, max_wait_ms: float = 5.0,
+                 profiler: SamplingProfiler = None):
+        self.agent = agent
+        self.retrieval_batcher = MicroBatcher(self._retrieve_candidate_papers, max_batch_size, max_wait_ms)
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.profiler = profiler
+
+    def _retrieve_candidate_papers(self, questions: List[str]) -> List[List[Tuple[str, str]]]:
+        METRICS.increment('retrieval_batches')
+        METRICS.increment('retrieval_batch_questions', len(questions))
+        with METRICS.span('batched_paper_retrieval'):
+            results = self.agent.document_retriever.retrieve_candidate_papers_for_queries(questions)
+        return [result.papers for result in results]
+
+    @staticmethod
+    async def _read_body(request: web.Request, *required_keys: str) -> dict:
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest(text="The body must be a json object")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="The body must be a json object")
+        missing_keys = [key for key in required_keys if key not in body]
+        if missing_keys:
+            raise web.HTTPBadRequest(text=f"Missing {', '.join(missing_keys)} in the body")
+        return body
+
+    async def handle_ask(self, request: web.Request) -> web.Response:
+        '''A request without a session_id starts a new session, its id is returned so the follow up questions can be
+        sent with it. Sessions are never shared between clients through a default id, so a follow up (state 1) or the
+        end of a chat (state 2) must name its session.
+        '''
+        start_time = time.time()
+        body = await self._read_body(request, 'question')
+        question = body['question']
+        if not isinstance(question, str):
+            raise web.HTTPBadRequest(text=f"question must be a string, got {question!r}")
+        try:
+            state = int(body.get('state', 0))
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text=f"state must be an integer, got {body.get('state')!r}")
+        if state not in (0, 1, 2):
+            raise web.HTTPBadRequest(text=f"state must be 0, 1 or 2, got {state}")
+        chat_history = body.get('chat_history', [])
+        if not isinstance(chat_history, list):
+            raise web.HTTPBadRequest(text=f"chat_history must be a list, got {chat_history!r}")
+        if body.get('session_id') is not None and not isinstance(body['session_id'], str):
+            raise web.HTTPBadRequest(text=f"session_id must be a string, got {body['session_id']!r}")
+        if state != 0 and not body.get('session_id'):
+            raise web.HTTPBadRequest(text=f"A request in state {state} must send the session_id of its chat")
+        session_id = body.get('session_id') or uuid.uuid4().hex
+        candidate_papers = await self.retrieval_batcher.submit(question) if state == 0 else None
+        try:
+            response, chat_history = await self.agent.arun(
+                question, chat_history, state, session_id=session_id, candidate_papers=candidate_papers
+            )
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        self.latencies.append(time.time() - start_time)
+        METRICS.observe('request_seconds', time.time() - start_time, route='ask')
+        return web.json_response({'response': response, 'chat_history': chat_history, 'session_id': session_id})
+
+    async def handle_end_session(self, request: web.Request) -> web.Response:
+        body = await self._read_body(request, 'session_id')
+        self.agent.end_session(body['session_id'])
+        return web.json_response({'session_id': body['session_id']})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        latencies = np.asarray(self.latencies) if self.latencies else np.zeros(1)
+        stats = {
+            'num_requests': len(self.latencies),
+            'num_batches': self.retrieval_batcher.num_batches,
+            'mean_batch_size': self.retrieval_batcher.num_items / max(self.retrieval_batcher.num_batches, 1),
+            'latency_p50': float(np.percentile(latencies, 50)),
+            'latency_p99': float(np.percentile(latencies, 99)),
+        }
+        if self.agent.document_retriever.query_embedding_cache is not None:
+            stats['query_embedding_cache'] = self.agent.document_retriever.query_embedding_cache.get_stats()
+        if self.agent.answer_cache is not None:
+            stats['answer_cache'] = self.agent.answer_cache.get_stats()
+        return web.json_response(stats)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        '''Prometheus scrape endpoint, empty unless the metrics are enabled.
+        '''
+        return web.Response(text=METRICS.export_prometheus(), content_type='text/plain', charset='utf-8')
+
+    async def handle_profile(self, request: web.Request) -> web.Response:
+        '''Folded stacks sampled so far by the profiler, when the server runs with one.
+        '''
+        if self.profiler is None:
+            raise web.HTTPNotFound(text="The server runs without the sampling profiler, see --profile")
+        return web.Response(text='\n'.join(self.profiler.get_folded_stacks()) + '\n', content_type='text/plain')
+
+    async def _on_cleanup(self, app: web.Application):
+        self.retrieval_batcher.close()
+        if self.profiler is not None:
+            self.profiler.stop()
+        await self.agent.aclose()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v1/ask', self.handle_ask)
+        app.router.add_post('/v1/end_session', self.handle_end_session)
+        app.router.add_get('/v1/stats', self.handle_stats)
+        app.router.add_get('/metrics', self.handle_metrics)
+        app.router.add_get('/v1/profile', self.handle_profile)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+
+if __name__ == "__main__":
+    """
+    $ python $BASE_DIR/pubmed_qa_bot/pubmed_agent_server.py --api_key dummy_key --port 8080
+    $ curl -X POST localhost:8080/v1/ask -d '{"question": "...", "session_id": "user-1"}'
+    """
+    parser = argparse.ArgumentParser(description="Serve the PubMed agent over HTTP with micro batched retrieval")
+    parser.add_argument("--api_key")
+    parser.add_argument("--api_base", default=None)
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=5.0)
+    parser.add_argument("--max_concurrent_requests", type=int, default=16)
+    parser.add_argument("--answer_cache_threshold", type=float, default=None,
+                        help="Enables the semantic answer cache with this question similarity threshold, e.g. 0.95")
+    parser.add_argument("--answer_cache_path", default=None, help="sqlite file persisting the answer cache")
+    parser.add_argument("--onnx_encoder_dir", default=None,
+                        help="Encode the queries with the ONNX model exported by onnx_query_encoder.py in this folder")
+    parser.add_argument("--onnx_float32", action="store_true", help="Use the float32 ONNX model instead of the int8 one")
+    parser.add_argument("--encoder_threads", type=int, default=None, help="Threads of the ONNX query encoder")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Records the per stage timings, retries, cache hits and tokens, served on /metrics")
+    parser.add_argument("--profile", action="store_true",
+                        help="Runs the sampling profiler, its folded stacks are served on /v1/profile")
+    args = parser.parse_args()
+    if args.metrics:
+        METRICS.enable()
+    openai.api_key = args.api_key
+    if args.api_base:
+        openai.api_base = args.api_base
+    answer_cache = None
+    if args.answer_cache_threshold is not None:
+        answer_cache = SemanticAnswerCache(args.answer_cache_threshold, cache_path=args.answer_cache_path)
+    retrieval_args = RetrievalArgs(warm_up_query_embedding_model=True)
+    document_retriever = None
+    if args.onnx_encoder_dir:
+        from onnx_query_encoder import load_onnx_document_retriever
+        document_retriever = load_onnx_document_retriever(retrieval_args, args.onnx_encoder_dir,
+                                                          not args.onnx_float32, args.encoder_threads)
+    server = PubMedAgentServer(
+        OpenAIPubMedAgent(retrieval_args=retrieval_args, document_retriever=document_retriever,
+                          max_concurrent_requests=args.max_concurrent_requests, answer_cache=answer_cache),
+        args.max_batch_size, args.max_wait_ms, SamplingProfiler().start() if args.profile else None
+    )
+    web.run_app(server.make_app(), host=args.host, port=args.port)
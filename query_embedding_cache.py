@@ -0,0 +1,194 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+
+KEY_SIZE = 16
+MAX_PROBES = 8
+# Query embedding models whose tokenizer lower cases its input, told by name so the model does not need to be loaded.
+LOWER_CASING_MODEL_NAMES = {'all-mpnet-base-v2', 'sentence-transformers/all-mpnet-base-v2'}
+
+
+def is_lower_casing_encoder(query_embedding_model: Any = None, model_name: str = None) -> bool:
+    '''Whether the encoder lower cases the queries itself, read from the do_lower_case flag of the model or of its
+    tokenizer when it has one, otherwise from the name of the model.
+    '''
+    for owner in (query_embedding_model, getattr(query_embedding_model, 'tokenizer', None)):
+        do_lower_case = getattr(owner, 'do_lower_case', None)
+        if isinstance(do_lower_case, bool):
+            return do_lower_case
+    return model_name in LOWER_CASING_MODEL_NAMES
+
+
+def normalize_query(query: str, lowercase: bool = False) -> str:
+    '''Queries differing only in whitespace share an embedding, and only in case too when the encoder lower cases its
+    input anyway.
+    '''
+    query = ' '.join(query.split())
+    return query.lower() if lowercase else query
+
+
+def get_query_key(model_name: str, query: str, lowercase: bool = False) -> bytes:
+    # The casing is part of the key so the lower cased queries never share entries with the cased ones.
+    key = f"{model_name}\0{'uncased' if lowercase else 'cased'}\0{normalize_query(query, lowercase)}"
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=KEY_SIZE).digest()
+
+
+class DiskQueryEmbeddingStore:
+    '''Fixed capacity open addressing hash table of query embeddings in two memory mapped files (keys and vectors), so
+    entries survive restarts and are shared by every worker process mapping the same directory. Writers serialize on a
+    file lock, clear the key of the slot, write the vector and then the new key. Readers do not lock: they copy the
+    vector and check the key of the slot again, so a vector being overwritten by another query is a miss instead of a
+    wrong embedding. When all the probed slots of a key are taken, the first one is overwritten.
+    '''
+
+    def __init__(self, cache_dir: str, model_name: str, dim: int, capacity: int = 100_000):
+        os.makedirs(cache_dir, exist_ok=True)
+        model_slug = model_name.replace('/', '_')
+        base_path = os.path.join(cache_dir, model_slug)
+        meta_path = base_path + '.meta.json'
+        self._lock_path = base_path + '.lock'
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.exists(meta_path):
+                with open(meta_path, 'r') as f:
+                    meta = json.loads(f.read())
+                if meta['dim'] != dim:
+                    raise ValueError(f"Query embedding cache at {base_path} stores {meta['dim']} dimensional embeddings "
+                                     f"but {model_name} produces {dim} dimensional embeddings")
+                capacity = meta['capacity']
+                mode = 'r+'
+            else:
+                mode = 'w+'
+            self.keys = np.memmap(base_path + '.keys', dtype=np.uint8, mode=mode, shape=(capacity, KEY_SIZE))
+            self.vectors = np.memmap(base_path + '.vectors', dtype=np.float32, mode=mode, shape=(capacity, dim))
+            if mode == 'w+':
+                with open(meta_path, 'w') as f:
+                    f.write(json.dumps({'model_name': model_name, 'dim': dim, 'capacity': capacity}))
+        self.capacity = capacity
+
+    def _probe_slots(self, key: bytes):
+        home = int.from_bytes(key[:8], 'little') % self.capacity
+        return [(home + probe) % self.capacity for probe in range(min(MAX_PROBES, self.capacity))]
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        key_array = np.frombuffer(key, dtype=np.uint8)
+        for slot in self._probe_slots(key):
+            slot_key = self.keys[slot]
+            if np.array_equal(slot_key, key_array):
+                embedding = np.array(self.vectors[slot])
+                return embedding if np.array_equal(self.keys[slot], key_array) else None
+            if not slot_key.any():
+                return None
+        return None
+
+    def put(self, key: bytes, embedding: np.ndarray):
+        key_array = np.frombuffer(key, dtype=np.uint8)
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            slots = self._probe_slots(key)
+            target = slots[0]
+            for slot in slots:
+                slot_key = self.keys[slot]
+                if not slot_key.any() or np.array_equal(slot_key, key_array):
+                    target = slot
+                    break
+            self.keys[target] = 0
+            self.vectors[target] = embedding
+            self.keys[target] = key_array
+
+
+class QueryEmbeddingCache:
+    '''Two level cache of query embeddings keyed by the model name and the normalized query text: a bounded in process
+    LRU in front of an optional DiskQueryEmbeddingStore. The queries are only lower cased for an encoder lower casing
+    its input, see is_lower_casing_encoder.
+    '''
+
+    def __init__(self, model_name: str, max_entries: int = 10000, disk_cache_dir: str = None,
+                 disk_capacity: int = 100_000, lowercase: bool = False):
+        self.model_name = model_name
+        self.lowercase = lowercase
+        self.max_entries = max_entries
+        self.disk_cache_dir = disk_cache_dir
+        self.disk_capacity = disk_capacity
+        self.disk_store = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _get_disk_store(self, dim: int) -> Optional[DiskQueryEmbeddingStore]:
+        if self.disk_cache_dir is None:
+            return None
+        if self.disk_store is None:
+            self.disk_store = DiskQueryEmbeddingStore(self.disk_cache_dir, self.model_name, dim, self.disk_capacity)
+        return self.disk_store
+
+    def _put_in_memory(self, key: bytes, embedding: np.ndarray):
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, query: str, dim: int = None) -> Optional[np.ndarray]:
+        '''Returns the cached, read only, embedding of the query or None. The disk store is only opened once the
+        embedding dimension is known, either from dim or from the first put.
+        '''
+        key = get_query_key(self.model_name, query, self.lowercase)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+
+        disk_store = self.disk_store if dim is None else self._get_disk_store(dim)
+        if disk_store is not None:
+            embedding = disk_store.get(key)
+            if embedding is not None:
+                embedding.setflags(write=False)
+                self._put_in_memory(key, embedding)
+                with self._lock:
+                    self.disk_hits += 1
+                return embedding
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, query: str, embedding: np.ndarray):
+        key = get_query_key(self.model_name, query, self.lowercase)
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.setflags(write=False)
+        self._put_in_memory(key, embedding)
+        disk_store = self._get_disk_store(embedding.shape[-1])
+        if disk_store is not None:
+            disk_store.put(key, embedding)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_stats(self):
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'memory_entries': len(self),
+        }
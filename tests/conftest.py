@@ -0,0 +1,139 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from paper_index_map import PaperIndexMap  # noqa: E402
+
+WORDS = ['lymphatic', 'vessels', 'chemokine', 'ccr7', 'il-6', 'tnf-alpha', 'metastasis', 'leukocyte', 'traffic',
+         'tumor', 'endothelial', 'cells', 'receptor', 'expression', 'mice', 'patients', 'therapy', 'dose', 'cancer',
+         'inflammation', 'the', 'of', 'and', 'in', 'with', 'cxcl12', 'p53', 'brca1', 'insulin', 'glucose']
+
+
+def write_cleaned_text(folder_path: str, papers_by_file: dict):
+    '''Writes the cleaned text split files, one json dict of paper name -> abstract and main_body per file.
+    '''
+    os.makedirs(folder_path, exist_ok=True)
+    for file_name, papers in papers_by_file.items():
+        with open(os.path.join(folder_path, file_name), 'w') as f:
+            f.write(json.dumps(papers))
+
+
+def make_papers(num_papers: int, seed: int = 0, num_files: int = 2) -> dict:
+    rng = np.random.default_rng(seed)
+    papers_by_file = {f'split_{file_idx}.jsonl': {} for file_idx in range(num_files)}
+    for paper_idx in range(num_papers):
+        abstract = ' '.join(rng.choice(WORDS, size=int(rng.integers(5, 40))))
+        body = '\n'.join(' '.join(rng.choice(WORDS, size=12)) for _ in range(int(rng.integers(1, 6))))
+        papers_by_file[f'split_{paper_idx % num_files}.jsonl'][f'PMC{paper_idx:06d}.txt'] = {
+            'abstract': abstract, 'main_body': body,
+        }
+    return papers_by_file
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    '''A small cleaned text corpus with its paper index map, where paper i of the map is PMC{i:06d}.txt.
+    '''
+    papers_by_file = make_papers(120)
+    cleaned_text_path = str(tmp_path / 'cleaned_text')
+    write_cleaned_text(cleaned_text_path, papers_by_file)
+    paper_file_names = sorted((paper_name, file_name) for file_name, papers in papers_by_file.items()
+                              for paper_name in papers)
+    paper_index_map_path = str(tmp_path / 'paper_index_map')
+    PaperIndexMap.from_paper_file_names(paper_file_names).save(paper_index_map_path)
+    return {
+        'papers_by_file': papers_by_file,
+        'paper_file_names': paper_file_names,
+        'cleaned_text_path': cleaned_text_path,
+        'paper_text_store_path': str(tmp_path / 'paper_text_store'),
+        'paper_index_map_path': paper_index_map_path,
+        'tmp_path': tmp_path,
+    }
+
+
+class CountingEncoder:
+    '''Wraps the benchmark SyntheticEncoder and counts the texts it encodes.
+    '''
+
+    def __init__(self, dim: int = 32):
+        from benchmark import SyntheticEncoder
+        self.encoder = SyntheticEncoder(dim=dim)
+        self.model_name = self.encoder.model_name
+        self.num_encoded_texts = 0
+
+    def encode(self, sentences, *args, **kwargs):
+        self.num_encoded_texts += 1 if isinstance(sentences, str) else len(sentences)
+        return self.encoder.encode(sentences, *args, **kwargs)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.encoder.get_sentence_embedding_dimension()
+
+
+@pytest.fixture
+def make_retriever(corpus):
+    '''Embeds the corpus with a CountingEncoder and returns a function building a DocumentRetriever over it with an
+    exact vector index, so the retrieval runs without any model download.
+    '''
+    from benchmark import embed_corpus
+    from document_retriever import DocumentRetriever, RetrievalArgs
+    from embedding_store import read_all_abstract_embeddings
+    from vector_index import EXACT_BACKEND, ExactVectorIndex
+
+    encoder = CountingEncoder()
+    embeddings_path = str(corpus['tmp_path'] / 'paper_embedding')
+    embed_corpus(corpus['cleaned_text_path'], embeddings_path, encoder)
+    paper_file_names, embeddings = read_all_abstract_embeddings(embeddings_path)
+    arrays_path = str(corpus['tmp_path'] / 'embedding_paper_index_map')
+    PaperIndexMap.from_paper_file_names(paper_file_names).save(arrays_path)
+
+    def _make_retriever(**kwargs):
+        vector_db = ExactVectorIndex()
+        vector_db.build(embeddings)
+        retrieval_args = RetrievalArgs(
+            vector_db_index_to_papers_map_file_path=None, vector_db_index_to_papers_arrays_path=arrays_path,
+            paper_text_files_path=corpus['cleaned_text_path'], paper_text_store_path=corpus['paper_text_store_path'],
+            vector_db_backend=EXACT_BACKEND, embeddings_folder_path=embeddings_path,
+            **{'query_embedding_cache_size': 0, 'lexical_index_path': None, **kwargs}
+        )
+        encoder.num_encoded_texts = 0
+        return DocumentRetriever(retrieval_args, encoder, vector_db)
+
+    _make_retriever.encoder = encoder
+    return _make_retriever
+
+
+@pytest.fixture
+def fake_openai():
+    '''The fake chat completion server of fake_openai_server.py, set as the openai api base for the test.
+    '''
+    import openai
+    from fake_openai_server import FakeCompletionConfig, start_fake_openai_server
+
+    server, api_base = start_fake_openai_server(FakeCompletionConfig(first_token_latency=0.0, inter_token_latency=0.0))
+    previous_api_base, previous_api_key = openai.api_base, openai.api_key
+    openai.api_base, openai.api_key = api_base, 'test'
+    yield server
+    openai.api_base, openai.api_key = previous_api_base, previous_api_key
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_agent(make_retriever, fake_openai):
+    '''Returns a function building an agent over the test corpus that answers through the fake server, with the
+    benchmark's ApproximateTokenizer so no tiktoken encoding is downloaded.
+    '''
+    from benchmark import ApproximateTokenizer
+    from chat_agent import OpenAIPubMedAgent
+    from prompt_builder import PromptBuilder
+
+    def _make_agent(**kwargs):
+        return OpenAIPubMedAgent(document_retriever=make_retriever(),
+                                 prompt_builder=PromptBuilder(tokenizer=ApproximateTokenizer()), **kwargs)
+
+    return _make_agent
@@ -0,0 +1,62 @@
+import sqlite3
+import time
+
+import numpy as np
+
+from answer_cache import SemanticAnswerCache, make_answer_cache_key
+
+
+def _embedding(seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).normal(size=16).astype(np.float32)
+
+
+def _response(idx: int) -> dict:
+    return {'role': 'assistant', 'content': f'answer {idx}'}
+
+
+def _num_rows(cache_path: str) -> int:
+    with sqlite3.connect(cache_path) as db:
+        return db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+
+def test_similar_question_of_the_same_key_hits():
+    cache = SemanticAnswerCache(similarity_threshold=0.95)
+    key = make_answer_cache_key('gpt-3.5-turbo', ['PMC2.txt', 'PMC1.txt'], 'template')
+    assert key == make_answer_cache_key('gpt-3.5-turbo', ['PMC1.txt', 'PMC2.txt'], 'template')
+    cache.put(key, 'question', _embedding(0), _response(0))
+    assert cache.get(key, _embedding(0) * 2) == _response(0)
+    assert cache.get(key, _embedding(1)) is None
+    assert cache.get(make_answer_cache_key('gpt-4', ['PMC1.txt'], 'template'), _embedding(0)) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_evicted_entries_are_deleted_from_the_database(tmp_path):
+    cache_path = str(tmp_path / 'answer_cache.sqlite')
+    cache = SemanticAnswerCache(max_entries=3, cache_path=cache_path)
+    for idx in range(5):
+        cache.put(f'key{idx}', f'question {idx}', _embedding(idx), _response(idx))
+    assert len(cache) == 3 and cache.evictions == 2
+    assert _num_rows(cache_path) == 3
+
+    reloaded_cache = SemanticAnswerCache(max_entries=3, cache_path=cache_path)
+    assert reloaded_cache.get('key4', _embedding(4)) == _response(4)
+    assert reloaded_cache.get('key0', _embedding(0)) is None
+
+
+def test_table_is_trimmed_on_load(tmp_path):
+    cache_path = str(tmp_path / 'answer_cache.sqlite')
+    cache = SemanticAnswerCache(max_entries=10, cache_path=cache_path)
+    for idx in range(8):
+        cache.put(f'key{idx}', f'question {idx}', _embedding(idx), _response(idx))
+
+    reloaded_cache = SemanticAnswerCache(max_entries=3, cache_path=cache_path)
+    assert len(reloaded_cache) == 3
+    assert _num_rows(cache_path) == 3
+    assert reloaded_cache.get('key7', _embedding(7)) == _response(7)
+
+
+def test_expired_entries_miss():
+    cache = SemanticAnswerCache(ttl_seconds=0.01)
+    cache.put('key', 'question', _embedding(0), _response(0))
+    time.sleep(0.02)
+    assert cache.get('key', _embedding(0)) is None
@@ -0,0 +1,48 @@
+import os
+
+from benchmark import BenchmarkConfig, SyntheticEncoder, benchmark_agent, benchmark_retrieval, build_vector_dbs, \
+    compare_results, embed_corpus, generate_synthetic_corpus, make_questions
+from document_retriever import DocumentRetriever, RetrievalArgs
+from vector_index import ANNOY_BACKEND, EXACT_BACKEND
+
+
+def test_retrieval_benchmark_on_a_small_synthetic_corpus(tmp_path):
+    config = BenchmarkConfig(num_papers=200, papers_per_file=100, abstract_words=40, body_lines=5, vocabulary_size=2000,
+                             num_topics=10, num_trees=10, num_queries=20)
+    encoder = SyntheticEncoder(seed=config.seed)
+    cleaned_text_folder_path = str(tmp_path / 'cleaned_text')
+    assert len(generate_synthetic_corpus(cleaned_text_folder_path, config)) == 200
+    assert embed_corpus(cleaned_text_folder_path, str(tmp_path / 'paper_embedding'), encoder) == 200
+    paths = build_vector_dbs(str(tmp_path), config)['paths']
+
+    def make_retriever(backend: str) -> DocumentRetriever:
+        retrieval_args = RetrievalArgs(
+            trained_vector_db_file_path=paths[backend], vector_db_index_to_papers_map_file_path=paths['json_map'],
+            vector_db_index_to_papers_arrays_path=paths['arrays_map'], paper_text_files_path=cleaned_text_folder_path,
+            paper_text_store_path=os.path.join(str(tmp_path), 'paper_text_store'), top_k=config.top_k,
+            vector_db_backend=backend, embeddings_folder_path=paths['embeddings'], query_embedding_cache_size=0,
+        )
+        return DocumentRetriever(retrieval_args, encoder)
+
+    questions = make_questions(cleaned_text_folder_path, config.num_queries, config.seed)
+    retrieval = benchmark_retrieval(make_retriever(ANNOY_BACKEND), make_retriever(EXACT_BACKEND), questions,
+                                    config.top_k)
+    assert retrieval['recall@5'] >= 0.8
+    assert retrieval['source_paper_hit@5'] >= 0.8
+    assert retrieval['latency']['search']['count'] == config.num_queries
+
+
+def test_agent_benchmark_runs_offline(make_retriever):
+    config = BenchmarkConfig(first_token_latency=0.0, inter_token_latency=0.0, concurrency=2)
+    questions = [{'question': question} for question in ('role of il-6', 'ccr7 in lymphatic vessels')]
+    agent_results = benchmark_agent(make_retriever(), questions, config)
+    assert agent_results['latency']['arun_concurrent']['count'] == len(questions)
+    assert agent_results['mean_prompt_tokens'] > 0
+
+
+def test_compare_results_reports_relative_changes():
+    baseline = {'build': {'embedding': 2.0}, 'retrieval': {'recall@5': 0.5, 'latency': {'p50_ms': 0.0}}}
+    results = {'build': {'embedding': 1.0}, 'retrieval': {'recall@5': 0.6, 'latency': {'p50_ms': 1.0}}, 'agent': {},
+               'peak_rss_bytes': 10}
+    changes = compare_results(baseline, results)
+    assert changes == {'build.embedding': -0.5, 'retrieval.recall@5': 0.6 / 0.5 - 1}
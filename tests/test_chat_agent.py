@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+from fake_openai_server import DEFAULT_FAKE_RESPONSE
+
+
+def test_run_sends_the_completion_reservation(make_agent, fake_openai):
+    agent = make_agent()
+    response, chat_history = agent.run('role of il-6 in lymphatic vessels')
+    assert response['content'] == DEFAULT_FAKE_RESPONSE
+    assert chat_history[-1] == {'role': 'assistant', 'content': DEFAULT_FAKE_RESPONSE}
+    request = fake_openai.received_requests[-1]
+    assert request['model'] == agent.model_name
+    assert request['max_tokens'] == agent.prompt_builder.max_completion_tokens
+    report = agent.token_reports[-1]
+    assert report.prompt_tokens <= agent.prompt_builder.context_windows[agent.model_name] - request['max_tokens']
+
+
+def test_run_stream_yields_the_whole_answer(make_agent, fake_openai):
+    agent = make_agent()
+    answer_stream = agent.run_stream('role of il-6 in lymphatic vessels')
+    deltas = []
+    try:
+        while True:
+            deltas.append(next(answer_stream))
+    except StopIteration as stop:
+        response, _ = stop.value
+    assert ''.join(deltas) == response['content'] == DEFAULT_FAKE_RESPONSE
+    assert fake_openai.received_requests[-1]['stream'] is True
+    assert fake_openai.received_requests[-1]['max_tokens'] == agent.prompt_builder.max_completion_tokens
+
+
+def test_arun_answers_concurrent_sessions(make_agent, fake_openai):
+    agent = make_agent()
+
+    async def ask(question, session_id):
+        response, _ = await agent.arun(question, session_id=session_id)
+        return response['content']
+
+    async def ask_concurrently():
+        try:
+            return await asyncio.gather(*[ask(f'chemokine receptor {idx}', f'session-{idx}') for idx in range(4)])
+        finally:
+            await agent.aclose()
+
+    assert asyncio.run(ask_concurrently()) == [DEFAULT_FAKE_RESPONSE] * 4
+    assert len(fake_openai.received_requests) == 4
+    assert all(agent.get_session(f'session-{idx}').passages for idx in range(4))
+    agent.end_session('session-0')
+    assert 'session-0' not in agent.sessions
+
+
+def test_arun_across_event_loops(make_agent, fake_openai):
+    agent = make_agent()
+
+    async def ask(question, session_id):
+        response, _ = await agent.arun(question, session_id=session_id)
+        return response['content']
+
+    async def ask_concurrently():
+        return await asyncio.gather(*[ask(f'chemokine receptor {idx}', f'session-{idx}') for idx in range(4)])
+
+    assert asyncio.run(ask_concurrently()) == [DEFAULT_FAKE_RESPONSE] * 4
+
+    async def ask_and_close():
+        try:
+            return await ask('tumor metastasis', 'session-0')
+        finally:
+            await agent.aclose()
+
+    assert asyncio.run(ask_and_close()) == DEFAULT_FAKE_RESPONSE
+    assert agent._http_session is None and agent._retrieval_executor is None
+    assert asyncio.run(ask_and_close()) == DEFAULT_FAKE_RESPONSE
+    assert len(fake_openai.received_requests) == 6
+
+
+def test_least_recently_used_sessions_are_evicted(make_agent):
+    agent = make_agent(max_sessions=2)
+    for session_id in ('a', 'b', 'a', 'c'):
+        agent.get_session(session_id)
+    assert list(agent.sessions) == ['a', 'c']
+    agent.end_session('a')
+    assert list(agent.sessions) == ['c']
+
+
+def test_idle_sessions_are_evicted(make_agent):
+    agent = make_agent(session_ttl_seconds=60)
+    agent.get_session('a').passages = ['passage']
+    agent.get_session('b')
+    agent.sessions['a'].last_used_time -= 120
+    agent.get_session('c')
+    assert list(agent.sessions) == ['b', 'c']
+    assert agent.get_session('a').passages == []
+
+
+def test_answer_cache_hits_record_a_zero_token_report(make_agent, fake_openai):
+    from answer_cache import SemanticAnswerCache
+
+    agent = make_agent(answer_cache=SemanticAnswerCache())
+    question = 'role of il-6 in lymphatic vessels'
+    agent.run(question)
+    assert agent.token_reports[-1].prompt_tokens > 0 and not agent.token_reports[-1].answer_cache_hit
+
+    response, _ = agent.run(question)
+    response_stream = agent.run_stream(question)
+    assert ''.join(response_stream) == response['content'] == DEFAULT_FAKE_RESPONSE
+    asyncio.run(agent.arun(question))
+    assert len(fake_openai.received_requests) == 1
+    assert len(agent.token_reports) == 4
+    for report in list(agent.token_reports)[1:]:
+        assert report.answer_cache_hit
+        assert (report.prompt_tokens, report.completion_tokens) == (0, 0)
+
+
+def test_only_the_last_token_reports_are_kept(make_agent, monkeypatch):
+    import chat_agent
+
+    monkeypatch.setattr(chat_agent, 'MAX_TOKEN_REPORTS', 2)
+    agent = make_agent()
+    for question in ('role of il-6', 'ccr7 and lymphatic vessels', 'tumor metastasis'):
+        agent.run(question)
+    assert len(agent.token_reports) == 2
+
+
+def test_max_sessions_must_be_positive(make_agent):
+    with pytest.raises(ValueError, match='max_sessions'):
+        make_agent(max_sessions=0)
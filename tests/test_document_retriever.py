@@ -0,0 +1,185 @@
+import numpy as np
+import pytest
+
+from conftest import write_cleaned_text
+
+QUERIES = ['ccr7 in lymphatic vessels', 'insulin and glucose in patients', 'p53 tumor therapy']
+
+
+def test_batch_retrieval_matches_single_queries(make_retriever, corpus):
+    retriever = make_retriever(top_k=4)
+    results = retriever.retrieve_candidate_papers_for_queries(QUERIES)
+    assert make_retriever.encoder.num_encoded_texts == len(QUERIES)
+    assert [result.papers for result in results] == [retriever.retrieve_candidate_papers_for_query(query)
+                                                     for query in QUERIES]
+    assert all(len(result.indexes) == len(result.scores) == 4 for result in results)
+    assert all(tuple(paper) in corpus['paper_file_names'] for result in results for paper in result.papers)
+
+    query_embeddings = retriever.parse_queries_to_embeddings(QUERIES)
+    assert retriever.retrieve_candidate_papers_for_queries(query_embeddings) == results
+    assert retriever.retrieve_candidate_papers_for_query(query_embeddings[1]) == results[1].papers
+    assert retriever.retrieve_candidate_papers_for_queries([]) == []
+
+
+def test_repeated_queries_are_encoded_once(make_retriever):
+    retriever = make_retriever(query_embedding_cache_size=10)
+    query_embedding = retriever.parse_query_to_embedding(QUERIES[0])
+    np.testing.assert_array_equal(retriever.parse_query_to_embedding(QUERIES[0]), query_embedding)
+    assert make_retriever.encoder.num_encoded_texts == 1
+
+    query_embeddings = retriever.parse_queries_to_embeddings(QUERIES)
+    assert make_retriever.encoder.num_encoded_texts == len(QUERIES)
+    np.testing.assert_array_equal(query_embeddings[0], query_embedding)
+    assert retriever.query_embedding_cache.get_stats()['memory_hits'] == 2
+
+
+def test_injected_model_names_the_query_embedding_cache(make_retriever):
+    retriever = make_retriever(query_embedding_cache_size=10)
+    assert retriever.query_embedding_cache.model_name == make_retriever.encoder.model_name
+    retriever.model = object()
+    assert retriever.query_embedding_cache is None
+
+
+def test_cached_query_embedding_does_not_load_the_model(make_retriever, monkeypatch):
+    import document_retriever
+
+    retriever = make_retriever(query_embedding_cache_size=10)
+    query_embedding = retriever.parse_query_to_embedding('ccr7 in lymphatic vessels')
+    retriever._model = None
+
+    def _load_query_embedding_model(model_name):
+        raise AssertionError(f"{model_name} was loaded for a cached query")
+
+    monkeypatch.setattr(document_retriever, 'load_query_embedding_model', _load_query_embedding_model)
+    np.testing.assert_array_equal(retriever.parse_query_to_embedding('ccr7 in lymphatic vessels'), query_embedding)
+    assert retriever.parse_queries_to_embeddings([]).shape == (0, len(query_embedding))
+
+
+def _get_passage_embeddings(retriever, paper_file_name):
+    paper = retriever.get_papers([paper_file_name])[0]
+    return retriever._get_passage_embeddings(paper_file_name, paper['abstract'], paper['main_body'].splitlines())
+
+
+def test_stored_passage_embeddings_are_used(make_retriever, corpus):
+    retriever = make_retriever()
+    paper_file_name = corpus['paper_file_names'][3]
+    _, body_embeddings = _get_passage_embeddings(retriever, paper_file_name)
+    body = corpus['papers_by_file'][paper_file_name[1]][paper_file_name[0]]['main_body']
+    assert len(body_embeddings) == len(body.splitlines())
+    assert make_retriever.encoder.num_encoded_texts == 0
+
+
+def test_passages_are_merged_line_windows_in_descending_score(make_retriever, corpus):
+    retriever = make_retriever(top_k=5)
+    candidate_papers = retriever.retrieve_candidate_papers_for_query(QUERIES[0])
+    passages = retriever.retrieve_passages_for_query(QUERIES[0], candidate_papers, num_passages=6, window=1)
+    assert passages
+    assert [passage.score for passage in passages] == sorted((passage.score for passage in passages), reverse=True)
+
+    line_ranges = {}
+    for passage in passages:
+        paper_name, file_name = passage.paper_file_name
+        paper = corpus['papers_by_file'][file_name][paper_name]
+        if passage.section == 'abstract':
+            assert passage.text == paper['abstract']
+            continue
+        assert passage.text == '\n'.join(paper['main_body'].splitlines()[passage.start_line:passage.end_line])
+        line_ranges.setdefault(paper_name, []).append((passage.start_line, passage.end_line))
+    for paper_line_ranges in line_ranges.values():
+        paper_line_ranges.sort()
+        assert all(end < next_start for (_, end), (next_start, _) in zip(paper_line_ranges, paper_line_ranges[1:]))
+
+    context = retriever.build_passage_context(passages)
+    paper_names = [passage.paper_file_name[0] for passage in passages]
+    assert context.count('PAPER: ') == len(set(paper_names))
+    assert context.startswith(f'PAPER: {paper_names[0]}\n')
+
+
+def test_query_embedding_model_is_loaded_on_first_use(make_retriever, monkeypatch):
+    import document_retriever
+
+    loaded_model_names = []
+
+    def _load_query_embedding_model(model_name):
+        loaded_model_names.append(model_name)
+        return make_retriever.encoder
+
+    monkeypatch.setattr(document_retriever, 'load_query_embedding_model', _load_query_embedding_model)
+    retriever = make_retriever()
+    retriever._model = None
+    assert loaded_model_names == []
+    retriever.parse_query_to_embedding(QUERIES[0])
+    retriever.parse_query_to_embedding(QUERIES[1])
+    assert loaded_model_names == [retriever.query_embedding_model_name]
+    assert 'query_embedding_model' in retriever.startup_timings
+
+
+def test_edited_paper_with_the_same_line_count_is_encoded_once(make_retriever, corpus):
+    paper_name, file_name = paper_file_name = corpus['paper_file_names'][3]
+    paper = corpus['papers_by_file'][file_name][paper_name]
+    edited_lines = [f'edited line {line_idx} about insulin' for line_idx in range(len(paper['main_body'].splitlines()))]
+    paper['main_body'] = '\n'.join(edited_lines)
+    write_cleaned_text(corpus['cleaned_text_path'], corpus['papers_by_file'])
+
+    retriever = make_retriever()
+    _, body_embeddings = _get_passage_embeddings(retriever, paper_file_name)
+    expected = make_retriever.encoder.encoder.encode(edited_lines, normalize_embeddings=True)
+    np.testing.assert_allclose(body_embeddings, expected, rtol=1e-5, atol=1e-6)
+    num_encoded_texts = make_retriever.encoder.num_encoded_texts
+    assert num_encoded_texts == 1 + len(edited_lines)
+
+    _get_passage_embeddings(retriever, paper_file_name)
+    assert make_retriever.encoder.num_encoded_texts == num_encoded_texts
+
+
+def test_lexical_index_is_fused_with_the_dense_search(make_retriever, corpus):
+    from lexical_index import BM25Index
+
+    lexical_index_path = str(corpus['tmp_path'] / 'lexical_index')
+    BM25Index.build(lexical_index_path, corpus['paper_text_store_path'], corpus['cleaned_text_path'],
+                    str(corpus['tmp_path'] / 'embedding_paper_index_map'), None, num_workers=1)
+    dense_retriever = make_retriever(top_k=4)
+    retriever = make_retriever(top_k=4, lexical_index_path=lexical_index_path, fusion_depth=10)
+    assert retriever.lexical_index is not None and dense_retriever.lexical_index is None
+
+    results = retriever.retrieve_candidate_papers_for_queries(QUERIES)
+    assert [result.papers for result in results] == [retriever.retrieve_candidate_papers_for_query(query)
+                                                     for query in QUERIES]
+    assert [result.papers for result in results] != [dense_retriever.retrieve_candidate_papers_for_query(query)
+                                                     for query in QUERIES]
+    query_embeddings = retriever.parse_queries_to_embeddings(QUERIES)
+    assert retriever.retrieve_candidate_papers_for_queries(query_embeddings) == \
+        dense_retriever.retrieve_candidate_papers_for_queries(query_embeddings)
+
+
+def test_lexical_index_of_another_paper_index_map_is_not_used(make_retriever, corpus):
+    from lexical_index import BM25Index
+
+    lexical_index_path = str(corpus['tmp_path'] / 'lexical_index')
+    BM25Index.build(lexical_index_path, corpus['paper_text_store_path'], corpus['cleaned_text_path'],
+                    corpus['paper_index_map_path'], None, num_workers=1)
+    with pytest.warns(UserWarning, match='another paper index map'):
+        retriever = make_retriever(lexical_index_path=lexical_index_path)
+    assert retriever.lexical_index is None
+
+
+def test_same_paper_name_in_two_files_are_two_papers(tmp_path):
+    from document_retriever import DocumentRetriever, Passage
+    from embedding_store import PaperEmbeddingLookup, write_embedding_split
+
+    embeddings_path = str(tmp_path / 'paper_embedding')
+    for split_name, file_name, value in (('split_a_1', 'split_a.jsonl', 1.0), ('split_b_1', 'split_b.jsonl', 2.0)):
+        write_embedding_split(embeddings_path, split_name, file_name, ['PMC1.txt'], np.full((1, 4), value),
+                              [np.full((2, 4), value)], 'test-model', 4)
+    paper_embedding_lookup = PaperEmbeddingLookup(embeddings_path)
+    assert paper_embedding_lookup.get_abstract_embedding(('PMC1.txt', 'split_a.jsonl'))[0] == 1.0
+    assert paper_embedding_lookup.get_body_embeddings(('PMC1.txt', 'split_b.jsonl'))[0, 0] == 2.0
+    assert ('PMC1.txt', 'split_c.jsonl') not in paper_embedding_lookup
+
+    context = DocumentRetriever.build_passage_context([
+        Passage(('PMC1.txt', 'split_a.jsonl'), 'abstract', 0.9, 'abstract of a'),
+        Passage(('PMC1.txt', 'split_b.jsonl'), 'abstract', 0.8, 'abstract of b'),
+        Passage(('PMC1.txt', 'split_a.jsonl'), 'main_body', 0.7, 'body of a', 0, 1),
+    ])
+    assert context.split('\n[SEP]\n') == ["PAPER: PMC1.txt\nabstract of a\n[...]\nbody of a",
+                                          "PAPER: PMC1.txt\nabstract of b"]
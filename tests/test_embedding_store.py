@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from embedding_store import list_embedding_splits, read_all_abstract_embeddings, read_embedding_split, \
+    write_embedding_split
+
+DIM = 4
+
+
+def test_round_trip(tmp_path):
+    abstract_embeddings = np.arange(3 * DIM, dtype=np.float32).reshape(3, DIM)
+    body_embeddings = [np.ones((2, DIM)), np.zeros((0, DIM)), np.full((1, DIM), 2.0)]
+    write_embedding_split(str(tmp_path), 'split_a_1', 'a.jsonl', ['p1', 'p2', 'p3'], abstract_embeddings,
+                          body_embeddings, 'test-model', DIM, dtype='float16')
+    assert list_embedding_splits(str(tmp_path)) == ['split_a_1']
+
+    split = read_embedding_split(str(tmp_path), 'split_a_1')
+    assert (split.model_name, split.dim, split.dtype, split.source_file) == ('test-model', DIM, 'float16', 'a.jsonl')
+    assert split.paper_ids == ['p1', 'p2', 'p3']
+    np.testing.assert_array_equal(split.abstract_embeddings, abstract_embeddings)
+    for paper_idx, body_embedding in enumerate(body_embeddings):
+        np.testing.assert_array_equal(split.get_body_embeddings(paper_idx), body_embedding)
+
+
+def test_dimension_mismatch_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        write_embedding_split(str(tmp_path), 'split_a_1', 'a.jsonl', ['p1'], np.zeros((1, DIM)),
+                              [np.zeros((0, DIM))], 'test-model', DIM + 1)
+    with pytest.raises(ValueError):
+        write_embedding_split(str(tmp_path), 'split_a_1', 'a.jsonl', ['p1'], np.zeros((1, DIM)),
+                              [np.zeros((2, DIM + 1))], 'test-model', DIM)
+    assert list_embedding_splits(str(tmp_path)) == []
+
+
+def test_read_all_abstract_embeddings(tmp_path):
+    write_embedding_split(str(tmp_path), 'split_a_1', 'a.jsonl', ['p1', 'p2'], np.zeros((2, DIM)),
+                          [np.zeros((0, DIM))] * 2, 'test-model', DIM)
+    write_embedding_split(str(tmp_path), 'split_b_1', 'b.jsonl', ['p1'], np.ones((1, DIM)), [np.zeros((0, DIM))],
+                          'test-model', DIM, dtype='float16')
+    paper_file_names, embeddings = read_all_abstract_embeddings(str(tmp_path))
+    assert paper_file_names == [('p1', 'a.jsonl'), ('p2', 'a.jsonl'), ('p1', 'b.jsonl')]
+    assert embeddings.dtype == np.float32
+    np.testing.assert_array_equal(embeddings, [[0] * DIM, [0] * DIM, [1] * DIM])
+
+    write_embedding_split(str(tmp_path), 'split_c_1', 'c.jsonl', ['p3'], np.ones((1, DIM)), [np.zeros((0, DIM))],
+                          'another-model', DIM)
+    with pytest.raises(ValueError):
+        read_all_abstract_embeddings(str(tmp_path))
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+
+import constants
+from embedding_store import write_embedding_split
+from embedding_vector_db import AnnoyConfig, add_new_papers_to_vector_dbs, create_and_store_embedding_idx_paper_map, \
+    create_and_train_annoy_vector_db, create_and_train_exact_vector_db, save_serialized_index
+from paper_index_map import PaperIndexMap
+
+DIM = 8
+
+
+def _write_split(folder_path, split_name, source_file, paper_ids, seed):
+    embeddings = np.random.default_rng(seed).normal(size=(len(paper_ids), DIM)).astype(np.float32)
+    write_embedding_split(folder_path, split_name, source_file, paper_ids, embeddings,
+                          [np.zeros((0, DIM), dtype=np.float32)] * len(paper_ids), 'test-model', DIM)
+    return dict(zip(((paper_id, source_file) for paper_id in paper_ids), embeddings))
+
+
+def _build(tmp_path):
+    embeddings_folder = str(tmp_path / 'embeddings')
+    paths = {
+        'map_path': str(tmp_path / 'map.json'),
+        'arrays_path': str(tmp_path / 'map_arrays'),
+        'annoy_folder': str(tmp_path / 'annoy'),
+        'exact_path': str(tmp_path / 'vector_db' / constants.EXACT_DATASET_FILE_NAME),
+    }
+    embedding_by_paper = _write_split(embeddings_folder, 'split_a_1', 'file_a.txt', ['p1', 'p2'], seed=0)
+    embedding_by_paper.update(_write_split(embeddings_folder, 'split_b_1', 'file_b.txt', ['p3'], seed=1))
+    _, embeddings_array = create_and_store_embedding_idx_paper_map(embeddings_folder, paths['map_path'],
+                                                                   paths['arrays_path'])
+    annoy_config = AnnoyConfig(num_trees=2, num_build_jobs=1)
+    save_serialized_index(create_and_train_annoy_vector_db(embeddings_array, annoy_config), paths['annoy_folder'])
+    save_serialized_index(create_and_train_exact_vector_db(embeddings_array), os.path.dirname(paths['exact_path']),
+                          constants.EXACT_DATASET_FILE_NAME)
+    return embeddings_folder, paths, annoy_config, embedding_by_paper
+
+
+def _add(embeddings_folder, paths, annoy_config, **kwargs):
+    return add_new_papers_to_vector_dbs(embeddings_folder, paths['map_path'], paths['annoy_folder'], annoy_config,
+                                        exact_dataset_path=paths['exact_path'], quantized_db_path=None,
+                                        embedding_index_to_paper_arrays_path=paths['arrays_path'], **kwargs)
+
+
+def _assert_rows_match_map(vector_db, paths, embedding_by_paper):
+    paper_index_map = PaperIndexMap.load(paths['arrays_path'])
+    assert len(vector_db) == len(paper_index_map) == len(embedding_by_paper)
+    for idx in range(len(paper_index_map)):
+        indexes, _ = vector_db.search(embedding_by_paper[paper_index_map[idx]], 1)
+        assert indexes == [idx]
+
+
+def test_add_indexes_the_new_papers_in_the_delta_shard_until_compaction(tmp_path):
+    embeddings_folder, paths, annoy_config, embedding_by_paper = _build(tmp_path)
+    embedding_by_paper.update(_write_split(embeddings_folder, 'split_c_1', 'file_c.txt', ['p4'], seed=2))
+
+    _, exact_db = _add(embeddings_folder, paths, annoy_config, compaction_fraction=10.0)
+    paper_index_map = PaperIndexMap.load(paths['arrays_path'])
+    assert paper_index_map[3] == ('p4', 'file_c.txt')
+    assert len(exact_db.delta_index) == 1
+    _assert_rows_match_map(exact_db, paths, embedding_by_paper)
+
+    _, exact_db = _add(embeddings_folder, paths, annoy_config, force_compaction=True)
+    assert len(exact_db.delta_index) == 0
+    _assert_rows_match_map(exact_db, paths, embedding_by_paper)
+
+
+def test_add_indexes_a_paper_name_already_indexed_from_another_file(tmp_path):
+    embeddings_folder, paths, annoy_config, embedding_by_paper = _build(tmp_path)
+    embedding_by_paper.update(_write_split(embeddings_folder, 'split_c_1', 'file_c.txt', ['p1'], seed=2))
+
+    _, exact_db = _add(embeddings_folder, paths, annoy_config, compaction_fraction=10.0)
+    paper_index_map = PaperIndexMap.load(paths['arrays_path'])
+    assert paper_index_map[3] == ('p1', 'file_c.txt')
+    assert len(exact_db.delta_index) == 1
+    _assert_rows_match_map(exact_db, paths, embedding_by_paper)
+
+    _, exact_db = _add(embeddings_folder, paths, annoy_config, force_compaction=True)
+    assert len(exact_db.delta_index) == 0
+    _assert_rows_match_map(exact_db, paths, embedding_by_paper)
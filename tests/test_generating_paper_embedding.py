@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pytest
+
+import generating_paper_embedding
+from conftest import make_papers, write_cleaned_text
+from embedding_store import list_embedding_splits, read_embedding_split
+from generating_paper_embedding import generate_embedding_from_text, iter_paper_splits
+
+MODEL_NAME = 'synthetic-model'
+# Seed and dimension of the SyntheticEncoder of the next run, read by the forked worker processes, so the embeddings
+# tell which run encoded them.
+ENCODER_SEED = 0
+ENCODER_DIM = 8
+
+
+def _init_synthetic_worker(model_name: str, num_threads: int):
+    from benchmark import SyntheticEncoder
+    generating_paper_embedding._worker_model = SyntheticEncoder(dim=ENCODER_DIM, seed=ENCODER_SEED)
+
+
+def _generate(tmp_path, monkeypatch, seed: int, dim: int = 8):
+    global ENCODER_SEED, ENCODER_DIM
+    ENCODER_SEED, ENCODER_DIM = seed, dim
+    monkeypatch.setattr(generating_paper_embedding, '_init_worker', _init_synthetic_worker)
+    generate_embedding_from_text(MODEL_NAME, str(tmp_path / 'cleaned_text'), str(tmp_path / 'paper_embedding'),
+                                 num_workers=1, split_size=4)
+
+
+def _read_abstract_embeddings(tmp_path):
+    embeddings_path = str(tmp_path / 'paper_embedding')
+    abstract_embeddings = {}
+    for split_name in list_embedding_splits(embeddings_path):
+        split = read_embedding_split(embeddings_path, split_name)
+        for paper_id, abstract_embedding in zip(split.paper_ids, split.abstract_embeddings):
+            abstract_embeddings[(paper_id, split.source_file)] = np.array(abstract_embedding)
+    return abstract_embeddings
+
+
+def test_split_names_hold_the_full_file_name(tmp_path):
+    write_cleaned_text(str(tmp_path), {'a_1.jsonl': {'PMC1.txt': {'abstract': 'a', 'main_body': ''}},
+                                       'b_1.jsonl': {'PMC2.txt': {'abstract': 'b', 'main_body': ''}}})
+    split_names = [split_name for split_name, _, _ in iter_paper_splits(str(tmp_path))]
+    assert len(set(split_names)) == 2
+
+
+def test_every_file_yields_its_last_smaller_split(tmp_path):
+    write_cleaned_text(str(tmp_path), make_papers(10))
+    split_sizes = [(file_name, len(papers)) for _, file_name, papers in iter_paper_splits(str(tmp_path), 2)]
+    assert split_sizes == [('split_0.jsonl', 2), ('split_0.jsonl', 2), ('split_0.jsonl', 1),
+                           ('split_1.jsonl', 2), ('split_1.jsonl', 2), ('split_1.jsonl', 1)]
+
+
+def test_rerun_only_encodes_the_new_and_edited_papers(tmp_path, monkeypatch):
+    papers_by_file = make_papers(20)
+    write_cleaned_text(str(tmp_path / 'cleaned_text'), papers_by_file)
+    _generate(tmp_path, monkeypatch, seed=1)
+    first_run_embeddings = _read_abstract_embeddings(tmp_path)
+
+    # A paper inserted first in a file shifts every other paper of the file to the next position, and split.
+    file_name = 'split_0.jsonl'
+    papers_by_file[file_name] = {'PMC999999.txt': {'abstract': 'insulin and glucose', 'main_body': 'insulin'},
+                                 **papers_by_file[file_name]}
+    papers_by_file['split_1.jsonl']['PMC000001.txt']['abstract'] += ' edited'
+    write_cleaned_text(str(tmp_path / 'cleaned_text'), papers_by_file)
+    _generate(tmp_path, monkeypatch, seed=2)
+    second_run_embeddings = _read_abstract_embeddings(tmp_path)
+
+    changed_papers = {('PMC999999.txt', 'split_0.jsonl'), ('PMC000001.txt', 'split_1.jsonl')}
+    assert set(second_run_embeddings) == set(first_run_embeddings) | changed_papers
+    for paper_file_name, abstract_embedding in second_run_embeddings.items():
+        if paper_file_name in changed_papers:
+            assert not np.allclose(abstract_embedding, first_run_embeddings.get(paper_file_name, 0))
+        else:
+            np.testing.assert_array_equal(abstract_embedding, first_run_embeddings[paper_file_name])
+
+
+def test_model_with_another_dimension_than_the_existing_splits_is_rejected(tmp_path, monkeypatch):
+    papers_by_file = make_papers(8)
+    write_cleaned_text(str(tmp_path / 'cleaned_text'), papers_by_file)
+    _generate(tmp_path, monkeypatch, seed=1)
+    papers_by_file['split_0.jsonl']['PMC000000.txt']['abstract'] += ' edited'
+    write_cleaned_text(str(tmp_path / 'cleaned_text'), papers_by_file)
+    with pytest.raises(ValueError, match='16 dimensional'):
+        _generate(tmp_path, monkeypatch, seed=1, dim=16)
+
+
+def test_splits_the_cleaned_text_no_longer_produces_are_deleted(tmp_path, monkeypatch):
+    papers_by_file = make_papers(20)
+    write_cleaned_text(str(tmp_path / 'cleaned_text'), papers_by_file)
+    _generate(tmp_path, monkeypatch, seed=1)
+    assert len(list_embedding_splits(str(tmp_path / 'paper_embedding'))) == 6
+
+    os.remove(str(tmp_path / 'cleaned_text' / 'split_1.jsonl'))
+    del papers_by_file['split_1.jsonl']
+    papers_by_file['split_0.jsonl'] = dict(list(papers_by_file['split_0.jsonl'].items())[:5])
+    write_cleaned_text(str(tmp_path / 'cleaned_text'), papers_by_file)
+    _generate(tmp_path, monkeypatch, seed=1)
+    split_names = [split_name for split_name, _, _ in iter_paper_splits(str(tmp_path / 'cleaned_text'), 4)]
+    assert list_embedding_splits(str(tmp_path / 'paper_embedding')) == sorted(split_names)
+    assert len(split_names) == 2
@@ -0,0 +1,73 @@
+import collections
+import math
+
+import numpy as np
+import pytest
+
+from lexical_index import MAX_TERM_BYTES, BM25Index, reciprocal_rank_fusion, tokenize
+from paper_index_map import PaperIndexMap
+
+
+def test_tokenize_drops_stopwords_and_splits_hyphenated_terms():
+    assert tokenize("The role of IL-6 in CCR7+ cells") == ['role', 'il-6', 'il', '6', 'il6', 'ccr7', 'cells']
+
+
+def test_tokenize_drops_tokens_longer_than_the_vocabulary_width():
+    long_chain = '-'.join(['ab'] * 40)
+    assert tokenize(long_chain) == ['ab'] * 40
+    assert tokenize('x' * (MAX_TERM_BYTES + 1)) == []
+    assert tokenize('x' * MAX_TERM_BYTES) == ['x' * MAX_TERM_BYTES]
+
+
+def test_reciprocal_rank_fusion():
+    indexes, scores = reciprocal_rank_fusion([[1, 2, -1], [2, 3]], k=60)
+    assert indexes == [2, 1, 3]
+    assert scores == pytest.approx([1 / 62 + 1 / 61, 1 / 61, 1 / 62])
+    assert reciprocal_rank_fusion([[1, 2], [3]], k=60, top_k=1)[0] == [1]
+    assert reciprocal_rank_fusion([[], [-1]]) == ([], [])
+
+
+def _brute_force_bm25(documents, query, k1=1.2, b=0.75):
+    counts = [collections.Counter(tokenize(document)) for document in documents]
+    average_length = np.mean([sum(count.values()) for count in counts])
+    document_frequencies = collections.Counter(term for count in counts for term in count)
+    scores = np.zeros(len(documents))
+    for doc_id, count in enumerate(counts):
+        length = sum(count.values())
+        for term in set(tokenize(query)):
+            if term in count:
+                df = document_frequencies[term]
+                idf = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+                scores[doc_id] += idf * count[term] * (k1 + 1) / (
+                    count[term] + k1 * (1 - b + b * length / average_length))
+    return scores
+
+
+@pytest.fixture
+def bm25_index(corpus):
+    return BM25Index.build(
+        str(corpus['tmp_path'] / 'lexical_index'), corpus['paper_text_store_path'], corpus['cleaned_text_path'],
+        corpus['paper_index_map_path'], None, num_workers=1, block_size=25,
+    )
+
+
+@pytest.mark.parametrize('query', ['ccr7 chemokine receptor', 'il6 tnf-alpha', 'BRCA1 p53 in patients',
+                                   'lymphatic vessels metastasis of tumor cells', 'unknownterm', ''])
+def test_bm25_matches_brute_force(corpus, bm25_index, query):
+    abstracts = {name: paper['abstract'] for papers in corpus['papers_by_file'].values()
+                 for name, paper in papers.items()}
+    expected_scores = _brute_force_bm25([abstracts[name] for name, _ in corpus['paper_file_names']], query)
+
+    doc_ids, scores = bm25_index.search(query, 10)
+    num_matching = int(np.count_nonzero(expected_scores))
+    assert len(doc_ids) == min(10, num_matching)
+    np.testing.assert_allclose(scores, np.sort(expected_scores)[::-1][:len(doc_ids)], rtol=1e-4)
+    np.testing.assert_allclose(expected_scores[doc_ids], scores, rtol=1e-4)
+
+
+def test_bm25_index_checks_the_paper_index_map(corpus, bm25_index):
+    paper_file_names = corpus['paper_file_names']
+    assert bm25_index.matches(PaperIndexMap.load(corpus['paper_index_map_path']))
+    assert bm25_index.matches(PaperIndexMap.from_paper_file_names(paper_file_names + [('PMC_new_and_longer', 'x')]))
+    assert not bm25_index.matches(PaperIndexMap.from_paper_file_names(paper_file_names[::-1]))
+    assert not bm25_index.matches(PaperIndexMap.from_paper_file_names(paper_file_names[:-1]))
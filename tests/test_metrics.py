@@ -0,0 +1,62 @@
+import json
+import time
+
+import pytest
+
+from metrics import METRICS, Metrics, SamplingProfiler
+
+
+@pytest.fixture
+def metrics():
+    METRICS.reset()
+    METRICS.enable()
+    yield METRICS
+    METRICS.disable()
+    METRICS.reset()
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    with metrics.span('stage'):
+        metrics.increment('counter')
+        metrics.observe('histogram', 1.0)
+    assert metrics.export_prometheus() == '\n'
+    assert metrics.export_json_lines() == ''
+
+
+def test_spans_record_their_parent_stage_and_export():
+    metrics = Metrics(enabled=True, buckets=(0.5, 1.0))
+    with metrics.span('outer'):
+        with metrics.span('inner'):
+            pass
+    metrics.increment('cache_lookups', result='hit')
+    metrics.increment('cache_lookups', 2, result='hit')
+    metrics.observe('tokens', 0.7)
+
+    records = [json.loads(line) for line in metrics.export_json_lines().splitlines()]
+    spans = [record for record in records if record['type'] == 'span']
+    assert [(span['span'], span['parent']) for span in spans] == [('inner', 'outer'), ('outer', None)]
+    prometheus = metrics.export_prometheus()
+    assert 'pubmed_agent_cache_lookups_total{result="hit"} 3' in prometheus
+    assert 'pubmed_agent_tokens_bucket{le="0.5"} 0' in prometheus
+    assert 'pubmed_agent_tokens_bucket{le="1.0"} 1' in prometheus
+    assert 'pubmed_agent_stage_seconds_count{stage="inner"} 1' in prometheus
+
+
+def test_agent_run_records_its_stages(make_agent, metrics):
+    agent = make_agent()
+    agent.run('role of il-6 in lymphatic vessels')
+    stages = set(record['span'] for record in map(json.loads, metrics.export_json_lines().splitlines())
+                 if record['type'] == 'span')
+    assert {'paper_retrieval', 'query_encode', 'vector_search', 'passage_scoring', 'prompt_build',
+            'llm_generate'} <= stages
+    assert 'pubmed_agent_prompt_tokens_total' in metrics.export_prometheus()
+
+
+def test_sampling_profiler_counts_the_stacks_of_other_threads():
+    profiler = SamplingProfiler(interval=0.001).start()
+    time.sleep(0.05)
+    profiler.stop()
+    assert profiler.num_samples > 0
+    assert any('test_sampling_profiler_counts_the_stacks_of_other_threads' in stack
+               for stack in profiler.get_folded_stacks())
@@ -0,0 +1,21 @@
+import numpy as np
+
+from benchmark import SyntheticEncoder
+from onnx_query_encoder import sample_queries_from_papers, validate_onnx_query_encoder
+
+
+def test_sampled_queries_start_the_abstract_of_a_paper(corpus):
+    queries = sample_queries_from_papers(10, corpus['paper_text_store_path'], corpus['cleaned_text_path'], max_words=5)
+    abstracts = [paper['abstract'] for papers in corpus['papers_by_file'].values() for paper in papers.values()]
+    assert len(queries) == 10
+    assert all(any(abstract.startswith(query) for abstract in abstracts) for query in queries)
+
+
+def test_validation_of_an_identical_encoder_reports_full_agreement(make_retriever):
+    retriever = make_retriever()
+    queries = ['il-6 in lymphatic vessels', 'ccr7 and tumor metastasis', 'insulin and glucose in mice']
+    report = validate_onnx_query_encoder(SyntheticEncoder(dim=32), SyntheticEncoder(dim=32), queries,
+                                         retriever.vector_db, k=5)
+    assert report['num_queries'] == len(queries)
+    assert np.isclose(report['min_cosine_similarity'], 1.0)
+    assert report['top5_overlap'] == 1.0
@@ -0,0 +1,80 @@
+import json
+import os
+
+import numpy as np
+
+from paper_index_map import PaperIndexMap
+
+
+def _write_json_map(file_path: str, paper_file_names):
+    with open(file_path, 'w') as f:
+        f.write(json.dumps({idx: list(paper_file_name) for idx, paper_file_name in enumerate(paper_file_names)}))
+
+
+def test_round_trip(corpus):
+    paper_index_map = PaperIndexMap.load(corpus['paper_index_map_path'])
+    assert isinstance(paper_index_map.paper_names, np.memmap)
+    assert len(paper_index_map) == len(corpus['paper_file_names'])
+    assert [paper_index_map[idx] for idx in range(len(paper_index_map))] == corpus['paper_file_names']
+    assert paper_index_map.get_many([2, -1, 0, len(paper_index_map)]) == [corpus['paper_file_names'][2],
+                                                                          corpus['paper_file_names'][0]]
+    assert paper_index_map.get(len(paper_index_map)) is None
+
+
+def test_unicode_and_empty_maps(tmp_path):
+    paper_file_names = [('PMCé中.txt', 'split_1.jsonl'), ('PMC2.txt', 'split_0.jsonl')]
+    PaperIndexMap.from_paper_file_names(paper_file_names).save(str(tmp_path / 'map'))
+    assert PaperIndexMap.load(str(tmp_path / 'map')).get_many([0, 1]) == paper_file_names
+
+    PaperIndexMap.from_paper_file_names([]).save(str(tmp_path / 'empty'))
+    assert len(PaperIndexMap.load(str(tmp_path / 'empty'))) == 0
+
+
+def test_load_or_convert_follows_the_json_map(tmp_path, corpus):
+    json_map_path = str(tmp_path / 'embedding_idx_paper_file_name_map.jsonl')
+    arrays_path = str(tmp_path / 'converted')
+    _write_json_map(json_map_path, corpus['paper_file_names'])
+    paper_index_map = PaperIndexMap.load_or_convert(arrays_path, json_map_path)
+    assert paper_index_map.get_many(range(len(paper_index_map))) == corpus['paper_file_names']
+
+    new_paper_file_names = corpus['paper_file_names'] + [('PMC999999.txt', 'split_2.jsonl')]
+    _write_json_map(json_map_path, new_paper_file_names)
+    os.utime(json_map_path, (0, 0))
+    assert PaperIndexMap.load_or_convert(arrays_path, json_map_path)[len(new_paper_file_names) - 1] == \
+        ('PMC999999.txt', 'split_2.jsonl')
+    # Without the JSON map the converted arrays are used as they are.
+    assert len(PaperIndexMap.load_or_convert(arrays_path, str(tmp_path / 'missing.jsonl'))) == len(new_paper_file_names)
+
+
+def test_fingerprint_ignores_the_stored_width(corpus):
+    paper_index_map = PaperIndexMap.load(corpus['paper_index_map_path'])
+    wider_map = PaperIndexMap.from_paper_file_names(corpus['paper_file_names'] + [('PMC' + 'x' * 40, 'split_0.jsonl')])
+    assert wider_map.paper_names.dtype.itemsize > paper_index_map.paper_names.dtype.itemsize
+    assert wider_map.get_fingerprint(len(paper_index_map)) == paper_index_map.get_fingerprint()
+    assert wider_map.get_fingerprint() != paper_index_map.get_fingerprint()
+
+
+def test_saved_fingerprints_are_not_recomputed(corpus, monkeypatch):
+    import paper_index_map as paper_index_map_module
+
+    paper_file_names = corpus['paper_file_names']
+    extended_map = PaperIndexMap.from_paper_file_names(paper_file_names + [('PMC999999.txt', 'split_2.jsonl')])
+    expected_fingerprints = {len(paper_file_names): extended_map.get_fingerprint(len(paper_file_names)),
+                             len(extended_map): extended_map.get_fingerprint()}
+    extended_map.save(corpus['paper_index_map_path'])
+    loaded_map = PaperIndexMap.load(corpus['paper_index_map_path'])
+    assert loaded_map.fingerprints == expected_fingerprints
+
+    def _sha1(*args, **kwargs):
+        raise AssertionError("The saved fingerprint was hashed again")
+
+    monkeypatch.setattr(paper_index_map_module.hashlib, 'sha1', _sha1)
+    assert loaded_map.get_fingerprint(len(paper_file_names)) == expected_fingerprints[len(paper_file_names)]
+    assert loaded_map.get_fingerprint() == expected_fingerprints[len(extended_map)]
+    monkeypatch.undo()
+
+    # A map that does not extend the saved one drops the fingerprints of the saved one.
+    other_map = PaperIndexMap.from_paper_file_names(paper_file_names[1:])
+    other_map.save(corpus['paper_index_map_path'])
+    assert PaperIndexMap.load(corpus['paper_index_map_path']).fingerprints == \
+        {len(other_map): other_map.get_fingerprint()}
@@ -0,0 +1,61 @@
+import json
+import os
+import shutil
+
+import constants
+from conftest import write_cleaned_text
+from paper_text_store import PaperTextStore
+
+
+def test_round_trip(corpus):
+    store = PaperTextStore.build(corpus['cleaned_text_path'], corpus['paper_text_store_path'])
+    assert len(store) == len(corpus['paper_file_names'])
+    for paper_name, file_name in corpus['paper_file_names']:
+        assert store.get_paper((paper_name, file_name)) == corpus['papers_by_file'][file_name][paper_name]
+    paper_file_names = corpus['paper_file_names'][::-7]
+    assert store.get_papers(paper_file_names) == [store.get_paper(key) for key in paper_file_names]
+    assert store.get_abstract(('missing.txt', 'split_0.jsonl')) == ''
+    store.close()
+
+
+def test_same_paper_name_in_two_files(tmp_path):
+    papers_by_file = {
+        'split_0.jsonl': {'PMC1.txt': {'abstract': 'first', 'main_body': 'first body'}},
+        'split_1.jsonl': {'PMC1.txt': {'abstract': 'second', 'main_body': 'second body'}},
+    }
+    write_cleaned_text(str(tmp_path / 'cleaned_text'), papers_by_file)
+    store = PaperTextStore.build(str(tmp_path / 'cleaned_text'), str(tmp_path / 'store'))
+    assert len(store) == 2
+    assert store.get_abstract(('PMC1.txt', 'split_0.jsonl')) == 'first'
+    assert store.get_body(('PMC1.txt', 'split_1.jsonl')) == 'second body'
+
+
+def test_load_or_build_rebuilds_changed_sources_and_keeps_the_store_without_sources(corpus):
+    store = PaperTextStore.load_or_build(corpus['paper_text_store_path'], corpus['cleaned_text_path'])
+    store.close()
+
+    paper_name, file_name = corpus['paper_file_names'][0]
+    corpus['papers_by_file'][file_name][paper_name]['abstract'] = 'a longer edited abstract'
+    write_cleaned_text(corpus['cleaned_text_path'], corpus['papers_by_file'])
+    store = PaperTextStore.load_or_build(corpus['paper_text_store_path'], corpus['cleaned_text_path'])
+    assert store.get_abstract((paper_name, file_name)) == 'a longer edited abstract'
+    store.close()
+
+    shutil.rmtree(corpus['cleaned_text_path'])
+    store = PaperTextStore.load_or_build(corpus['paper_text_store_path'], corpus['cleaned_text_path'])
+    assert store.get_abstract((paper_name, file_name)) == 'a longer edited abstract'
+    store.close()
+
+
+def test_store_of_an_older_format_is_rebuilt(corpus):
+    PaperTextStore.build(corpus['cleaned_text_path'], corpus['paper_text_store_path']).close()
+    index_file_path = os.path.join(corpus['paper_text_store_path'], constants.PAPER_TEXT_INDEX_FILE_NAME)
+    with open(index_file_path, 'r') as f:
+        store_index = json.loads(f.read())
+    del store_index['version']
+    with open(index_file_path, 'w') as f:
+        f.write(json.dumps(store_index))
+
+    store = PaperTextStore.load_or_build(corpus['paper_text_store_path'], corpus['cleaned_text_path'])
+    assert len(store) == len(corpus['paper_file_names'])
+    store.close()
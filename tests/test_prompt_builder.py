@@ -0,0 +1,77 @@
+import re
+
+import pytest
+
+from chat_agent import render_full_paper_context
+from constants import ACTOR_USER, ASSISTANT_ROLE, SYSTEM_ROLE
+from document_retriever import DocumentRetriever, Passage
+from prompt_builder import EARLIER_CONVERSATION_PREFIX, PromptBuilder
+
+TEMPLATE = "Answer from the papers below.\n{paper_text}"
+
+
+class WordTokenizer:
+    '''One token per word, with its trailing whitespace, so the token counts are easy to reason about.
+    '''
+
+    def encode(self, text, **kwargs):
+        return re.findall(r'\S+\s*|\s+', text)
+
+    def decode(self, tokens):
+        return ''.join(tokens)
+
+
+def _passages(num_passages: int, num_words: int):
+    return [Passage(paper_file_name=(f'PMC{idx}.txt', 'split_0.jsonl'), section='abstract', score=1.0 - idx / 100,
+                    text=' '.join([f'word{idx}'] * num_words)) for idx in range(num_passages)]
+
+
+def _history(num_turns: int, num_words: int):
+    history = []
+    for idx in range(num_turns):
+        history.append({"role": ACTOR_USER, "content": f"question {idx} " + 'q ' * num_words})
+        history.append({"role": ASSISTANT_ROLE, "content": 'a ' * num_words})
+    return history
+
+
+@pytest.fixture
+def prompt_builder():
+    return PromptBuilder(model_names=['small', 'large'], context_windows={'small': 400, 'large': 1600},
+                         max_completion_tokens=100, tokenizer=WordTokenizer())
+
+
+def test_prompt_fits_the_window_minus_the_completion_reservation(prompt_builder):
+    messages, report = prompt_builder.build(TEMPLATE, _passages(10, 60), DocumentRetriever.build_passage_context,
+                                            _history(6, 30), 'What is the role of il-6?', 'small')
+    assert report.model_name == 'small'
+    assert report.prompt_tokens == prompt_builder.count_message_tokens(messages, 'small')
+    assert report.prompt_tokens <= 400 - 100
+    assert report.prompt_tokens > 400 - 100 - 10
+    assert 0 < report.num_passages < 10 and report.num_passages + report.num_dropped_passages == 10
+    assert messages[0]['role'] == SYSTEM_ROLE and messages[-1] == {"role": ACTOR_USER,
+                                                                   "content": 'What is the role of il-6?'}
+    # The dropped turns are summarized by the questions they asked.
+    assert report.num_dropped_turns > 0
+    assert any(message['content'].startswith(EARLIER_CONVERSATION_PREFIX + 'question 0') for message in messages)
+
+
+def test_passages_are_kept_in_order_of_score(prompt_builder):
+    passages = _passages(4, 5)[::-1]
+    messages, report = prompt_builder.build(TEMPLATE, passages, DocumentRetriever.build_passage_context, [],
+                                            'question', 'small')
+    assert report.num_dropped_passages == 0
+    positions = [messages[0]['content'].index(f'word{idx}') for idx in range(4)]
+    assert positions == sorted(positions)
+
+
+def test_model_is_only_switched_with_auto_select_model(prompt_builder):
+    passages = _passages(1, 600)
+    _, report = prompt_builder.build(TEMPLATE, passages, render_full_paper_context, [], 'question', 'small')
+    assert report.model_name == 'small' and report.num_passages == 1
+    assert report.prompt_tokens <= 300
+
+    prompt_builder.auto_select_model = True
+    _, report = prompt_builder.build(TEMPLATE, _passages(1, 10), render_full_paper_context, [], 'question', 'large')
+    assert report.model_name == 'small'
+    _, report = prompt_builder.build(TEMPLATE, passages, render_full_paper_context, [], 'question', 'small')
+    assert report.model_name == 'large' and report.num_dropped_passages == 0
@@ -0,0 +1,99 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from fake_openai_server import DEFAULT_FAKE_RESPONSE
+from pubmed_agent_server import PubMedAgentServer
+
+
+def _run_with_client(agent, test, max_wait_ms: float = 1.0):
+    async def _run():
+        async with TestClient(TestServer(PubMedAgentServer(agent, max_wait_ms=max_wait_ms).make_app())) as client:
+            return await test(client)
+
+    return asyncio.run(_run())
+
+
+def test_concurrent_new_questions_share_a_retrieval_batch(make_agent):
+    agent = make_agent()
+
+    async def ask(client, question, session_id):
+        response = await client.post('/v1/ask', json={'question': question, 'session_id': session_id})
+        assert response.status == 200
+        return await response.json()
+
+    async def test(client):
+        bodies = await asyncio.gather(*[ask(client, f'chemokine receptor {idx}', f'session-{idx}')
+                                        for idx in range(4)])
+        follow_up = await client.post('/v1/ask', json={'question': 'and in mice?', 'session_id': 'session-0',
+                                                       'state': 1, 'chat_history': bodies[0]['chat_history']})
+        assert (await follow_up.json())['session_id'] == 'session-0'
+        assert (await client.post('/v1/end_session', json={'session_id': 'session-1'})).status == 200
+        stats = await (await client.get('/v1/stats')).json()
+        return bodies, stats
+
+    bodies, stats = _run_with_client(agent, test, max_wait_ms=200.0)
+    assert [body['response']['content'] for body in bodies] == [DEFAULT_FAKE_RESPONSE] * 4
+    assert [body['session_id'] for body in bodies] == [f'session-{idx}' for idx in range(4)]
+    assert 'session-1' not in agent.sessions
+    assert stats['num_requests'] == 5
+    assert stats['mean_batch_size'] > 1
+
+
+def test_every_session_less_question_gets_its_own_session(make_agent):
+    agent = make_agent()
+
+    async def test(client):
+        session_ids, chat_histories = [], []
+        for question in ('role of il-6', 'ccr7 and lymphatic vessels'):
+            response = await client.post('/v1/ask', json={'question': question})
+            assert response.status == 200
+            body = await response.json()
+            assert body['response']['content'] == DEFAULT_FAKE_RESPONSE
+            session_ids.append(body['session_id'])
+            chat_histories.append(body['chat_history'])
+        follow_up = await client.post('/v1/ask', json={'question': 'and in mice?', 'session_id': session_ids[0],
+                                                       'state': 1, 'chat_history': chat_histories[0]})
+        assert (await follow_up.json())['session_id'] == session_ids[0]
+        stats = await (await client.get('/v1/stats')).json()
+        return session_ids, stats
+
+    session_ids, stats = _run_with_client(agent, test)
+    assert session_ids[0] != session_ids[1]
+    assert set(session_ids) <= set(agent.sessions)
+    assert stats['num_requests'] == 3 and stats['num_batches'] >= 1
+
+
+def test_malformed_requests_are_rejected_with_400(make_agent):
+    async def test(client):
+        statuses = []
+        for kwargs in ({'json': {'session_id': 'a'}}, {'data': 'not json'}, {'json': ['role of il-6']},
+                       {'json': {'question': 'role of il-6', 'state': 'first'}}):
+            statuses.append((await client.post('/v1/ask', **kwargs)).status)
+        statuses.append((await client.post('/v1/end_session', json={})).status)
+        return statuses
+
+    assert _run_with_client(make_agent(), test) == [400] * 5
+
+
+def test_ask_rejects_invalid_fields_with_400(make_agent, fake_openai):
+    agent = make_agent()
+
+    async def test(client):
+        responses = []
+        for body in ({'question': ['role of il-6']}, {'question': None},
+                     {'question': 'role of il-6', 'chat_history': 'role of il-6'},
+                     {'question': 'role of il-6', 'chat_history': {'role': 'user'}},
+                     {'question': 'role of il-6', 'state': 3}, {'question': 'role of il-6', 'state': -1},
+                     {'question': 'and in mice?', 'state': 1, 'chat_history': []},
+                     {'question': 'and in mice?', 'state': 1, 'chat_history': [], 'session_id': ''},
+                     {'question': '', 'state': 2},
+                     {'question': 'role of il-6', 'session_id': 7}):
+            response = await client.post('/v1/ask', json=body)
+            responses.append((response.status, await response.text()))
+        return responses
+
+    responses = _run_with_client(agent, test)
+    assert [status for status, _ in responses] == [400] * 10
+    assert 'session_id' in responses[6][1] and 'state must be 0, 1 or 2' in responses[4][1]
+    assert not agent.sessions and not fake_openai.received_requests
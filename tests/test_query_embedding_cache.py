@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from query_embedding_cache import QueryEmbeddingCache, is_lower_casing_encoder
+
+
+def _embedding(seed: int, dim: int = 8) -> np.ndarray:
+    return np.random.default_rng(seed).normal(size=dim).astype(np.float32)
+
+
+def test_memory_cache_is_a_bounded_lru_of_normalized_queries():
+    cache = QueryEmbeddingCache('model', max_entries=2, lowercase=True)
+    cache.put('Role of  IL-6', _embedding(0))
+    cache.put('ccr7', _embedding(1))
+    np.testing.assert_array_equal(cache.get('role of il-6'), _embedding(0))
+    cache.put('tnf', _embedding(2))
+    assert cache.get('ccr7') is None
+    assert cache.get('ROLE OF IL-6') is not None
+    assert len(cache) == 2
+    assert (cache.memory_hits, cache.misses) == (2, 1)
+    with pytest.raises(ValueError):
+        cache.get('tnf')[0] = 1.0
+
+
+def test_disk_cache_is_shared_across_instances_of_the_same_model(tmp_path):
+    cache = QueryEmbeddingCache('sentence-transformers/model', disk_cache_dir=str(tmp_path))
+    cache.put('role of il-6', _embedding(0))
+
+    reloaded_cache = QueryEmbeddingCache('sentence-transformers/model', disk_cache_dir=str(tmp_path))
+    np.testing.assert_array_equal(reloaded_cache.get('role of  il-6', dim=8), _embedding(0))
+    assert reloaded_cache.disk_hits == 1
+    assert QueryEmbeddingCache('other-model', disk_cache_dir=str(tmp_path)).get('role of il-6', dim=8) is None
+    with pytest.raises(ValueError):
+        QueryEmbeddingCache('sentence-transformers/model', disk_cache_dir=str(tmp_path)).get('role of il-6', dim=16)
+
+
+def test_disk_cache_keeps_colliding_queries_apart(tmp_path):
+    cache = QueryEmbeddingCache('model', max_entries=1, disk_cache_dir=str(tmp_path), disk_capacity=4)
+    for idx in range(4):
+        cache.put(f'query {idx}', _embedding(idx))
+    for idx in range(4):
+        np.testing.assert_array_equal(cache.get(f'query {idx}'), _embedding(idx))
+
+
+def test_queries_are_only_lower_cased_for_a_lower_casing_encoder(tmp_path):
+    cache = QueryEmbeddingCache('cased-model', disk_cache_dir=str(tmp_path))
+    cache.put('Role of IL-6', _embedding(0))
+    assert cache.get('role of il-6') is None
+    np.testing.assert_array_equal(cache.get('Role  of IL-6'), _embedding(0))
+    # The casing is part of the key, a lower casing cache of the same model does not read the cased entries.
+    lower_casing_cache = QueryEmbeddingCache('cased-model', disk_cache_dir=str(tmp_path), lowercase=True)
+    assert lower_casing_cache.get('Role of IL-6', dim=8) is None
+
+    class Tokenizer:
+        do_lower_case = False
+
+    class Model:
+        tokenizer = Tokenizer()
+
+    assert is_lower_casing_encoder(None, 'all-mpnet-base-v2')
+    assert not is_lower_casing_encoder(None, 'other-model')
+    assert not is_lower_casing_encoder(Model(), 'all-mpnet-base-v2')
+
+
+class _OverwrittenWhileRead:
+    '''Stands for the vectors of a DiskQueryEmbeddingStore and lets another query take the slot right before it is read.
+    '''
+
+    def __init__(self, disk_store, key: bytes, embedding: np.ndarray):
+        self.disk_store = disk_store
+        self.vectors = disk_store.vectors
+        self.key = key
+        self.embedding = embedding
+
+    def __getitem__(self, slot):
+        self.disk_store.vectors = self.vectors
+        self.disk_store.put(self.key, self.embedding)
+        return self.vectors[slot]
+
+
+def test_disk_cache_read_of_an_overwritten_slot_is_a_miss(tmp_path):
+    from query_embedding_cache import get_query_key
+
+    cache = QueryEmbeddingCache('model', max_entries=1, disk_cache_dir=str(tmp_path), disk_capacity=1)
+    cache.put('query 0', _embedding(0))
+    disk_store = cache.disk_store
+    disk_store.vectors = _OverwrittenWhileRead(disk_store, get_query_key('model', 'query 1'), _embedding(1))
+    assert disk_store.get(get_query_key('model', 'query 0')) is None
+    np.testing.assert_array_equal(disk_store.get(get_query_key('model', 'query 1')), _embedding(1))
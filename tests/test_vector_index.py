@@ -0,0 +1,160 @@
+import os
+
+import numpy as np
+import pytest
+
+from vector_index import AnnoyVectorIndex, ExactVectorIndex, QuantizedVectorIndex, ShardedVectorIndex, \
+    get_delta_manifest_path, get_delta_path, load_vector_index, ANNOY_BACKEND, EXACT_BACKEND, QUANTIZED_BACKEND
+
+
+def _make_embeddings(num_vectors: int = 2000, dim: int = 32, num_clusters: int = 20, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_clusters, dim))
+    return (centers[rng.integers(num_clusters, size=num_vectors)] + 0.3 * rng.normal(size=(num_vectors, dim))
+            ).astype(np.float32)
+
+
+def _recall(indexes, exact_indexes) -> float:
+    return float(np.mean([len(set(query_indexes) & set(exact_query_indexes)) / len(exact_query_indexes)
+                          for query_indexes, exact_query_indexes in zip(indexes, exact_indexes)]))
+
+
+@pytest.fixture
+def embeddings():
+    return _make_embeddings()
+
+
+@pytest.fixture
+def queries(embeddings):
+    rng = np.random.default_rng(1)
+    return embeddings[rng.choice(len(embeddings), 50, replace=False)] + 0.1 * rng.normal(size=(50, 32))
+
+
+def test_exact_search_matches_brute_force(embeddings, queries):
+    exact_index = ExactVectorIndex(block_size=300)
+    exact_index.build(embeddings)
+    indexes, distances = exact_index.batch_search(queries, 10)
+    normalized = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    similarities = (queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ normalized.T
+    assert indexes == np.argsort(-similarities, axis=1, kind='stable')[:, :10].tolist()
+    np.testing.assert_allclose(distances, np.sqrt(2 - 2 * np.sort(similarities, axis=1)[:, ::-1][:, :10]), atol=1e-5)
+
+
+def test_annoy_and_exact_backends_agree(tmp_path, embeddings, queries):
+    exact_index = ExactVectorIndex()
+    exact_index.build(embeddings)
+    exact_index.save(str(tmp_path / 'dataset.npy'))
+    annoy_index = AnnoyVectorIndex(32, num_trees=20)
+    annoy_index.build(embeddings)
+    annoy_index.save(str(tmp_path / 'index.ann'))
+
+    loaded_exact_index = load_vector_index(EXACT_BACKEND, str(tmp_path / 'dataset.npy'), 32)
+    loaded_annoy_index = load_vector_index(ANNOY_BACKEND, str(tmp_path / 'index.ann'), 32)
+    exact_indexes, exact_distances = loaded_exact_index.batch_search(queries, 10)
+    annoy_indexes, annoy_distances = loaded_annoy_index.batch_search(queries, 10)
+    assert exact_indexes == exact_index.batch_search(queries, 10)[0]
+    assert _recall(annoy_indexes, exact_indexes) >= 0.9
+    np.testing.assert_allclose(np.array(annoy_distances)[:, 0], np.array(exact_distances)[:, 0], atol=1e-4)
+
+
+@pytest.mark.parametrize('num_lists, num_probes', [(1, 1), (16, 8)])
+def test_quantized_recall_against_exact(embeddings, queries, num_lists, num_probes):
+    exact_index = ExactVectorIndex()
+    exact_index.build(embeddings)
+    exact_indexes, _ = exact_index.batch_search(queries, 10)
+    quantized_index = QuantizedVectorIndex(num_lists=num_lists, num_probes=num_probes, block_size=300)
+    quantized_index.build(embeddings)
+    quantized_indexes, _ = quantized_index.batch_search(queries, 10)
+    assert _recall(quantized_indexes, exact_indexes) >= 0.95
+
+
+def test_quantized_index_re_ranks_against_the_exact_dataset(tmp_path, embeddings, queries):
+    dataset_path = str(tmp_path / 'dataset.npy')
+    exact_index = ExactVectorIndex()
+    exact_index.build(embeddings)
+    exact_index.save(dataset_path)
+
+    quantized_path = str(tmp_path / 'trained_quantized')
+    quantized_index = QuantizedVectorIndex(num_lists=8, block_size=300, vectors_path=dataset_path)
+    quantized_index.build(np.load(dataset_path, mmap_mode='r'))
+    quantized_index.save(quantized_path)
+    assert not os.path.exists(os.path.join(quantized_path, QuantizedVectorIndex.VECTORS_FILE_NAME))
+
+    loaded_index = load_vector_index(QUANTIZED_BACKEND, quantized_path, 32)
+    assert loaded_index.vectors_path == dataset_path
+    assert loaded_index.batch_search(queries, 5) == quantized_index.batch_search(queries, 5)
+
+    exact_index.build(embeddings[::-1])
+    exact_index.save(dataset_path)
+    with pytest.raises(ValueError):
+        load_vector_index(QUANTIZED_BACKEND, quantized_path, 32)
+
+
+def test_quantized_index_without_vectors_path_saves_its_vectors(tmp_path, embeddings, queries):
+    quantized_index = QuantizedVectorIndex(block_size=300)
+    quantized_index.build(embeddings)
+    quantized_index.save(str(tmp_path / 'trained_quantized'))
+    loaded_index = QuantizedVectorIndex()
+    loaded_index.load(str(tmp_path / 'trained_quantized'))
+    assert loaded_index.batch_search(queries, 5) == quantized_index.batch_search(queries, 5)
+
+
+def test_sharded_add_matches_a_full_build(tmp_path, embeddings, queries):
+    full_index = ExactVectorIndex()
+    full_index.build(embeddings)
+    sharded_index = ShardedVectorIndex(ExactVectorIndex())
+    sharded_index.build(embeddings[:1500])
+    sharded_index.add(embeddings[1500:1800])
+    sharded_index.add(embeddings[1800:])
+    assert len(sharded_index) == len(embeddings)
+    assert len(sharded_index.delta_index) == 500
+
+    expected_indexes, expected_distances = full_index.batch_search(queries, 10)
+    indexes, distances = sharded_index.batch_search(queries, 10)
+    np.testing.assert_allclose(distances, expected_distances, atol=1e-5)
+    assert [set(query_indexes) for query_indexes in indexes] == [set(query_indexes) for query_indexes in expected_indexes]
+
+    sharded_index.save(str(tmp_path / 'dataset.npy'))
+    loaded_index = ShardedVectorIndex(ExactVectorIndex())
+    loaded_index.load(str(tmp_path / 'dataset.npy'))
+    assert loaded_index.batch_search(queries, 10) == sharded_index.batch_search(queries, 10)
+
+    sharded_index.compact(embeddings)
+    assert len(sharded_index.delta_index) == 0
+    assert len(sharded_index.main_index) == len(embeddings)
+
+
+def test_sharded_save_only_rewrites_the_main_index_after_a_compaction(tmp_path, embeddings):
+    path = str(tmp_path / 'dataset.npy')
+    sharded_index = ShardedVectorIndex(ExactVectorIndex())
+    sharded_index.build(embeddings[:1500])
+    sharded_index.save(path)
+    main_mtime = os.stat(path).st_mtime_ns
+
+    loaded_index = ShardedVectorIndex(ExactVectorIndex())
+    loaded_index.load(path)
+    loaded_index.add(embeddings[1500:])
+    os.utime(path, ns=(main_mtime - 10 ** 9, main_mtime - 10 ** 9))
+    loaded_index.save(path)
+    assert os.stat(path).st_mtime_ns == main_mtime - 10 ** 9
+    assert os.path.exists(get_delta_path(path)) and os.path.exists(get_delta_manifest_path(path))
+
+    loaded_index.compact(embeddings)
+    loaded_index.save(path)
+    assert os.stat(path).st_mtime_ns != main_mtime - 10 ** 9
+    assert not os.path.exists(get_delta_path(path)) and not os.path.exists(get_delta_manifest_path(path))
+    assert len(np.load(path)) == len(embeddings)
+
+
+def test_sharded_load_rejects_a_delta_saved_for_another_main_index(tmp_path, embeddings):
+    path = str(tmp_path / 'dataset.npy')
+    sharded_index = ShardedVectorIndex(ExactVectorIndex())
+    sharded_index.build(embeddings[:1500])
+    sharded_index.add(embeddings[1500:])
+    sharded_index.save(path)
+    rebuilt_index = ExactVectorIndex()
+    rebuilt_index.build(embeddings[:1000])
+    rebuilt_index.save(path)
+
+    with pytest.raises(ValueError):
+        ShardedVectorIndex(ExactVectorIndex()).load(path)
@@ -0,0 +1,532 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Protocol, Tuple
+
+import numpy as np
+
+ANNOY_BACKEND = 'annoy'
+EXACT_BACKEND = 'exact'
+QUANTIZED_BACKEND = 'quantized'
+VECTOR_INDEX_BACKENDS = [ANNOY_BACKEND, EXACT_BACKEND, QUANTIZED_BACKEND]
+
+
+class VectorIndex(Protocol):
+    '''Backend neutral API over the vector databases so DocumentRetriever does not need to know which library finds the
+    nearest neighbors. Scores are angular distances (sqrt(2 - 2 * cosine similarity), the same as Annoy's angular
+    metric) so lower is better, and results are sorted by ascending distance whatever the backend.
+    '''
+
+    def build(self, embeddings: np.ndarray) -> None:
+        ...
+
+    def save(self, path: str) -> None:
+        ...
+
+    def load(self, path: str) -> None:
+        ...
+
+    def search(self, query_embedding: np.ndarray, k: int) -> Tuple[List[int], List[float]]:
+        ...
+
+    def batch_search(self, query_embeddings: np.ndarray, k: int) -> Tuple[List[List[int]], List[List[float]]]:
+        ...
+
+    def __len__(self) -> int:
+        ...
+
+    @property
+    def dim(self) -> int:
+        ...
+
+
+def _new_annoy_index(dim: int, metric: str):
+    # annoy is only imported once an Annoy index is actually used so importing this module stays cheap.
+    from annoy import AnnoyIndex
+    return AnnoyIndex(dim, metric)
+
+
+class AnnoyVectorIndex:
+    def __init__(self, dim: int, metric: str = 'angular', num_trees: int = 1000, seed: int = 44,
+                 num_search_threads: int = None, num_build_jobs: int = -1):
+        self.dim = dim
+        self.metric = metric
+        self.num_trees = num_trees
+        self.seed = seed
+        self.num_search_threads = num_search_threads or os.cpu_count() or 1
+        # Threads building the trees, -1 uses every core.
+        self.num_build_jobs = num_build_jobs
+        self.index = _new_annoy_index(dim, metric)
+
+    def build(self, embeddings: np.ndarray, block_size: int = 65536) -> None:
+        self.index = _new_annoy_index(self.dim, self.metric)
+        self.index.set_seed(self.seed)
+        # Converting a block of rows to lists at once is much cheaper than handing add_item one NumPy row at a time.
+        for start in range(0, len(embeddings), block_size):
+            block = np.asarray(embeddings[start:start + block_size], dtype=np.float32).tolist()
+            for idx, embedding in enumerate(block, start):
+                self.index.add_item(idx, embedding)
+        self.index.build(self.num_trees, n_jobs=self.num_build_jobs)
+
+    def save(self, path: str) -> None:
+        # Written next to the target and renamed so the processes memory mapping the previous index keep a valid file.
+        self.index.save(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def load(self, path: str) -> None:
+        self.index = _new_annoy_index(self.dim, self.metric)
+        self.index.load(path)
+
+    def search(self, query_embedding: np.ndarray, k: int) -> Tuple[List[int], List[float]]:
+        return self.index.get_nns_by_vector(query_embedding, n=k, include_distances=True)
+
+    def batch_search(self, query_embeddings: np.ndarray, k: int) -> Tuple[List[List[int]], List[List[float]]]:
+        '''Annoy releases the GIL while it walks the trees, so the queries are searched on a pool of threads.
+        '''
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        if self.num_search_threads == 1 or len(query_embeddings) == 1:
+            results = [self.search(query_embedding, k) for query_embedding in query_embeddings]
+        else:
+            with ThreadPoolExecutor(max_workers=self.num_search_threads) as executor:
+                results = list(executor.map(lambda query_embedding: self.search(query_embedding, k), query_embeddings))
+        indexes = [query_indexes for query_indexes, _ in results]
+        scores = [query_scores for _, query_scores in results]
+        return indexes, scores
+
+    def __len__(self) -> int:
+        return self.index.get_n_items()
+
+
+class ExactVectorIndex:
+    '''Exact cosine nearest neighbor search with NumPy over a (num_vectors, dim) float32 .npy matrix, such as the
+    dataset.npy saved for ScaNN. The matrix is memory mapped and scanned in blocks of block_size rows: every block is
+    scored against all the queries with a single matrix multiply and argpartition keeps the running top k.
+    '''
+
+    def __init__(self, block_size: int = 65536):
+        self.block_size = block_size
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        self.inverse_norms = np.zeros(0, dtype=np.float32)
+
+    def _set_embeddings(self, embeddings: np.ndarray):
+        self.embeddings = embeddings
+        # The stored vectors are not required to be unit norm (e.g. mean of the abstract chunk embeddings), so the
+        # norms are applied to the scores instead of rewriting the memory mapped matrix.
+        inverse_norms = np.empty(len(embeddings), dtype=np.float32)
+        for start in range(0, len(embeddings), self.block_size):
+            block = np.asarray(embeddings[start:start + self.block_size], dtype=np.float32)
+            inverse_norms[start:start + len(block)] = 1.0 / np.maximum(np.linalg.norm(block, axis=1), 1e-12)
+        self.inverse_norms = inverse_norms
+
+    def build(self, embeddings: np.ndarray) -> None:
+        self._set_embeddings(np.ascontiguousarray(embeddings, dtype=np.float32))
+
+    def save(self, path: str) -> None:
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, np.asarray(self.embeddings, dtype=np.float32))
+        os.replace(path + '.tmp', path)
+
+    def load(self, path: str) -> None:
+        self._set_embeddings(np.load(path, mmap_mode='r'))
+
+    @property
+    def dim(self) -> int:
+        return self.embeddings.shape[1]
+
+    def search(self, query_embedding: np.ndarray, k: int) -> Tuple[List[int], List[float]]:
+        indexes, scores = self.batch_search(np.asarray(query_embedding).reshape(1, -1), k)
+        return indexes[0], scores[0]
+
+    def batch_search(self, query_embeddings: np.ndarray, k: int) -> Tuple[List[List[int]], List[List[float]]]:
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.embeddings.shape[1])
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        num_queries = len(queries)
+        k = min(k, len(self.embeddings))
+        if k <= 0:
+            return [[] for _ in range(num_queries)], [[] for _ in range(num_queries)]
+
+        best_similarities = np.full((num_queries, 0), -np.inf, dtype=np.float32)
+        best_indexes = np.zeros((num_queries, 0), dtype=np.int64)
+        for start in range(0, len(self.embeddings), self.block_size):
+            block = np.asarray(self.embeddings[start:start + self.block_size], dtype=np.float32)
+            similarities = (queries @ block.T) * self.inverse_norms[start:start + len(block)]
+            similarities = np.concatenate([best_similarities, similarities], axis=1)
+            indexes = np.concatenate(
+                [best_indexes, np.broadcast_to(np.arange(start, start + len(block)), (num_queries, len(block)))], axis=1
+            )
+            if similarities.shape[1] > k:
+                top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+                similarities = np.take_along_axis(similarities, top, axis=1)
+                indexes = np.take_along_axis(indexes, top, axis=1)
+            best_similarities, best_indexes = similarities, indexes
+
+        order = np.argsort(-best_similarities, axis=1, kind='stable')
+        best_similarities = np.take_along_axis(best_similarities, order, axis=1)
+        best_indexes = np.take_along_axis(best_indexes, order, axis=1)
+        distances = np.sqrt(np.maximum(2.0 - 2.0 * best_similarities, 0.0))
+        return best_indexes.tolist(), distances.tolist()
+
+    def __len__(self) -> int:
+        return len(self.embeddings)
+
+
+def _save_npy_atomically(file_path: str, array: np.ndarray):
+    with open(file_path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def _normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-12)
+
+
+def train_spherical_kmeans(embeddings: np.ndarray, num_clusters: int, num_iterations: int = 10,
+                           max_training_size: int = 100_000, block_size: int = 65536, seed: int = 44) -> np.ndarray:
+    '''Unit norm centroids of the cosine k-means of (a sample of at most max_training_size of) the embeddings.
+    '''
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(len(embeddings), size=min(max_training_size, len(embeddings)), replace=False))
+    sample = _normalize_rows(embeddings[sample_rows])
+    centroids = sample[rng.choice(len(sample), size=num_clusters, replace=False)]
+    for _ in range(num_iterations):
+        assignments = np.concatenate([np.argmax(sample[start:start + block_size] @ centroids.T, axis=1)
+                                      for start in range(0, len(sample), block_size)])
+        counts = np.bincount(assignments, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        order = np.argsort(assignments, kind='stable')
+        non_empty_clusters = np.flatnonzero(counts)
+        sums[non_empty_clusters] = np.add.reduceat(sample[order], (np.cumsum(counts) - counts)[non_empty_clusters])
+        empty_clusters = counts == 0
+        # Empty clusters restart from a random sample instead of staying stuck at the origin.
+        sums[empty_clusters] = sample[rng.choice(len(sample), size=int(empty_clusters.sum()))]
+        centroids = _normalize_rows(sums)
+    return centroids
+
+
+class QuantizedVectorIndex:
+    '''Compressed index for corpora whose float32 vectors do not fit in RAM. Every unit normalized vector is stored as
+    int8 codes (per dimension scalar quantization between the min and max of that dimension), 1 byte per dimension
+    instead of 4. With num_lists > 1 the vectors are also partitioned by a cosine k-means (IVF) and a query only scores
+    the codes of its num_probes closest lists.
+
+    The codes are scored in compressed form, the best k * rerank_factor candidates of a query are then re-ranked
+    exactly against the full precision vectors, which are memory mapped from disk so only the shortlisted rows are read.
+    The index is saved as a folder of .npy files and a meta.json. With vectors_path, the (num_vectors, dim) float32 .npy
+    matrix already saved for the exact index, the re-ranking reads that file instead of a copy of it in the folder; a
+    checksum of sampled rows is kept to refuse a vectors file rebuilt since the index was.
+    '''
+    CODES_FILE_NAME = 'codes.npy'
+    IDS_FILE_NAME = 'ids.npy'
+    LIST_OFFSETS_FILE_NAME = 'list_offsets.npy'
+    CENTROIDS_FILE_NAME = 'centroids.npy'
+    QUANTIZATION_FILE_NAME = 'quantization.npy'
+    VECTORS_FILE_NAME = 'vectors.npy'
+    META_FILE_NAME = 'meta.json'
+
+    def __init__(self, num_lists: int = 1, num_probes: int = 8, rerank_factor: int = 10, block_size: int = 65536,
+                 seed: int = 44, vectors_path: str = None):
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.rerank_factor = rerank_factor
+        self.block_size = block_size
+        self.seed = seed
+        self.codes = np.zeros((0, 0), dtype=np.int8)
+        # ids[position] is the id of the vector stored at that position, the positions are grouped by list.
+        self.ids = np.zeros(0, dtype=np.int32)
+        self.list_offsets = np.zeros(2, dtype=np.int64)
+        self.centroids = np.zeros((1, 0), dtype=np.float32)
+        # Row 0 holds the min of every dimension and row 1 the size of one quantization step.
+        self.quantization = np.zeros((2, 0), dtype=np.float32)
+        # Full precision vectors in id order, not necessarily unit norm and possibly holding more rows than the index.
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.vectors_path = vectors_path
+
+    def _quantize(self, embeddings: np.ndarray) -> np.ndarray:
+        minimums, steps = self.quantization
+        codes = np.rint((embeddings - minimums) / steps) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def _assign_lists(self, embeddings: np.ndarray) -> np.ndarray:
+        if len(self.centroids) == 1:
+            return np.zeros(len(embeddings), dtype=np.int64)
+        return np.concatenate([np.argmax(embeddings[start:start + self.block_size] @ self.centroids.T, axis=1)
+                               for start in range(0, len(embeddings), self.block_size)])
+
+    def _normalized_blocks(self, embeddings: np.ndarray):
+        for start in range(0, len(embeddings), self.block_size):
+            yield start, _normalize_rows(embeddings[start:start + self.block_size])
+
+    def build(self, embeddings: np.ndarray) -> None:
+        '''embeddings can be memory mapped, it is read block by block and only the int8 codes are held in memory. It is
+        kept as the full precision vectors of the re-ranking, without a copy.
+        '''
+        dim = np.shape(embeddings)[-1]
+        minimums, maximums = np.full(dim, np.inf, dtype=np.float32), np.full(dim, -np.inf, dtype=np.float32)
+        for _, block in self._normalized_blocks(embeddings):
+            minimums, maximums = np.minimum(minimums, block.min(axis=0)), np.maximum(maximums, block.max(axis=0))
+        if not len(embeddings):
+            minimums, maximums = np.zeros(dim, dtype=np.float32), np.zeros(dim, dtype=np.float32)
+        self.quantization = np.stack([minimums, np.maximum(maximums - minimums, 1e-12) / 255]).astype(np.float32)
+        num_lists = min(self.num_lists, len(embeddings))
+        if num_lists > 1:
+            self.centroids = train_spherical_kmeans(embeddings, num_lists, block_size=self.block_size, seed=self.seed)
+        else:
+            self.centroids = np.zeros((1, dim), dtype=np.float32)
+        assignments = np.concatenate([self._assign_lists(block) for _, block in self._normalized_blocks(embeddings)]) \
+            if len(embeddings) else np.zeros(0, dtype=np.int64)
+        order = np.argsort(assignments, kind='stable')
+        self.ids = order.astype(np.int32)
+        self.list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))]).astype(np.int64)
+        positions = np.argsort(order, kind='stable')
+        self.codes = np.zeros((len(embeddings), dim), dtype=np.int8)
+        for start, block in self._normalized_blocks(embeddings):
+            self.codes[positions[start:start + len(block)]] = self._quantize(block)
+        self.vectors = embeddings
+
+    @staticmethod
+    def _get_vectors_checksum(vectors: np.ndarray, num_vectors: int, num_rows: int = 64) -> str:
+        rows = np.unique(np.linspace(0, num_vectors - 1, num=min(num_vectors, num_rows)).astype(np.int64))
+        return hashlib.sha1(np.ascontiguousarray(vectors[rows], dtype=np.float32).tobytes()).hexdigest()
+
+    def save(self, path: str) -> None:
+        '''Without vectors_path the full precision vectors are saved in the folder as well.
+        '''
+        os.makedirs(path, exist_ok=True)
+        arrays = [(self.CODES_FILE_NAME, self.codes), (self.IDS_FILE_NAME, self.ids),
+                  (self.LIST_OFFSETS_FILE_NAME, self.list_offsets), (self.CENTROIDS_FILE_NAME, self.centroids),
+                  (self.QUANTIZATION_FILE_NAME, self.quantization)]
+        if self.vectors_path is None:
+            arrays.append((self.VECTORS_FILE_NAME, np.asarray(self.vectors[:len(self)], dtype=np.float32)))
+        for file_name, array in arrays:
+            _save_npy_atomically(os.path.join(path, file_name), np.asarray(array))
+        meta_file_path = os.path.join(path, self.META_FILE_NAME)
+        with open(meta_file_path + '.tmp', 'w') as f:
+            f.write(json.dumps({
+                'num_lists': self.num_lists, 'num_probes': self.num_probes, 'rerank_factor': self.rerank_factor,
+                'num_vectors': len(self),
+                # Relative to the index folder, so the runtime data folder can be moved as a whole.
+                'vectors_path': os.path.relpath(self.vectors_path, path) if self.vectors_path is not None else None,
+                'vectors_checksum': self._get_vectors_checksum(self.vectors, len(self)),
+            }))
+        os.replace(meta_file_path + '.tmp', meta_file_path)
+        if self.vectors_path is not None and os.path.exists(os.path.join(path, self.VECTORS_FILE_NAME)):
+            os.remove(os.path.join(path, self.VECTORS_FILE_NAME))
+
+    def load(self, path: str) -> None:
+        with open(os.path.join(path, self.META_FILE_NAME), 'r') as f:
+            meta = json.loads(f.read())
+        self.num_lists, self.num_probes, self.rerank_factor = meta['num_lists'], meta['num_probes'], meta['rerank_factor']
+        self.codes = np.load(os.path.join(path, self.CODES_FILE_NAME), mmap_mode='r')
+        self.ids = np.load(os.path.join(path, self.IDS_FILE_NAME))
+        self.list_offsets = np.load(os.path.join(path, self.LIST_OFFSETS_FILE_NAME))
+        self.centroids = np.load(os.path.join(path, self.CENTROIDS_FILE_NAME))
+        self.quantization = np.load(os.path.join(path, self.QUANTIZATION_FILE_NAME))
+        self.vectors_path = None
+        if meta.get('vectors_path') is not None:
+            self.vectors_path = os.path.normpath(os.path.join(path, meta['vectors_path']))
+        self.vectors = np.load(self.vectors_path or os.path.join(path, self.VECTORS_FILE_NAME), mmap_mode='r')
+        is_stale = len(self.vectors) < len(self) or (
+            'vectors_checksum' in meta and meta['vectors_checksum'] != self._get_vectors_checksum(self.vectors, len(self)))
+        if is_stale:
+            raise ValueError(f"The full precision vectors {self.vectors_path} changed since the quantized index {path} "
+                             f"was built, rebuild it")
+
+    @property
+    def bytes_per_vector(self) -> float:
+        '''Bytes held in RAM per vector during search: the codes and the id, plus the centroids spread over all vectors.
+        The full precision vectors stay on disk.
+        '''
+        return self.codes.shape[1] * self.codes.itemsize + self.ids.itemsize + \
+            self.centroids.nbytes / max(len(self), 1)
+
+    def _probe_lists(self, queries: np.ndarray) -> np.ndarray:
+        num_probes = min(self.num_probes, len(self.centroids))
+        if num_probes == len(self.centroids):
+            return np.broadcast_to(np.arange(num_probes), (len(queries), num_probes))
+        return np.argpartition(-(queries @ self.centroids.T), num_probes - 1, axis=1)[:, :num_probes]
+
+    def _shortlist(self, queries: np.ndarray, shortlist_size: int) -> List[np.ndarray]:
+        '''Positions of the shortlist_size best candidates of every query according to the int8 codes.
+        '''
+        minimums, steps = self.quantization
+        # q . x ~= q . minimums + (q * steps) . (codes + 128)
+        scaled_queries = queries * steps
+        offsets = queries @ minimums + 128 * scaled_queries.sum(axis=1)
+        probes = self._probe_lists(queries)
+        candidate_scores = [[] for _ in range(len(queries))]
+        candidate_positions = [[] for _ in range(len(queries))]
+        for list_id in np.unique(probes):
+            query_rows = np.flatnonzero((probes == list_id).any(axis=1))
+            list_start, list_end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            for start in range(list_start, list_end, self.block_size):
+                block = np.asarray(self.codes[start:min(start + self.block_size, list_end)], dtype=np.float32)
+                scores = scaled_queries[query_rows] @ block.T + offsets[query_rows, None]
+                if scores.shape[1] > shortlist_size:
+                    top = np.argpartition(-scores, shortlist_size - 1, axis=1)[:, :shortlist_size]
+                else:
+                    top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+                for row, query_row in enumerate(query_rows):
+                    candidate_scores[query_row].append(scores[row, top[row]])
+                    candidate_positions[query_row].append(top[row] + start)
+
+        shortlists = []
+        for query_scores, query_positions in zip(candidate_scores, candidate_positions):
+            if not query_scores:
+                shortlists.append(np.zeros(0, dtype=np.int64))
+                continue
+            query_scores, query_positions = np.concatenate(query_scores), np.concatenate(query_positions)
+            if len(query_scores) > shortlist_size:
+                top = np.argpartition(-query_scores, shortlist_size - 1)[:shortlist_size]
+                query_positions = query_positions[top]
+            shortlists.append(query_positions)
+        return shortlists
+
+    def search(self, query_embedding: np.ndarray, k: int) -> Tuple[List[int], List[float]]:
+        indexes, scores = self.batch_search(np.asarray(query_embedding).reshape(1, -1), k)
+        return indexes[0], scores[0]
+
+    def batch_search(self, query_embeddings: np.ndarray, k: int) -> Tuple[List[List[int]], List[List[float]]]:
+        queries = _normalize_rows(np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.codes.shape[1]))
+        k = min(k, len(self))
+        if k <= 0:
+            return [[] for _ in range(len(queries))], [[] for _ in range(len(queries))]
+
+        indexes, scores = [], []
+        for query, positions in zip(queries, self._shortlist(queries, k * self.rerank_factor)):
+            # Sorted ids read the memory mapped vectors in file order.
+            candidate_ids = np.sort(self.ids[positions])
+            similarities = _normalize_rows(self.vectors[candidate_ids]) @ query
+            order = np.argsort(-similarities, kind='stable')[:k]
+            indexes.append(candidate_ids[order].tolist())
+            scores.append(np.sqrt(np.maximum(2.0 - 2.0 * similarities[order], 0.0)).tolist())
+        return indexes, scores
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def dim(self) -> int:
+        return self.codes.shape[1]
+
+
+def get_delta_path(path: str) -> str:
+    '''The delta shard of the index saved at path, e.g. index.delta.npy next to index.ann.
+    '''
+    return os.path.splitext(path.rstrip(os.sep))[0] + '.delta.npy'
+
+
+def get_delta_manifest_path(path: str) -> str:
+    '''Records the number of vectors of the main index and of the delta shard saved at path, e.g. index.delta.json.
+    '''
+    return os.path.splitext(path.rstrip(os.sep))[0] + '.delta.json'
+
+
+class ShardedVectorIndex:
+    '''Main index of any backend plus a small delta shard holding the vectors added since the main index was built, so
+    new papers are searchable without rebuilding the main index. The delta is searched exactly, which is cheap while it
+    stays small. Ids of the delta continue after the ids of the main index and the results of both shards are merged by
+    distance. compact rebuilds the main index over every vector and empties the delta. save only rewrites the main
+    index once it was built or compacted since it was loaded, otherwise only the delta and its manifest are written.
+    '''
+
+    def __init__(self, main_index: VectorIndex, delta_index: ExactVectorIndex = None):
+        self.main_index = main_index
+        self.delta_index = delta_index or ExactVectorIndex()
+        self.main_index_changed = True
+
+    def build(self, embeddings: np.ndarray) -> None:
+        self.main_index.build(embeddings)
+        self.delta_index = ExactVectorIndex()
+        self.main_index_changed = True
+
+    def add(self, embeddings: np.ndarray) -> None:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if len(self.delta_index):
+            embeddings = np.concatenate([np.asarray(self.delta_index.embeddings, dtype=np.float32), embeddings])
+        self.delta_index.build(embeddings)
+
+    def compact(self, embeddings: np.ndarray) -> None:
+        '''embeddings holds every vector of the index, main and delta, in id order.
+        '''
+        if len(embeddings) != len(self):
+            raise ValueError(f"Compaction needs all the {len(self)} vectors of the index, got {len(embeddings)}")
+        self.build(embeddings)
+
+    def save(self, path: str) -> None:
+        if self.main_index_changed or not os.path.exists(path):
+            self.main_index.save(path)
+            self.main_index_changed = False
+        delta_path, manifest_path = get_delta_path(path), get_delta_manifest_path(path)
+        if len(self.delta_index):
+            self.delta_index.save(delta_path)
+            # Written last, so a delta is only trusted once the manifest says which main index it extends.
+            with open(manifest_path + '.tmp', 'w') as f:
+                f.write(json.dumps({'main_size': len(self.main_index), 'delta_size': len(self.delta_index)}))
+            os.replace(manifest_path + '.tmp', manifest_path)
+        else:
+            for file_path in (manifest_path, delta_path):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+    def load(self, path: str) -> None:
+        self.main_index.load(path)
+        self.main_index_changed = False
+        self.delta_index = ExactVectorIndex()
+        if os.path.exists(get_delta_path(path)):
+            self.delta_index.load(get_delta_path(path))
+            if os.path.exists(get_delta_manifest_path(path)):
+                with open(get_delta_manifest_path(path), 'r') as f:
+                    manifest = json.loads(f.read())
+                if (manifest['main_size'], manifest['delta_size']) != (len(self.main_index), len(self.delta_index)):
+                    raise ValueError(f"The delta shard of {path} was saved for a main index of {manifest['main_size']} "
+                                     f"vectors and {manifest['delta_size']} delta vectors, found "
+                                     f"{len(self.main_index)} and {len(self.delta_index)}")
+
+    def search(self, query_embedding: np.ndarray, k: int) -> Tuple[List[int], List[float]]:
+        indexes, scores = self.batch_search(np.asarray(query_embedding).reshape(1, -1), k)
+        return indexes[0], scores[0]
+
+    def batch_search(self, query_embeddings: np.ndarray, k: int) -> Tuple[List[List[int]], List[List[float]]]:
+        main_indexes, main_scores = self.main_index.batch_search(query_embeddings, k)
+        if not len(self.delta_index):
+            return main_indexes, main_scores
+        delta_indexes, delta_scores = self.delta_index.batch_search(query_embeddings, k)
+        offset = len(self.main_index)
+        indexes, scores = [], []
+        for query_results in zip(main_indexes, main_scores, delta_indexes, delta_scores):
+            query_main_indexes, query_main_scores, query_delta_indexes, query_delta_scores = query_results
+            merged = sorted(
+                list(zip(query_main_scores, query_main_indexes)) +
+                [(score, idx + offset) for score, idx in zip(query_delta_scores, query_delta_indexes)]
+            )[:k]
+            indexes.append([idx for _, idx in merged])
+            scores.append([score for score, _ in merged])
+        return indexes, scores
+
+    def __len__(self) -> int:
+        return len(self.main_index) + len(self.delta_index)
+
+    @property
+    def dim(self) -> int:
+        return self.main_index.dim
+
+
+def create_vector_index(backend: str, dim: int) -> VectorIndex:
+    if backend == ANNOY_BACKEND:
+        return AnnoyVectorIndex(dim)
+    elif backend == EXACT_BACKEND:
+        return ExactVectorIndex()
+    elif backend == QUANTIZED_BACKEND:
+        return QuantizedVectorIndex()
+    raise ValueError(f"Unknown vector index backend {backend}, expected one of {VECTOR_INDEX_BACKENDS}")
+
+
+def load_vector_index(backend: str, path: str, dim: int) -> VectorIndex:
+    vector_index = create_vector_index(backend, dim)
+    if os.path.exists(get_delta_path(path)):
+        vector_index = ShardedVectorIndex(vector_index)
+    vector_index.load(path)
+    return vector_index